@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+'''
+Compares IcoTool.extract_best() with the metadata only selection
+(extract_best(metadata_only=True)) on a synthetic resource DLL whose groups
+hold 8 and 32 bits per pixel images at the sizes Windows ships plus a
+256x256 PNG image. The legacy path copies every image out of the file to
+pick one per group, the metadata only path copies just the winners.
+'''
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import icotool
+import corpus
+
+def measure(filename, metadata_only, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        with icotool.IcoTool(filename, use_mmap=True) as tool:
+            icons = tool.extract_best(metadata_only=metadata_only)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    with icotool.IcoTool(filename, use_mmap=True) as tool:
+        tracemalloc.start()
+        icons = tool.extract_best(metadata_only=metadata_only)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return best, peak, icons
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-g', '--groups', type=int, default=500, help="Number of RT_GROUP_ICON resources")
+    parser.add_argument('-r', '--repeat', type=int, default=3, help="Runs per mode, best is reported")
+    args = parser.parse_args()
+
+    sizes = (16, 24, 32, 48, 64, 128)
+    groups = []
+    for g, images in enumerate(corpus.group_images(args.groups, sizes=sizes, bpp=8, png_size=256)):
+        groups.append(images + [corpus.make_dib(size, size, 32, seed=g * 1000 + size + 1) for size in sizes])
+
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, "bench.dll")
+        with open(filename, 'wb') as f:
+            f.write(corpus.make_pe(groups))
+        print(f"{filename}: {args.groups} groups of {len(groups[0])} images, {os.path.getsize(filename):,} bytes")
+        with icotool.IcoTool(filename, use_mmap=True) as tool:
+            copied = sum(len(icon['ICON']) for icon in tool.extract_all())
+        print(f"Every image: {copied:,} bytes")
+
+        for label, metadata_only in (("extract_best", False), ("metadata_only", True)):
+            elapsed, peak, icons = measure(filename, metadata_only, args.repeat)
+            returned = sum(len(icon['ICON']) for icon in icons)
+            print(f"{label:<14} {elapsed*1000:8.1f} ms  peak {peak:>13,} bytes  {len(icons)} icons, {returned:,} bytes returned")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+'''
+Compares icon decode throughput (icons per second) of the NumPy DIB decoder
+in icondecode with the Pillow path (Image.open on the ICO file, convert to
+RGBA, tobytes) for 1, 4, 8, 24 and 32 bits per pixel icons, and checks both
+produce the same pixels.
+'''
+
+import argparse
+import io
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from PIL import Image
+
+import icondecode
+import icotool
+import corpus
+
+def pillow_decode(icon):
+    img = Image.open(io.BytesIO(icon['ICON']))
+    if img.mode != "RGBA":
+        img = img.convert("RGBA")
+    return img.tobytes(), img.size
+
+def native_decode(icon):
+    return icondecode.decode_dib(icotool.icon_image(icon))
+
+def throughput(decode, icons, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        for icon in icons:
+            decode(icon)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(icons) / best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--icons', type=int, default=200, help="Icons per bit depth and size")
+    parser.add_argument('-r', '--repeat', type=int, default=3, help="Runs per decoder, best is reported")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for bpp in (1, 4, 8, 24, 32):
+            for size in (16, 32, 48):
+                filename = os.path.join(tmp, f"bench{bpp}_{size}.ico")
+                with open(filename, 'wb') as f:
+                    f.write(corpus.make_ico([corpus.make_dib(size, size, bpp, seed=seed) for seed in range(args.icons)]))
+                with icotool.IcoTool(filename) as tool:
+                    icons = tool.extract_all()
+
+                for icon in icons:
+                    if native_decode(icon) != pillow_decode(icon):
+                        print(f"ERROR: {icon['filename']} decodes differently from Pillow")
+                        sys.exit(1)
+
+                pillow = throughput(pillow_decode, icons, args.repeat)
+                native = throughput(native_decode, icons, args.repeat)
+                print(f"{bpp:2} bpp {size:3}x{size:<3} Pillow {pillow:10,.0f} icons/s  NumPy {native:10,.0f} icons/s  {native / pillow:5.2f}x")
+
+if __name__ == '__main__':
+    main()
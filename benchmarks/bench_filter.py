@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+'''
+Compares filtering icons after IcoTool.extract_all with pushing the
+icotool.IconFilter down into the parsers, on the synthetic corpora of
+corpus.write_corpus, for a few typical filters.
+'''
+
+import argparse
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import icotool
+import corpus
+
+FILTERS = {
+    '48px and up, 32 bits': {'min_width': 48, 'min_bits': 32},
+    'PNG only': {'formats': ["png"]},
+    'group 1': {'groups': ["1"]},
+}
+
+def parse(files, icon_filter, pushdown):
+    start = time.perf_counter()
+    icons = []
+    for filename in files:
+        with icotool.IcoTool(filename, use_mmap=True) as tool:
+            if pushdown:
+                icons.extend(tool.extract_all(icon_filter))
+            else:
+                icons.extend(icon for icon in tool.extract_all() if icon_filter.wanted(icon))
+    return time.perf_counter() - start, len(icons)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-s', '--scale', type=int, default=1, help="Multiplies the size of the corpora")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        corpora = corpus.write_corpus(tmp, args.scale)
+        files = [filename for filenames in corpora.values() for filename in filenames]
+        for label, options in FILTERS.items():
+            # Group patterns are only checked by the parsers
+            post, post_icons = parse(files, icotool.IconFilter(**options), False) if 'groups' not in options else (None, None)
+            icon_filter = icotool.IconFilter(**options)
+            pushed, icons = parse(files, icon_filter, True)
+            after = f"{post*1000:8.1f} ms" if post is not None else f"{'-':>11}"
+            print(f"{label:<22} after parsing {after}  pushed down {pushed*1000:8.1f} ms  {icons:>6} icons  {icon_filter.stats['skipped']:>6} skipped ({icon_filter.stats['skipped_bytes']:,} bytes, {icon_filter.stats['skipped_groups']} groups)")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+
+'''
+Measures how NE icon library (ICL) parsing scales with the number of icons.
+Time per icon should stay flat as the library grows. The memory allocated
+while parsing is checked by tests/test_icotool.py.
+'''
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import icotool
+import corpus
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--icons', type=int, nargs='+', default=[10, 1000, 10000], help="Library sizes to measure")
+    parser.add_argument('-r', '--repeat', type=int, default=3, help="Runs per size, best is reported")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for count in args.icons:
+            filename = os.path.join(tmp, f"bench{count}.icl")
+            with open(filename, 'wb') as f:
+                f.write(corpus.make_ne(corpus.group_images(count, sizes=(16,), bpp=4)))
+
+            best = None
+            for i in range(args.repeat):
+                start = time.perf_counter()
+                with icotool.IcoTool(filename, use_mmap=True) as tool:
+                    icons = tool.extract_all()
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            if len(icons) != count:
+                print(f"ERROR: expected {count} icons, got {len(icons)}")
+                sys.exit(1)
+            print(f"{count:>7} icons {best*1000:10.1f} ms {best/count*1e6:8.1f} us/icon")
+
+if __name__ == '__main__':
+    main()
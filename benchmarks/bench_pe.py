@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+'''
+Compares IcoTool's native PE resource walker against the previous
+pefile + icoextract round trip on a synthetic resource DLL.
+
+icoextract is no longer a requirement, the comparison is skipped when it
+is not installed (pip install icoextract).
+'''
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import icotool
+import corpus
+
+try:
+    from icoextract import IconExtractor
+except ImportError:
+    IconExtractor = None
+
+def legacy_extract_all(filename):
+    '''
+    The PE path before the native walker: icoextract rebuilds an ICO per
+    group which extract_ico then parses again.
+    '''
+    tool = icotool.IcoTool(filename)
+    extractor = IconExtractor(filename)
+    icons = []
+    for idx, entry in enumerate(extractor.list_group_icons()):
+        tool.cur_file = extractor.get_icon(idx).getvalue()
+        icons.extend(tool.extract_ico(index=idx))
+    return icons
+
+def native_extract_all(filename):
+    with icotool.IcoTool(filename, use_mmap=True) as tool:
+        return tool.extract_all()
+
+def timeit(func, filename, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = func(filename)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-g', '--groups', type=int, default=1000, help="Number of RT_GROUP_ICON resources")
+    parser.add_argument('-r', '--repeat', type=int, default=3, help="Runs per implementation, best is reported")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, "bench.dll")
+        with open(filename, 'wb') as f:
+            f.write(corpus.make_pe(corpus.group_images(args.groups, png_size=128)))
+        print(f"{filename}: {args.groups} groups, {os.path.getsize(filename):,} bytes")
+
+        native, native_icons = timeit(native_extract_all, filename, args.repeat)
+        print(f"native     {native*1000:10.1f} ms  {len(native_icons)} icons")
+        if IconExtractor is None:
+            print("icoextract not installed, skipping the comparison")
+            return
+        legacy, legacy_icons = timeit(legacy_extract_all, filename, args.repeat)
+        print(f"icoextract {legacy*1000:10.1f} ms  {len(legacy_icons)} icons")
+        print(f"speedup    {legacy/native:10.1f}x")
+        if legacy_icons != native_icons:
+            print("ERROR: outputs differ")
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+'''
+Compares the memory held by the IconRecords extract_all returns with the
+per icon dicts it used to return (a formatted filename, a nested
+rtIconDirEntry dict and an assembled ICO file for every icon), on a
+synthetic DLL holding many small icons.
+'''
+
+import argparse
+import gc
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import icotool
+import corpus
+
+def held(build):
+    '''
+    Returns (seconds, bytes still allocated, result) for calling build,
+    timed on a first call and measured on a second one.
+    '''
+    start = time.perf_counter()
+    build()
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, current, result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-g', '--groups', type=int, default=30000, help="Number of RT_GROUP_ICON resources (two icons each)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, "bench.dll")
+        with open(filename, 'wb') as f:
+            f.write(corpus.make_pe(corpus.group_images(args.groups, sizes=(16, 32), bpp=4)))
+
+        with icotool.IcoTool(filename, use_mmap=True) as tool:
+            elapsed, records_size, records = held(tool.extract_all)
+            count = len(records)
+            images = sum(len(icon.image) for icon in records)
+            print(f"{count:,} icons, {images:,} bytes of images")
+            print(f"IconRecord {elapsed*1000:8.1f} ms  {records_size:>13,} bytes  {records_size/count:7.1f} bytes per icon")
+
+            del records
+            elapsed, dicts_size, dicts = held(lambda: [dict(icon.items()) for icon in tool.iter_icons()])
+            print(f"dict       {elapsed*1000:8.1f} ms  {dicts_size:>13,} bytes  {dicts_size/count:7.1f} bytes per icon")
+            del dicts
+
+    print(f"IconRecords hold {100 - records_size * 100 / dicts_size:.0f}% less memory")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+'''
+Measures the latency of the icon HTTP service (iconserver) on the
+synthetic corpora of corpus.write_corpus, served from a temporary folder
+on a local port: the listing and the best icon of every file with a cold
+cache, again with a warm cache, and revalidated with If-None-Match.
+'''
+
+import argparse
+import http.client
+import os
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import iconserver
+import corpus
+
+def fetch(port, paths, tags=None):
+    '''
+    Requests every path once, returns the seconds taken, the bytes received
+    and the ETag of each path.
+    '''
+    connection = http.client.HTTPConnection("127.0.0.1", port)
+    received = 0
+    etags = {}
+    start = time.perf_counter()
+    for path in paths:
+        headers = {'If-None-Match': tags[path]} if tags else {}
+        connection.request("GET", path, headers=headers)
+        response = connection.getresponse()
+        received += len(response.read())
+        if response.status not in (200, 304):
+            raise RuntimeError(f"{path}: {response.status}")
+        etags[path] = response.getheader("ETag")
+    elapsed = time.perf_counter() - start
+    connection.close()
+    return elapsed, received, etags
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-s', '--scale', type=int, default=1, help="Multiplies the size of the corpora")
+    parser.add_argument('-j', '--jobs', type=int, default=None, help="Worker processes parsing files")
+    parser.add_argument('--size', type=int, default=48, help="Size the best icons are scaled to")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        corpora = corpus.write_corpus(tmp, args.scale)
+        files = [os.path.relpath(filename, tmp) for filenames in corpora.values() for filename in filenames]
+        paths = [f"/icons/{name}" for name in files] + [f"/icon/{name}?n=best&size={args.size}" for name in files]
+        service = iconserver.IconService(tmp, workers=args.jobs)
+        server = iconserver.IconServer(service, port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        port = server.server_address[1]
+        try:
+            print(f"{len(files)} files, {len(paths)} requests")
+            elapsed, received, tags = fetch(port, paths)
+            print(f"cold cache    {elapsed*1000:9.1f} ms {len(paths) / elapsed:10,.0f} requests/s {received:>13,} bytes")
+            elapsed, received, tags = fetch(port, paths)
+            print(f"warm cache    {elapsed*1000:9.1f} ms {len(paths) / elapsed:10,.0f} requests/s {received:>13,} bytes")
+            elapsed, received, tags = fetch(port, paths, tags)
+            print(f"not modified  {elapsed*1000:9.1f} ms {len(paths) / elapsed:10,.0f} requests/s {received:>13,} bytes")
+            print(f"{service.stats}, {service.cache.bytes:,} bytes cached")
+        finally:
+            server.shutdown()
+            server.server_close()
+            service.close()
+
+if __name__ == '__main__':
+    main()
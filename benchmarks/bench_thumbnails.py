@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+'''
+Compares the RGBA bytes the icon view holds when icons are decoded at full
+size with the fixed size thumbnails of iconcache, and the decode time of a
+scan with a cold and a warm thumbnail cache, on a synthetic resource DLL
+whose groups hold 16 to 128 pixels DIBs and a 256x256 PNG image.
+'''
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import iconcache
+import iconscan
+import corpus
+
+def scan(filename, thumbnails=None, size=iconcache.THUMBNAIL_SIZE):
+    start = time.perf_counter()
+    result = iconscan.scan_file(filename, decode=False)
+    for icon in result.icons:
+        icon['RGBA'], icon['RGBA_size'] = iconscan.decode_icon(icon, size, thumbnails)
+    return time.perf_counter() - start, sum(len(icon['RGBA']) for icon in result.icons)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-g', '--groups', type=int, default=300, help="Number of RT_GROUP_ICON resources")
+    parser.add_argument('-s', '--size', type=int, default=iconcache.THUMBNAIL_SIZE, help="Thumbnail size")
+    args = parser.parse_args()
+
+    sizes = (16, 32, 48, 128)
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, "bench.dll")
+        with open(filename, 'wb') as f:
+            f.write(corpus.make_pe(corpus.group_images(args.groups, sizes=sizes, png_size=256)))
+        print(f"{filename}: {args.groups} groups of {len(sizes) + 1} images, {os.path.getsize(filename):,} bytes")
+
+        elapsed, held = scan(filename, size=None)
+        print(f"full size       {elapsed*1000:8.1f} ms  {held:>13,} RGBA bytes held")
+        thumbnails = iconcache.ThumbnailCache(os.path.join(tmp, "thumbnails"), args.size)
+        for label in ("cold cache", "warm cache"):
+            elapsed, held = scan(filename, thumbnails, args.size)
+            print(f"{label:<15} {elapsed*1000:8.1f} ms  {held:>13,} RGBA bytes held")
+
+if __name__ == '__main__':
+    main()
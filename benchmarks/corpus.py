@@ -0,0 +1,259 @@
+'''
+Synthetic icon corpus generator
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Builds deterministic ICO images and Windows files holding them, using only
+the standard library, for the benchmarks in this folder.
+'''
+
+import os
+import random
+import struct
+import zlib
+
+def make_dib(width, height, bpp=32, seed=0):
+    '''
+    Returns an icon DIB (BITMAPINFOHEADER, palette, XOR bitmap and AND mask)
+    of width x height pixels at bpp bits per pixel filled with random pixels.
+    '''
+    rnd = random.Random(seed)
+    colors = 1 << bpp if bpp <= 8 else 0
+    header = struct.pack('<IiiHHIIiiII', 40, width, height * 2, 1, bpp, 0, 0, 0, 0, colors, 0)
+    palette = bytes(rnd.getrandbits(8) if i % 4 != 3 else 0 for i in range(colors * 4))
+    xor_stride = ((width * bpp + 31) // 32) * 4
+    and_stride = ((width + 31) // 32) * 4
+    xor = rnd.randbytes(xor_stride * height)
+    mask = rnd.randbytes(and_stride * height)
+    return header + palette + xor + mask
+
+def make_png(width, height, seed=0):
+    '''
+    Returns a width x height RGBA PNG stream filled with random pixels.
+    '''
+    rnd = random.Random(seed)
+    raw = b''.join(b'\x00' + rnd.randbytes(width * 4) for y in range(height))
+
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data))
+
+    return (b'\x89PNG\r\n\x1a\n' +
+        chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)) +
+        chunk(b'IDAT', zlib.compress(raw, 6)) +
+        chunk(b'IEND', b''))
+
+def image_entry(img):
+    '''
+    Returns the first 12 bytes of the ICONDIRENTRY (or GRPICONDIRENTRY)
+    describing image img.
+    '''
+    if img[:8] == b'\x89PNG\r\n\x1a\n':
+        width, height = struct.unpack_from('>II', img, 16)
+        bpp = 32
+    else:
+        width, height = struct.unpack_from('<ii', img, 4)
+        height //= 2
+        bpp = struct.unpack_from('<H', img, 14)[0]
+    colors = 1 << bpp if bpp < 8 else 0
+    return struct.pack('<BBBBHHI', width & 0xFF, height & 0xFF, colors, 0, 1, bpp, len(img))
+
+def make_ico(images):
+    '''
+    Returns an ICO file holding images.
+    '''
+    data = bytearray(struct.pack('<HHH', 0, 1, len(images)))
+    offset = 6 + 16 * len(images)
+    for img in images:
+        data += image_entry(img) + struct.pack('<I', offset)
+        offset += len(img)
+    for img in images:
+        data += img
+    return bytes(data)
+
+def group_images(groups, sizes=(16, 32, 48), bpp=32, png_size=None, seed=0):
+    '''
+    Returns a list of groups icon groups, each a list of DIB images at sizes
+    (plus a PNG image of png_size if given).
+    '''
+    result = []
+    for g in range(groups):
+        images = [make_dib(size, size, bpp, seed=seed + g * 1000 + size) for size in sizes]
+        if png_size:
+            images.append(make_png(png_size, png_size, seed=seed + g))
+        result.append(images)
+    return result
+
+def _rsrc_section(types, rva):
+    '''
+    Returns a resource section for types, a dict of resource type ids to
+    lists of (resource id, data), loaded at rva.
+    '''
+    type_ids = sorted(types)
+    lang_dirs = [(t, res_id, data) for t in type_ids for res_id, data in types[t]]
+
+    def directory(entries):
+        return struct.pack('<IIHHHH', 0, 0, 0, 0, 0, len(entries)) + b''.join(
+            struct.pack('<II', name, offset) for name, offset in entries)
+
+    root_size = 16 + 8 * len(type_ids)
+    type_size = sum(16 + 8 * len(types[t]) for t in type_ids)
+    lang_start = root_size + type_size
+    entries_start = lang_start + 24 * len(lang_dirs)
+    data_start = entries_start + 16 * len(lang_dirs)
+
+    root = []
+    type_dirs = bytearray()
+    n = 0
+    for t in type_ids:
+        root.append((t, 0x80000000 | (root_size + len(type_dirs))))
+        entries = []
+        for res_id, data in types[t]:
+            entries.append((res_id, 0x80000000 | (lang_start + 24 * n)))
+            n += 1
+        type_dirs += directory(entries)
+
+    lang = bytearray()
+    data_entries = bytearray()
+    blobs = bytearray()
+    for i, (t, res_id, data) in enumerate(lang_dirs):
+        lang += directory([(1033, entries_start + 16 * i)])
+        data_entries += struct.pack('<IIII', rva + data_start + len(blobs), len(data), 0, 0)
+        blobs += data + bytes(-len(data) % 4)
+
+    return directory(root) + type_dirs + lang + data_entries + blobs
+
+def make_pe(groups, pe32plus=False):
+    '''
+    Returns a PE DLL whose .rsrc section holds groups, a list of lists of
+    icon images, as RT_GROUP_ICON and RT_ICON resources.
+    '''
+    icons = []
+    group_dirs = []
+    for images in groups:
+        grp = bytearray(struct.pack('<HHH', 0, 1, len(images)))
+        for img in images:
+            icons.append((len(icons) + 1, img))
+            grp += image_entry(img) + struct.pack('<H', len(icons))
+        group_dirs.append((len(group_dirs) + 1, bytes(grp)))
+
+    section_rva = 0x1000
+    rsrc = _rsrc_section({3: icons, 14: group_dirs}, section_rva)
+    raw_size = len(rsrc) + (-len(rsrc) % 0x200)
+    rsrc += bytes(raw_size - len(rsrc))
+
+    optional_size = 240 if pe32plus else 224
+    headers = bytearray(0x200)
+    headers[0:2] = b'MZ'
+    struct.pack_into('<I', headers, 60, 0x40)
+    headers[0x40:0x44] = b'PE\0\0'
+    struct.pack_into('<HHIIIHH', headers, 0x44, 0x8664 if pe32plus else 0x14c, 1, 0, 0, 0, optional_size, 0x2102)
+    optional = 0x58
+    struct.pack_into('<H', headers, optional, 0x20b if pe32plus else 0x10b)
+    struct.pack_into('<II', headers, optional + 32, 0x1000, 0x200) # SectionAlignment, FileAlignment
+    struct.pack_into('<HH', headers, optional + 48, 4, 0) # MajorSubsystemVersion
+    image_size = section_rva + raw_size + (-raw_size % 0x1000)
+    struct.pack_into('<II', headers, optional + 56, image_size, 0x200) # SizeOfImage, SizeOfHeaders
+    struct.pack_into('<H', headers, optional + 68, 2) # Subsystem
+    data_directory = optional + (112 if pe32plus else 96)
+    struct.pack_into('<I', headers, data_directory - 4, 16) # NumberOfRvaAndSizes
+    struct.pack_into('<II', headers, data_directory + 16, section_rva, len(rsrc))
+    section = optional + optional_size
+    struct.pack_into('<8sIIII', headers, section, b'.rsrc', raw_size, section_rva, raw_size, 0x200)
+    struct.pack_into('<I', headers, section + 36, 0x40000040) # Characteristics
+    return bytes(headers) + bytes(rsrc)
+
+def make_ne(groups, names=True):
+    '''
+    Returns an NE icon library (ICL) holding groups, a list of lists of icon
+    images, as RT_GROUP_ICON and RT_ICON resources. With names each group
+    gets a resource name, as icon editors write them.
+    '''
+    icons = []
+    group_dirs = []
+    for images in groups:
+        grp = bytearray(struct.pack('<HHH', 0, 1, len(images)))
+        for img in images:
+            icons.append(img)
+            grp += image_entry(img) + struct.pack('<H', len(icons))
+        group_dirs.append(bytes(grp))
+
+    names_table = bytearray()
+    if names:
+        for name in ["ICL"] + [f"ICON{i}" for i in range(1, len(group_dirs) + 1)]:
+            names_table += bytes([len(name)]) + name.encode()
+    names_table += b'\x00'
+
+    ne_header = 0x40
+    rsrctab = ne_header + 0x40
+    table_size = 2 + 8 + 12 * len(icons) + 8 + 12 * len(group_dirs) + 2 + len(names_table)
+    data_size = sum(len(d) + 16 for d in icons + group_dirs)
+    # rnOffset is 16 bits wide, shifted left by rscAlignShift
+    shift = max(4, ((rsrctab + table_size + data_size) >> 16).bit_length())
+    align = 1 << shift
+
+    data = bytearray()
+    data_start = rsrctab + table_size
+    data_start += -data_start % align
+    offsets = []
+    for blob in icons + group_dirs:
+        offsets.append((data_start + len(data)) >> shift)
+        data += blob + bytes(-len(blob) % align)
+
+    table = bytearray(struct.pack('<H', shift))
+    for type_id, blobs, first in ((3, icons, 0), (14, group_dirs, len(icons))):
+        table += struct.pack('<HHI', 0x8000 | type_id, len(blobs), 0)
+        for i, blob in enumerate(blobs):
+            table += struct.pack('<HHHHHH', offsets[first + i], (len(blob) + align - 1) >> shift, 0x1030, 0x8000 | (i + 1), 0, 0)
+    table += b'\x00\x00' + names_table
+
+    header = bytearray(rsrctab)
+    header[0:2] = b'MZ'
+    struct.pack_into('<I', header, 60, ne_header)
+    header[ne_header:ne_header+2] = b'NE'
+    struct.pack_into('<H', header, ne_header + 36, rsrctab - ne_header)
+    return bytes(header + table + bytes(data_start - rsrctab - len(table)) + data)
+
+# Bits per pixel of the classic images in the suite corpora
+SUITE_BPP = (1, 4, 8, 24, 32)
+
+def write_corpus(folder, scale=1):
+    '''
+    Writes the benchmark suite corpora to folder, returns a dict of corpus
+    name to the list of files written:
+
+    ico: ICO files of 16, 32 and 48 pixels images at 1, 4, 8, 24 and 32
+         bits per pixel, half of them with a 256x256 PNG image
+    ne: an NE icon library (ICL) of 2000 groups of 4 and 8 bits per pixel
+        images
+    pe: a PE DLL whose .rsrc section holds 1000 groups of 16 to 48 pixels
+        images and a 128x128 PNG image
+
+    scale multiplies the number of files and groups. The same scale always
+    writes the same bytes.
+    '''
+    os.makedirs(folder, exist_ok=True)
+    corpora = {'ico': [], 'ne': [], 'pe': []}
+
+    for i in range(40 * scale):
+        bpp = SUITE_BPP[i % len(SUITE_BPP)]
+        images = [make_dib(size, size, bpp, seed=i * 100 + size) for size in (16, 32, 48)]
+        if i % 2:
+            images.append(make_png(256, 256, seed=i))
+        path = os.path.join(folder, f"suite{i:04}.ico")
+        with open(path, 'wb') as f:
+            f.write(make_ico(images))
+        corpora['ico'].append(path)
+
+    groups = []
+    for g, images in enumerate(group_images(1000 * scale, sizes=(16, 32), bpp=4, seed=1)):
+        groups.append(images)
+        groups.append([make_dib(size, size, 8, seed=(g + 1) * 7919 + size) for size in (16, 32)])
+    path = os.path.join(folder, "suite.icl")
+    with open(path, 'wb') as f:
+        f.write(make_ne(groups))
+    corpora['ne'].append(path)
+
+    path = os.path.join(folder, "suite.dll")
+    with open(path, 'wb') as f:
+        f.write(make_pe(group_images(1000 * scale, sizes=(16, 24, 32, 48), png_size=128, seed=2)))
+    corpora['pe'].append(path)
+    return corpora
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+'''
+Benchmark suite: writes the synthetic ICO, NE (ICL) and PE (DLL) corpora of
+corpus.write_corpus and measures, for each of them, the throughput and peak
+memory of every stage icons go through:
+
+parse: IcoTool.extract_all on every file
+decode: iconscan.decode_icon of every icon at full size
+scan: iconscan.Scanner, parsing and decoding thumbnails as the GUI does
+export: iconexport.Exporter writing every icon as a PNG file
+
+Results can be saved as a baseline (--save) and compared with one
+(--baseline), stages slower than the threshold are reported and make the
+suite exit with status 1. Only the standard library, the repository and
+its requirements are used, nothing is downloaded.
+'''
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import iconexport
+import iconscan
+import icotool
+import corpus
+
+def parse(files, tmp):
+    icons = []
+    for filename in files:
+        with icotool.IcoTool(filename, use_mmap=True) as tool:
+            icons.extend(tool.extract_all())
+    return len(icons), sum(len(icon['ICON']) for icon in icons)
+
+def decode(files, tmp):
+    count = size = 0
+    for filename in files:
+        with icotool.IcoTool(filename, use_mmap=True) as tool:
+            for icon in tool.iter_icons():
+                rgba, image_size = iconscan.decode_icon(icon, size=None)
+                count += 1
+                size += len(rgba)
+    return count, size
+
+def scan(files, tmp):
+    count = size = 0
+    for result in iconscan.Scanner(workers=0).scan(files):
+        count += len(result.icons)
+        size += sum(len(icon['RGBA']) for icon in result.icons)
+    return count, size
+
+def export(files, tmp):
+    folder = os.path.join(tmp, "export")
+    shutil.rmtree(folder, ignore_errors=True)
+    os.makedirs(folder)
+    items = (iconexport.ExportItem(icon['filename'][:icon['filename'].rfind(".")], ico=icon['ICON'])
+             for icon in icotool.iter_icons(files))
+    with iconexport.Exporter(folder, workers=1) as exporter:
+        summary = exporter.export(items)
+    return summary['written'], summary['bytes']
+
+STAGES = {'parse': parse, 'decode': decode, 'scan': scan, 'export': export}
+
+def measure(stage, files, tmp, repeat):
+    '''
+    Returns the result dict of stage on files: best of repeat runs, then
+    one more run under tracemalloc for the peak memory.
+    '''
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        icons, size = stage(files, tmp)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    stage(files, tmp)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'seconds': best,
+        'icons': icons,
+        'bytes': size,
+        'icons_per_s': icons / best,
+        'mb_per_s': size / best / 1048576,
+        'peak': peak,
+    }
+
+def compare(results, baseline, threshold):
+    '''
+    Prints each stage against baseline, returns the stages slower (fewer
+    icons per second) or using more memory than threshold allows.
+    '''
+    regressions = []
+    for name, stages in results.items():
+        for stage, result in stages.items():
+            base = baseline.get(name, {}).get(stage)
+            if base is None:
+                print(f"{name:<4} {stage:<7} not in the baseline")
+                continue
+            speed = result['icons_per_s'] / base['icons_per_s']
+            memory = result['peak'] / max(base['peak'], 1)
+            flags = []
+            if speed < 1 - threshold:
+                flags.append("SLOWER")
+            if memory > 1 + threshold:
+                flags.append("MORE MEMORY")
+            if flags:
+                regressions.append(f"{name}/{stage}")
+            print(f"{name:<4} {stage:<7} speed {speed:6.2f}x  peak memory {memory:6.2f}x  {' '.join(flags)}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-s', '--scale', type=int, default=1, help="Multiplies the size of the corpora")
+    parser.add_argument('-r', '--repeat', type=int, default=3, help="Runs per stage, best is reported")
+    parser.add_argument('--corpus', help="Folder to write the corpora to and keep (default: a temporary folder)", default=None)
+    parser.add_argument('--stages', help="Comma separated stages to run (default: %(default)s)", default=",".join(STAGES))
+    parser.add_argument('--save', help="Write the results to this JSON baseline", default=None, metavar="FILE")
+    parser.add_argument('--baseline', help="Compare the results with this JSON baseline", default=None, metavar="FILE")
+    parser.add_argument('--threshold', type=float, default=0.10, help="Fraction slower or larger than the baseline reported as a regression (default: %(default)s)")
+    args = parser.parse_args()
+
+    stages = args.stages.split(",")
+    for stage in stages:
+        if stage not in STAGES:
+            parser.error(f"unknown stage {stage}, choose from {', '.join(STAGES)}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        start = time.perf_counter()
+        corpora = corpus.write_corpus(args.corpus or os.path.join(tmp, "corpus"), args.scale)
+        print(f"Corpora written in {time.perf_counter() - start:.1f}s")
+
+        results = {}
+        for name, files in corpora.items():
+            size = sum(os.path.getsize(filename) for filename in files)
+            print(f"{name}: {len(files)} files, {size:,} bytes")
+            results[name] = {}
+            for stage in stages:
+                result = results[name][stage] = measure(STAGES[stage], files, tmp, args.repeat)
+                print(f"  {stage:<7} {result['seconds']*1000:9.1f} ms {result['icons']:>7} icons {result['icons_per_s']:>10,.0f} icons/s {result['mb_per_s']:>8.1f} MB/s  peak {result['peak']:>13,} bytes")
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({'python': platform.python_version(), 'machine': platform.machine(), 'scale': args.scale, 'results': results}, f, indent=2)
+        print(f"Baseline saved to {args.save}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('scale') != args.scale:
+            print(f"WARNING: the baseline was measured at scale {baseline.get('scale')}")
+        regressions = compare(results, baseline['results'], args.threshold)
+        if regressions:
+            print(f"Regressions: {', '.join(regressions)}")
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+import logging
+import os
+import tarfile
+import zipfile
+
+import iconprofile
+import icotool
+
+'''
+Icons Archive Reader
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Finds the ICO, ICL, DLL and EXE files inside zip and tar archives (.tar,
+.tar.gz, .tgz, .tar.bz2, .tar.xz) without unpacking them to disk. Members
+are read forward only, tar archives as a stream, and only their headers
+are read unless they can hold icons, those are read into memory and handed
+to the scan engine as ArchiveMembers.
+'''
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# Archive suffixes and how they are read
+ARCHIVE_TYPES = {
+    '.zip': 'zip',
+    '.tar': 'tar',
+    '.tar.gz': 'tar',
+    '.tgz': 'tar',
+    '.tar.bz2': 'tar',
+    '.tbz2': 'tar',
+    '.tar.xz': 'tar',
+    '.txz': 'tar',
+}
+
+# Larger members are skipped rather than read into memory
+MAX_MEMBER_SIZE = 256 * 1024 * 1024
+
+class ArchiveMember:
+    '''
+    A member of an archive that can hold icons:
+
+    archive: str, path of the archive
+    name: str, path of the member in the archive
+    filetype: "ICO", "NE" or "PE"
+    data: bytes, the member
+    '''
+
+    __slots__ = ('archive', 'name', 'filetype', 'data')
+
+    def __init__(self, archive, name, filetype, data):
+        self.archive = archive
+        self.name = name
+        self.filetype = filetype
+        self.data = data
+
+    @property
+    def filename(self):
+        # Where the member would be if the archive was unpacked in place
+        return os.path.join(self.archive, self.name)
+
+    def __repr__(self):
+        return f"ArchiveMember({self.archive!r}, {self.name!r}, {self.filetype!r}, {len(self.data)} bytes)"
+
+def archive_type(path):
+    '''
+    Returns "zip" or "tar" for an archive path, from its suffix, or None.
+    '''
+    name = str(path).lower()
+    for suffix, kind in ARCHIVE_TYPES.items():
+        if name.endswith(suffix):
+            return kind
+    return None
+
+def read_member(archive, name, f):
+    '''
+    Sniffs the member name read from f, returns an ArchiveMember or None if
+    it cannot hold icons.
+    '''
+    with iconprofile.stage("sniff"):
+        filetype, header = icotool.sniff_stream(f)
+    if filetype is None:
+        iconprofile.count("not_icon_file", nbytes=len(header))
+        return None
+    with iconprofile.stage("archive_read") as timer:
+        data = header + f.read()
+        timer.nbytes = len(data)
+    return ArchiveMember(archive, name, filetype, data)
+
+def iter_members(path, max_member_size=MAX_MEMBER_SIZE):
+    '''
+    Yields an ArchiveMember for each member of the archive at path that can
+    hold icons, in archive order. Raises the errors of the archive itself
+    (for example a corrupt archive), members that cannot be read are
+    skipped.
+    '''
+    path = str(path)
+    if archive_type(path) == "zip":
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                if info.is_dir() or info.file_size > max_member_size:
+                    continue
+                try:
+                    with archive.open(info) as f:
+                        member = read_member(path, info.filename, f)
+                except (RuntimeError, zipfile.BadZipFile, NotImplementedError, OSError) as e:
+                    # Encrypted, damaged or unsupported compression
+                    logger.debug(f"Unable to read {info.filename} in {path}: {e}")
+                    continue
+                if member is not None:
+                    yield member
+    else:
+        # Stream mode reads the (compressed) archive once, front to back
+        with tarfile.open(path, "r|*") as archive:
+            for info in archive:
+                if not info.isfile() or info.size > max_member_size:
+                    continue
+                f = archive.extractfile(info)
+                if f is None:
+                    continue
+                # Members added as ./name are named as if unpacked
+                name = info.name[2:] if info.name.startswith("./") else info.name
+                member = read_member(path, name, f)
+                if member is not None:
+                    yield member
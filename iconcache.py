@@ -0,0 +1,129 @@
+import logging
+import os
+import struct
+from collections import OrderedDict
+from pathlib import Path
+
+'''
+Icons Caches
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+ThumbnailCache keeps the fixed size thumbnails shown in the icon view on
+disk, keyed by the digest of the icon image, so large images are only
+scaled down once. LRUCache holds decoded full size images within a memory
+budget, they are decoded on demand for copy and export.
+'''
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+DEFAULT_THUMBNAILS = Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "iconsext" / "thumbnails"
+# Largest width and height of the thumbnails shown in the icon view
+THUMBNAIL_SIZE = 64
+# Memory budget of the decoded full size images
+DEFAULT_LRU_SIZE = 64 * 1024 * 1024
+
+# Width and height of the RGBA pixels that follow in a thumbnail file
+THUMBNAIL_HEADER = struct.Struct('<II')
+
+class ThumbnailCache:
+    '''
+    Thumbnails of at most size x size pixels, stored as raw RGBA files
+    under path (None only sets their size, nothing is stored). Only images
+    larger than size are stored, smaller images are their own thumbnail
+    and decode faster than a file can be read.
+
+    Instances are passed to the scan worker processes, several processes
+    can share the same cache.
+    '''
+
+    def __init__(self, path=DEFAULT_THUMBNAILS, size=THUMBNAIL_SIZE):
+        self.path = None if path is None else Path(path)
+        self.size = size
+
+    def thumbnail_path(self, digest):
+        return self.path / str(self.size) / digest[:2] / f"{digest}.rgba"
+
+    def get(self, digest):
+        '''
+        Returns the cached thumbnail of the image with digest as (RGBA
+        bytes, (width, height)), or None.
+        '''
+        if self.path is None:
+            return None
+        try:
+            with open(self.thumbnail_path(digest), 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        if len(data) < THUMBNAIL_HEADER.size:
+            return None
+        width, height = THUMBNAIL_HEADER.unpack_from(data)
+        if len(data) != THUMBNAIL_HEADER.size + width * height * 4:
+            logger.debug(f"Ignoring truncated thumbnail {digest}")
+            return None
+        return data[THUMBNAIL_HEADER.size:], (width, height)
+
+    def put(self, digest, rgba, size):
+        '''
+        Stores the thumbnail of the image with digest, failures are only
+        logged.
+        '''
+        if self.path is None:
+            return
+        path = self.thumbnail_path(digest)
+        tmp = path.with_suffix(f".{os.getpid()}.tmp")
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(tmp, 'wb') as f:
+                f.write(THUMBNAIL_HEADER.pack(*size))
+                f.write(rgba)
+            # Readers in other processes never see a partial file
+            os.replace(tmp, path)
+        except OSError as e:
+            logger.debug(f"Unable to cache thumbnail {digest}: {e}")
+
+class LRUCache:
+    '''
+    A mapping that keeps at most max_bytes worth of values, evicting the
+    least recently used ones first. The size of each value is given when
+    it is stored.
+    '''
+
+    def __init__(self, max_bytes=DEFAULT_LRU_SIZE):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.items = OrderedDict()
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def get(self, key, default=None):
+        if key not in self.items:
+            return default
+        self.items.move_to_end(key)
+        return self.items[key][0]
+
+    def put(self, key, value, nbytes):
+        if key in self.items:
+            self.bytes -= self.items.pop(key)[1]
+        if nbytes > self.max_bytes:
+            # Never cached, it would evict everything else
+            return
+        self.items[key] = (value, nbytes)
+        self.bytes += nbytes
+        while self.bytes > self.max_bytes:
+            evicted, (value, size) = self.items.popitem(last=False)
+            self.bytes -= size
+            logger.debug(f"Evicted {evicted} ({size:,} bytes)")
+
+    def discard(self, key):
+        if key in self.items:
+            self.bytes -= self.items.pop(key)[1]
+
+    def clear(self):
+        self.items.clear()
+        self.bytes = 0
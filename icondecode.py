@@ -0,0 +1,103 @@
+import logging
+import struct
+
+import icotool
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+'''
+Icons DIB Decoder
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Decodes the classic device independent bitmap (DIB) images found in ICO,
+ICL, DLL and EXE files (1, 4, 8, 24 and 32 bits per pixel, uncompressed)
+straight to RGBA with NumPy: palette lookup, AND mask transparency and the
+bottom-up row order are handled on whole arrays instead of pixel by pixel.
+
+PNG images, compressed or 16 bits per pixel DIBs, or a missing NumPy are
+left to Pillow, see decode_dib.
+'''
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+BITMAPINFOHEADER = struct.Struct('<IiiHHIIiiII') # biSize, biWidth, biHeight, biPlanes, biBitCount, biCompression, biSizeImage, biXPelsPerMeter, biYPelsPerMeter, biClrUsed, biClrImportant
+BI_RGB = 0
+NATIVE_BIT_COUNTS = (1, 4, 8, 24, 32)
+
+def unpack_bits(rows, bit_count, width):
+    '''
+    Returns the width pixel values of each row of rows packed at bit_count
+    (1, 4 or 8) bits per pixel, most significant bits first.
+    '''
+    if bit_count == 8:
+        return rows[:, :width]
+    if bit_count == 4:
+        return numpy.stack((rows >> 4, rows & 0x0F), axis=-1).reshape(rows.shape[0], -1)[:, :width]
+    return numpy.unpackbits(rows, axis=1)[:, :width]
+
+def decode_dib(data):
+    '''
+    Decodes an icon DIB (BITMAPINFOHEADER, palette, XOR bitmap and AND mask)
+    to RGBA, returns (bytes, (width, height)) like iconscan.decode_icon.
+
+    32 bits per pixel images use their own alpha channel, unless it is
+    empty, the others are transparent where their AND mask is set.
+
+    Returns None when the image is not a DIB this decoder handles (or NumPy
+    is not installed), the caller should then use Pillow.
+    '''
+    if numpy is None or len(data) < BITMAPINFOHEADER.size or bytes(data[:8]) == icotool.PNG_SIGNATURE:
+        return None
+    biSize, biWidth, biHeight, biPlanes, biBitCount, biCompression, biSizeImage, biXPelsPerMeter, biYPelsPerMeter, biClrUsed, biClrImportant = BITMAPINFOHEADER.unpack_from(data)
+    # Top-down (negative height) icons are left to Pillow
+    if biSize < BITMAPINFOHEADER.size or biCompression != BI_RGB or biBitCount not in NATIVE_BIT_COUNTS or biWidth <= 0 or biHeight <= 1:
+        return None
+
+    width = biWidth
+    # The height covers both the XOR bitmap and the AND mask
+    height = biHeight // 2
+    buf = numpy.frombuffer(data, dtype=numpy.uint8)
+
+    offset = biSize
+    palette = None
+    if biBitCount <= 8:
+        colors = biClrUsed or 1 << biBitCount
+        if colors > 256 or len(buf) < offset + colors * 4:
+            return None
+        # RGBQUADs, padded so out of range indices are black
+        palette = numpy.zeros((256, 4), dtype=numpy.uint8)
+        palette[:colors] = buf[offset:offset + colors * 4].reshape(-1, 4)
+        offset += colors * 4
+
+    xor_stride = ((width * biBitCount + 31) // 32) * 4
+    and_stride = ((width + 31) // 32) * 4
+    xor_end = offset + xor_stride * height
+    and_end = xor_end + and_stride * height
+    if len(buf) < xor_end:
+        return None
+    # Rows are stored bottom-up, flip them while reading
+    xor = buf[offset:xor_end].reshape(height, xor_stride)[::-1]
+    mask = None
+    if len(buf) >= and_end:
+        mask = unpack_bits(buf[xor_end:and_end].reshape(height, and_stride)[::-1], 1, width)
+    elif biBitCount != 32:
+        return None
+
+    rgba = numpy.empty((height, width, 4), dtype=numpy.uint8)
+    if biBitCount == 32:
+        bgra = xor[:, :width * 4].reshape(height, width, 4)
+        rgba[..., 0:3] = bgra[..., 2::-1]
+        rgba[..., 3] = bgra[..., 3]
+        if mask is None or rgba[..., 3].any():
+            return rgba.tobytes(), (width, height)
+    elif biBitCount == 24:
+        rgba[..., 0:3] = xor[:, :width * 3].reshape(height, width, 3)[..., ::-1]
+    else:
+        rgba[..., 0:3] = palette[unpack_bits(xor, biBitCount, width)][..., 2::-1]
+
+    rgba[..., 3] = numpy.where(mask, 0, 255)
+    return rgba.tobytes(), (width, height)
@@ -0,0 +1,356 @@
+import io
+import json
+import logging
+import os
+import concurrent.futures
+import tarfile
+import time
+import zipfile
+from collections import deque
+
+import iconprofile
+import iconscan
+import icotool
+
+'''
+Icons Export Engine
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Writes icons to a folder, or into a single zip or tar archive, using a pool
+of worker threads, so exporting thousands of icons keeps every core busy
+and never blocks the GUI main loop.
+
+The target folder is listed once, callers resolve which existing files to
+skip or overwrite before the export starts. Archives are streamed: each
+icon is written as soon as it is encoded, followed by a manifest, without
+temporary files. Progress is reported as icons complete, the export can be
+cancelled and returns a summary of what was written and what failed.
+'''
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# Seconds between checks for cancellation while waiting on workers
+CANCEL_POLL = 0.1
+
+# Archive suffixes and the tarfile stream mode they are written with
+TAR_MODES = {
+    '.tar': 'w|',
+    '.tar.gz': 'w|gz',
+    '.tgz': 'w|gz',
+    '.tar.bz2': 'w|bz2',
+    '.tar.xz': 'w|xz',
+}
+
+# zlib compression level of each type of archive entry, 0 stores it.
+# PNG streams (and ICO files wrapping one) are already compressed.
+DEFAULT_LEVELS = {'png': 0, 'ico': 6, 'manifest': 6}
+
+class ExportItem:
+    '''
+    One icon to export:
+
+    name: str, file name without the extension
+    png: bytes, a PNG stream written unchanged (PNG compressed icons), or
+    pixels: bytes, 8 bit RGB or RGBA pixels encoded to PNG when written
+    size: (width, height) of pixels
+    rowstride: bytes per row of pixels, defaults to packed rows
+    has_alpha: pixels are RGBA rather than RGB
+    ico: bytes, the icon as an ICO file (IconRecord 'ICON'), written when
+         exporting ICO files. Without png or pixels it is decoded at full
+         size when the item is encoded, in a worker thread.
+    meta: dict, written to the manifest of archives
+    '''
+
+    def __init__(self, name, png=None, pixels=None, size=(0, 0), rowstride=0, has_alpha=True, ico=None, meta=None):
+        self.name = name
+        self.png = png
+        self.pixels = pixels
+        self.size = size
+        self.rowstride = rowstride
+        self.has_alpha = has_alpha
+        self.ico = ico
+        self.meta = meta
+
+    @property
+    def filename(self):
+        return f"{self.name}.png"
+
+    def png_bytes(self):
+        '''
+        Returns the icon as a PNG file.
+        '''
+        if self.png is not None:
+            return self.png
+        from PIL import Image
+        if self.pixels is None:
+            # Only the ICO file is known
+            icon = {'ICON': self.ico}
+            png = icotool.icon_png(icon)
+            if png is not None:
+                return png
+            pixels, size = iconscan.decode_icon(icon, size=None)
+            img = Image.frombuffer("RGBA", size, pixels, "raw", "RGBA", 0, 1)
+        else:
+            mode = "RGBA" if self.has_alpha else "RGB"
+            img = Image.frombuffer(mode, self.size, self.pixels, "raw", mode, self.rowstride, 1)
+        output = io.BytesIO()
+        img.save(output, "png")
+        return output.getvalue()
+
+def write_item(folder, item):
+    '''
+    Writes item to folder, returns the number of bytes written.
+    '''
+    data = item.png_bytes()
+    with open(os.path.join(folder, item.filename), "wb") as f:
+        f.write(data)
+    return len(data)
+
+class UniqueNames:
+    '''
+    Gives each icon exported a file name (without its extension) of its
+    own. Icon names only come from the name of their source file, the
+    group and the size, so same named files in different folders give the
+    same ones: later icons get a _2, _3... suffix.
+
+    key identifies one icon of one source, the same key always gets the
+    same name, so a source scanned again replaces its own icons.
+    '''
+
+    def __init__(self):
+        self.names = {}
+        self.used = set()
+
+    def name(self, key, name):
+        unique = self.names.get(key)
+        if unique is None:
+            unique = name
+            n = 1
+            while unique in self.used:
+                n += 1
+                unique = f"{name}_{n}"
+            self.used.add(unique)
+            self.names[key] = unique
+        return unique
+
+class Exporter:
+    '''
+    Exports icons to folder.
+
+    workers: number of worker threads, defaults to the number of CPUs.
+             PNG encoding and writes release the GIL, so threads run them
+             in parallel.
+    '''
+
+    def __init__(self, folder, workers=None):
+        self.folder = str(folder)
+        self.workers = max((os.cpu_count() or 1) if workers is None else workers, 1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        pass
+
+    def existing(self):
+        '''
+        Returns the set of file names already in the folder, listing it
+        once instead of checking every file.
+        '''
+        try:
+            with os.scandir(self.folder) as entries:
+                return {entry.name for entry in entries}
+        except FileNotFoundError:
+            return set()
+
+    def encode(self, item):
+        '''
+        Runs in a worker thread, writes item and returns its size.
+        '''
+        with iconprofile.stage("export_write") as timer:
+            size = timer.nbytes = write_item(self.folder, item)
+        return size
+
+    def store(self, item, result):
+        '''
+        Runs in the calling thread with what encode returned for item, in
+        the order items were given. Returns the number of bytes written.
+        '''
+        return result
+
+    def export(self, items, cancel=None, progress=None):
+        '''
+        Writes items (ExportItems, files already in the folder are
+        overwritten) and returns a summary dict: the number of icons
+        'written', 'bytes' written, 'failed' (a list of (name, error)),
+        whether the export was 'cancelled' and the 'elapsed' seconds.
+
+        items can be any iterable, it is consumed as icons are written.
+
+        cancel: optional threading.Event, once it is set icons not yet
+                started are dropped
+        progress: optional function called with (done, total) from the
+                  calling thread as icons complete, total is 0 when items
+                  has no length
+        '''
+        summary = {'written': 0, 'bytes': 0, 'failed': [], 'cancelled': False, 'elapsed': 0.0}
+        start = time.monotonic()
+        total = len(items) if hasattr(items, '__len__') else 0
+        done = 0
+        logger.debug(f"Exporting {total or 'all'} icons with {self.workers} workers")
+
+        def finished(future, item):
+            nonlocal done
+            done += 1
+            try:
+                summary['bytes'] += self.store(item, future.result())
+                summary['written'] += 1
+            except Exception as e:
+                logger.debug(f"Unable to export {item.name}: {e}")
+                summary['failed'].append((item.name, f"{type(e).__name__}: {e}"))
+            if progress is not None:
+                progress(done, total)
+
+        # Bound the icons in flight so encoded images do not pile up
+        max_pending = self.workers * 4
+        pending = deque()
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as executor:
+            try:
+                for item in items:
+                    if cancel is not None and cancel.is_set():
+                        summary['cancelled'] = True
+                        break
+                    pending.append((executor.submit(self.encode, item), item))
+                    while len(pending) >= max_pending:
+                        if cancel is not None and cancel.is_set():
+                            break
+                        concurrent.futures.wait([pending[0][0]], timeout=CANCEL_POLL)
+                        while pending and pending[0][0].done():
+                            finished(*pending.popleft())
+                while pending:
+                    future, item = pending.popleft()
+                    if cancel is not None and cancel.is_set() and future.cancel():
+                        summary['cancelled'] = True
+                        continue
+                    concurrent.futures.wait([future])
+                    finished(future, item)
+            finally:
+                for future, item in pending:
+                    future.cancel()
+
+        summary['elapsed'] = time.monotonic() - start
+        return summary
+
+def archive_mode(path):
+    '''
+    Returns "zip" or the tarfile stream mode for an archive path, from its
+    suffix, or None if it is not an archive.
+    '''
+    name = str(path).lower()
+    if name.endswith('.zip'):
+        return 'zip'
+    for suffix, mode in TAR_MODES.items():
+        if name.endswith(suffix):
+            return mode
+    return None
+
+class ArchiveExporter(Exporter):
+    '''
+    Exports icons into a single zip or tar archive at path (its type comes
+    from the suffix: .zip, .tar, .tar.gz, .tgz, .tar.bz2 or .tar.xz),
+    followed by a manifest with one JSON object per icon. Use it as a
+    context manager, the manifest is written when it is closed.
+
+    fmt: "png" to export PNG files, "ico" for the ICO files of the icons
+    levels: zlib compression level of each entry type ('png', 'ico' and
+            'manifest', see DEFAULT_LEVELS), 0 stores the entry. Only zip
+            archives compress each entry, tar archives are compressed as a
+            whole according to their suffix.
+    manifest: name of the manifest in the archive, None to leave it out
+
+    Entries are encoded by the worker threads and written in order by the
+    calling thread, only the icons in flight and the manifest lines are
+    held in memory.
+    '''
+
+    def __init__(self, path, fmt="png", levels=None, manifest="manifest.jsonl", workers=None):
+        super().__init__(os.path.dirname(str(path)) or ".", workers)
+        self.path = str(path)
+        self.fmt = fmt
+        self.levels = dict(DEFAULT_LEVELS, **(levels or {}))
+        self.manifest = manifest
+        self.manifest_lines = []
+        self.mode = archive_mode(self.path)
+        if self.mode is None:
+            raise ValueError(f"Unknown archive type: {self.path}")
+        logger.debug(f"Opening archive {self.path}")
+        if self.mode == 'zip':
+            self.archive = zipfile.ZipFile(self.path, 'w')
+        else:
+            self.archive = tarfile.open(self.path, self.mode)
+        self.names = set()
+        self.mtime = time.time()
+
+    def close(self):
+        if self.archive is None:
+            return
+        try:
+            if self.manifest:
+                data = "".join(line + "\n" for line in self.manifest_lines).encode()
+                self.add_entry(self.manifest, data, 'manifest')
+        finally:
+            self.archive.close()
+            self.archive = None
+
+    def add_manifest(self, entry):
+        '''
+        Adds entry, a dict, to the manifest without adding a file, for
+        example to list where a duplicate of an exported icon was found.
+        '''
+        if self.manifest:
+            self.manifest_lines.append(json.dumps(entry))
+
+    def add_entry(self, name, data, entry_type):
+        if self.mode == 'zip':
+            info = zipfile.ZipInfo(name, time.localtime(self.mtime)[:6])
+            level = self.levels.get(entry_type, 0)
+            if level:
+                info.compress_type = zipfile.ZIP_DEFLATED
+                self.archive.writestr(info, data, compresslevel=level)
+            else:
+                self.archive.writestr(info, data)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = self.mtime
+            self.archive.addfile(info, io.BytesIO(data))
+
+    def encode(self, item):
+        '''
+        Runs in a worker thread, returns (data, entry type) for item.
+        '''
+        if self.fmt == "ico":
+            data = item.ico
+            entry_type = 'png' if data[22:30] == icotool.PNG_SIGNATURE else 'ico'
+            return data, entry_type
+        with iconprofile.stage("export_encode") as timer:
+            data = item.png_bytes()
+            timer.nbytes = len(data)
+        return data, 'png'
+
+    def store(self, item, result):
+        data, entry_type = result
+        name = f"{item.name}.{self.fmt}"
+        if name in self.names:
+            # Archives can hold the same name twice, keep the first icon
+            raise FileExistsError(f"{name} is already in the archive")
+        with iconprofile.stage("archive_write", len(data)):
+            self.add_entry(name, data, entry_type)
+        self.names.add(name)
+        if self.manifest:
+            self.manifest_lines.append(json.dumps({'path': name, **(item.meta or {}), 'bytes': len(data)}))
+        return len(data)
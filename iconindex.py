@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from pathlib import Path
+
+'''
+Icons Scan Index
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+A persistent SQLite index of scanned files. For each file it keeps a
+fingerprint (path, size, modification time and optionally a SHA-1 of the
+content) together with the icons icotool.IcoTool.extract_all returned for
+it: their metadata and raw ICO files. Files that did not change since they
+were indexed are loaded from the index instead of being parsed again.
+
+The index is capped in size, the least recently used files are evicted
+first. Run this module to show, verify or prune an index.
+'''
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+DEFAULT_INDEX = Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "iconsext" / "index.sqlite"
+DEFAULT_MAX_SIZE = 512 * 1024 * 1024
+# Files stored between commits
+COMMIT_EVERY = 500
+# Fraction of the size cap kept when evicting
+EVICT_TO = 0.9
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    sha1 TEXT,
+    filetype TEXT,
+    bytes INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_last_used ON files (last_used);
+CREATE TABLE IF NOT EXISTS icons (
+    path TEXT NOT NULL REFERENCES files (path) ON DELETE CASCADE,
+    seq INTEGER NOT NULL,
+    meta TEXT NOT NULL,
+    icon BLOB NOT NULL,
+    PRIMARY KEY (path, seq)
+);
+'''
+
+# Keys added by the scan engine that are not stored
+UNSTORED_KEYS = ('ICON', 'RGBA', 'RGBA_size', 'digest')
+
+def file_sha1(filename):
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+class ScanIndex:
+    '''
+    Opens (or creates) the index at path.
+
+    max_size: total size in bytes of the icons kept, older files are
+              evicted past it
+    use_hash: also store the SHA-1 of each file, verify() then checks the
+              content and not only the size and modification time
+    '''
+
+    def __init__(self, path=DEFAULT_INDEX, max_size=DEFAULT_MAX_SIZE, use_hash=False):
+        self.path = Path(path)
+        self.max_size = max_size
+        self.use_hash = use_hash
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        logger.debug(f"Opening scan index {self.path}")
+        self.db = sqlite3.connect(str(self.path))
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("PRAGMA foreign_keys=ON")
+        self.db.executescript(SCHEMA)
+        self.total = self.db.execute("SELECT COALESCE(SUM(bytes), 0) FROM files").fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+        self.uncommitted = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.db is not None:
+            self.db.commit()
+            self.db.close()
+            self.db = None
+
+    def lookup(self, filename, stat=None):
+        '''
+        Returns (filetype, icons) for filename if it is indexed and its size
+        and modification time did not change, otherwise None. icons is a
+        list of icon dicts as returned by IcoTool.extract_all.
+        '''
+        filename = str(filename)
+        try:
+            stat = stat or os.stat(filename)
+        except OSError:
+            return None
+        row = self.db.execute("SELECT size, mtime_ns, filetype FROM files WHERE path = ?", (filename,)).fetchone()
+        if row is None or row[0] != stat.st_size or row[1] != stat.st_mtime_ns:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.db.execute("UPDATE files SET last_used = ? WHERE path = ?", (time.time(), filename))
+        icons = []
+        for meta, icon in self.db.execute("SELECT meta, icon FROM icons WHERE path = ? ORDER BY seq", (filename,)):
+            icon_dict = json.loads(meta)
+            icon_dict['ICON'] = icon
+            icons.append(icon_dict)
+        return row[2], icons
+
+    def store(self, filename, size, mtime_ns, filetype, icons):
+        '''
+        Indexes the icons of filename (size bytes, modified at mtime_ns when
+        it was parsed), replacing any previous entry.
+        '''
+        filename = str(filename)
+        nbytes = sum(len(icon['ICON']) for icon in icons)
+        if nbytes > self.max_size:
+            logger.debug(f"Not indexing {filename}, {nbytes:,} bytes is over the index size")
+            return
+        sha1 = None
+        if self.use_hash:
+            try:
+                sha1 = file_sha1(filename)
+            except OSError:
+                return
+
+        self.remove(filename)
+        self.db.execute("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (filename, size, mtime_ns, sha1, filetype, nbytes, time.time()))
+        self.db.executemany("INSERT INTO icons VALUES (?, ?, ?, ?)", (
+            (filename, seq, json.dumps({k: v for k, v in icon.items() if k not in UNSTORED_KEYS}), bytes(icon['ICON']))
+            for seq, icon in enumerate(icons)))
+        self.total += nbytes
+        if self.total > self.max_size:
+            # Leave some room so eviction does not run on every store
+            self.evict(int(self.max_size * EVICT_TO))
+        self.uncommitted += 1
+        if self.uncommitted >= COMMIT_EVERY:
+            self.db.commit()
+            self.uncommitted = 0
+
+    def remove(self, filename):
+        row = self.db.execute("SELECT bytes FROM files WHERE path = ?", (filename,)).fetchone()
+        if row:
+            self.db.execute("DELETE FROM files WHERE path = ?", (filename,))
+            self.total -= row[0]
+
+    def evict(self, max_size=None):
+        '''
+        Removes the least recently used files until the index holds at most
+        max_size (default: the index size cap) bytes of icons. Returns the
+        number of files removed.
+        '''
+        max_size = self.max_size if max_size is None else max_size
+        removed = 0
+        rows = self.db.execute("SELECT path, bytes FROM files ORDER BY last_used").fetchall()
+        for path, nbytes in rows:
+            if self.total <= max_size:
+                break
+            self.db.execute("DELETE FROM files WHERE path = ?", (path,))
+            self.total -= nbytes
+            removed += 1
+        logger.debug(f"Evicted {removed} files from the scan index")
+        return removed
+
+    def verify(self, remove=False):
+        '''
+        Checks every indexed file against the file system. Returns a dict
+        with the number of files 'checked', 'missing' and 'changed', with
+        remove stale entries are deleted.
+        '''
+        report = {'checked': 0, 'missing': 0, 'changed': 0}
+        rows = self.db.execute("SELECT path, size, mtime_ns, sha1 FROM files").fetchall()
+        for path, size, mtime_ns, sha1 in rows:
+            report['checked'] += 1
+            try:
+                stat = os.stat(path)
+                changed = stat.st_size != size or stat.st_mtime_ns != mtime_ns
+                if not changed and sha1:
+                    changed = file_sha1(path) != sha1
+            except OSError:
+                report['missing'] += 1
+                logger.debug(f"{path} is missing")
+                if remove:
+                    self.remove(path)
+                continue
+            if changed:
+                report['changed'] += 1
+                logger.debug(f"{path} changed")
+                if remove:
+                    self.remove(path)
+        self.db.commit()
+        return report
+
+    def prune(self):
+        '''
+        Removes missing and changed files, evicts down to the size cap and
+        compacts the database. Returns the verify() report plus the number
+        of files 'evicted'.
+        '''
+        report = self.verify(remove=True)
+        report['evicted'] = self.evict()
+        self.db.commit()
+        self.db.execute("VACUUM")
+        return report
+
+    def stats(self):
+        files, icons = self.db.execute("SELECT COUNT(*), (SELECT COUNT(*) FROM icons) FROM files").fetchone()
+        return {'files': files, 'icons': icons, 'bytes': self.total, 'max_size': self.max_size}
+
+def main():
+    desc = 'Show, verify or prune an Icons Extractor scan index.'
+    arg_parser = argparse.ArgumentParser(description=desc)
+    arg_parser.add_argument('-d', '--debug', help="Print debugging statements", action="store_const", dest="loglevel", const=logging.DEBUG, default=logging.WARNING)
+    arg_parser.add_argument("command", help="stats: show the index size, verify: check indexed files are unchanged, prune: remove stale files and evict down to the size cap", choices=["stats", "verify", "prune"])
+    arg_parser.add_argument("-i", "--index", help=f"Index file (default: {DEFAULT_INDEX})", default=DEFAULT_INDEX)
+    arg_parser.add_argument("--max-size", help="Size cap in MB used by prune", type=int, default=DEFAULT_MAX_SIZE // (1024 * 1024))
+    args = arg_parser.parse_args()
+    logging.basicConfig(level=args.loglevel)
+
+    with ScanIndex(args.index, max_size=args.max_size * 1024 * 1024) as index:
+        if args.command == "verify":
+            report = index.verify()
+        elif args.command == "prune":
+            report = index.prune()
+        else:
+            report = index.stats()
+        for key, value in report.items():
+            print(f"{key}: {value:,}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+import array
+import json
+import logging
+import threading
+import time
+
+'''
+Icons Stage Profiler
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Counters and timers around each stage of a scan (folder walk, file reads,
+file type detection, resource parsing, decoding, pixbufs...) to tell where
+the time goes on real data.
+
+Profiling is off by default, stage() then returns a shared object that
+does nothing, so the instrumented code only pays for a function call.
+Once enabled every stage records its count, total time, bytes and the
+duration of each call, reported as a per stage summary with percentiles:
+
+    iconprofile.enable()
+    with iconprofile.stage("parse_pe", nbytes=size):
+        ...
+    print(iconprofile.report())
+
+Worker processes collect() their stages and the scan engine merge()s them
+into the calling process.
+'''
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+enabled = False
+# Stage by name, updated from any thread under lock
+stages = {}
+lock = threading.Lock()
+
+class Stage:
+    '''
+    What was recorded for one stage: the number of calls (count), their
+    total seconds, the bytes they processed and the duration of each timed
+    call (samples). Counters only have a count and bytes.
+    '''
+
+    __slots__ = ('name', 'count', 'total', 'bytes', 'samples')
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.total = 0.0
+        self.bytes = 0
+        self.samples = array.array('d')
+
+    def percentile(self, fraction):
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[round(fraction * (len(ordered) - 1))]
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'p50': self.percentile(0.5),
+            'p95': self.percentile(0.95),
+            'bytes': self.bytes,
+        }
+
+class Timer:
+    '''
+    Records the time spent in a with block as one call of a stage. nbytes
+    can be set inside the block once the size processed is known.
+    '''
+
+    __slots__ = ('name', 'nbytes', 'start')
+
+    def __init__(self, name, nbytes=0):
+        self.name = name
+        self.nbytes = nbytes
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        record(self.name, time.perf_counter() - self.start, self.nbytes)
+
+class NullTimer:
+    '''
+    Returned by stage() when profiling is disabled.
+    '''
+
+    nbytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def __setattr__(self, name, value):
+        pass
+
+NULL_TIMER = NullTimer()
+
+def enable():
+    global enabled
+    enabled = True
+
+def disable():
+    global enabled
+    enabled = False
+
+def reset():
+    with lock:
+        stages.clear()
+
+def stage(name, nbytes=0):
+    '''
+    Returns a context manager timing one call of stage name.
+    '''
+    if not enabled:
+        return NULL_TIMER
+    return Timer(name, nbytes)
+
+def record(name, seconds, nbytes=0):
+    '''
+    Records one call of stage name that took seconds.
+    '''
+    with lock:
+        entry = stages.get(name)
+        if entry is None:
+            entry = stages[name] = Stage(name)
+        entry.count += 1
+        entry.total += seconds
+        entry.bytes += nbytes
+        entry.samples.append(seconds)
+
+def count(name, n=1, nbytes=0):
+    '''
+    Adds n to the counter name, without timing anything.
+    '''
+    if not enabled:
+        return
+    with lock:
+        entry = stages.get(name)
+        if entry is None:
+            entry = stages[name] = Stage(name)
+        entry.count += n
+        entry.bytes += nbytes
+
+def collect():
+    '''
+    Returns the stages recorded so far in a form that can be sent between
+    processes (see merge) and resets them.
+    '''
+    with lock:
+        data = {name: (entry.count, entry.total, entry.bytes, entry.samples) for name, entry in stages.items()}
+        stages.clear()
+    return data
+
+def merge(data):
+    '''
+    Adds stages returned by collect(), from another process, to this one.
+    '''
+    with lock:
+        for name, (calls, total, nbytes, samples) in data.items():
+            entry = stages.get(name)
+            if entry is None:
+                entry = stages[name] = Stage(name)
+            entry.count += calls
+            entry.total += total
+            entry.bytes += nbytes
+            entry.samples.extend(samples)
+
+def summary():
+    '''
+    Returns {stage name: {'count', 'total', 'p50', 'p95', 'bytes'}}, times
+    are in seconds, p50 and p95 are None for counters.
+    '''
+    with lock:
+        return {name: entry.summary() for name, entry in sorted(stages.items())}
+
+def report():
+    '''
+    Returns the summary as a table, stages taking the most time first.
+    '''
+    def ms(seconds):
+        return "-" if seconds is None else f"{seconds * 1000:.3f}"
+
+    lines = [f"{'stage':<18} {'count':>10} {'total s':>10} {'p50 ms':>10} {'p95 ms':>10} {'bytes':>15} {'MB/s':>9}"]
+    for name, entry in sorted(summary().items(), key=lambda item: -item[1]['total']):
+        rate = f"{entry['bytes'] / entry['total'] / 1048576:.1f}" if entry['bytes'] and entry['total'] else "-"
+        lines.append(f"{name:<18} {entry['count']:>10,} {entry['total']:>10.3f} {ms(entry['p50']):>10} {ms(entry['p95']):>10} {entry['bytes']:>15,} {rate:>9}")
+    return "\n".join(lines)
+
+def write_json(path):
+    with open(path, "w") as f:
+        json.dump(summary(), f, indent=2)
+    logger.debug(f"Profile written to {path}")
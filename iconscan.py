@@ -0,0 +1,484 @@
+import hashlib
+import logging
+import os
+import concurrent.futures
+import multiprocessing
+from collections import deque
+
+import iconarchive
+import iconcache
+import iconprofile
+import icotool
+
+'''
+Icons Scan Engine
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Scans many files for icons in parallel. Each file is sniffed, parsed with
+icotool.IcoTool and (optionally) its icons are decoded to RGBA buffers in
+a pool of worker processes, so a folder scan uses every core instead of
+the GUI main loop.
+
+Results come back per file, in input order or as soon as they are ready,
+and report any error instead of hiding it.
+'''
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# Seconds between checks for cancellation while waiting on workers
+CANCEL_POLL = 0.1
+# Digests of the images a worker process decoded, see Dedup
+worker_seen = set()
+# Archive member bytes sent to a worker at a time, on top of batch_size
+BATCH_BYTES = 16 * 1024 * 1024
+
+class ScanResult:
+    '''
+    The icons found in one file:
+
+    filename: str, the file scanned
+    filetype: "ICO", "NE", "PE" or None if the file cannot hold icons
+    size: int, size of the file in bytes
+    icons: list of icon dicts as returned by IcoTool.extract_all, when
+           decoding each also has 'RGBA' (bytes) and 'RGBA_size' (width,
+           height) of its thumbnail. Icons that could not be decoded are
+           left out.
+    errors: list of str, icons that could not be decoded
+    error: str or None, why the file could not be scanned
+    mtime_ns: int, modification time of the file when it was scanned
+    cached: bool, the icons were loaded from a scan index
+    archive: str or None, the archive holding the file, filename is then
+             the archive path joined with member
+    member: str or None, path of the file in archive
+    filtered: dict or None, with an icotool.IconFilter the icons it
+              'kept' and 'skipped' in the file, the image bytes skipped
+              ('skipped_bytes') and the 'skipped_groups'
+    '''
+
+    def __init__(self, filename, filetype=None, size=0, icons=None, errors=None, error=None, mtime_ns=0, cached=False, archive=None, member=None, filtered=None):
+        self.filename = filename
+        self.filetype = filetype
+        self.size = size
+        self.icons = icons if icons is not None else []
+        self.errors = errors if errors is not None else []
+        self.error = error
+        self.mtime_ns = mtime_ns
+        self.cached = cached
+        self.archive = archive
+        self.member = member
+        self.filtered = filtered
+
+    def __repr__(self):
+        return f"ScanResult({self.filename!r}, filetype={self.filetype!r}, icons={len(self.icons)}, error={self.error!r})"
+
+def decode_icon(icon, size=iconcache.THUMBNAIL_SIZE, cache=None):
+    '''
+    Decodes the ICO file of icon to an RGBA buffer, returns (bytes, (width, height)).
+    Classic DIB images are decoded by icondecode, PNG images (and anything
+    it cannot handle) by Pillow. Images larger than size are scaled down to
+    fit it, unless size is None.
+
+    cache: optional iconcache.ThumbnailCache, scaled down images are looked
+           up and stored there by the digest of the image
+    '''
+    digest = None
+    if size and cache is not None and (icon['Width'] > size or icon['Height'] > size):
+        digest = icon.get('digest') or icon_digest(icon)
+        with iconprofile.stage("thumbnail_read"):
+            cached = cache.get(digest)
+        if cached is not None:
+            iconprofile.count("thumbnail_hit")
+            return cached
+
+    import icondecode
+    image = icotool.icon_image(icon)
+    with iconprofile.stage("decode_dib", len(image)):
+        decoded = icondecode.decode_dib(image)
+    if decoded is not None:
+        rgba, image_size = decoded
+        if not size or (image_size[0] <= size and image_size[1] <= size):
+            return decoded
+
+    import io
+    from PIL import Image
+    with iconprofile.stage("decode_pillow", len(image)):
+        if decoded is not None:
+            img = Image.frombuffer("RGBA", image_size, rgba, "raw", "RGBA", 0, 1)
+        else:
+            png = icotool.icon_png(icon)
+            img = Image.open(io.BytesIO(png if png is not None else icon['ICON']))
+        if size:
+            img.thumbnail((size, size))
+        if img.mode != "RGBA":
+            img = img.convert("RGBA")
+        thumbnail = img.tobytes(), img.size
+    if digest is not None:
+        with iconprofile.stage("thumbnail_write", len(thumbnail[0])):
+            cache.put(digest, *thumbnail)
+    return thumbnail
+
+def icon_digest(icon):
+    '''
+    Returns the hex digest of the image of icon, identical images have the
+    same digest whichever file they come from.
+    '''
+    image = icotool.icon_image(icon)
+    with iconprofile.stage("digest", len(image)):
+        return hashlib.blake2b(image, digest_size=16).hexdigest()
+
+def scan_file(filename, decode=True, best=False, seen=None, thumbnails=None, icon_filter=None):
+    '''
+    Scans a single file, returns a ScanResult. Never raises for a bad file.
+    With best only the best icon of each group is returned (see
+    IcoTool.iter_best). seen and thumbnails are passed to decode_result.
+    icon_filter is an optional icotool.IconFilter applied while parsing.
+    '''
+    try:
+        with iconprofile.stage("stat"):
+            stat = os.stat(filename)
+    except OSError as e:
+        return ScanResult(filename, error=f"{type(e).__name__}: {e}")
+
+    with iconprofile.stage("sniff"):
+        filetype = icotool.sniff_filetype(filename)
+    if not filetype:
+        iconprofile.count("not_icon_file", nbytes=stat.st_size)
+        return ScanResult(filename, size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+
+    result = ScanResult(filename, filetype, stat.st_size, mtime_ns=stat.st_mtime_ns)
+    return parse_result(result, lambda: icotool.IcoTool(filename, use_mmap=True), decode, best, seen, thumbnails, icon_filter)
+
+def scan_member(member, decode=True, best=False, seen=None, thumbnails=None, icon_filter=None):
+    '''
+    Scans an iconarchive.ArchiveMember like scan_file, from its data.
+    '''
+    result = ScanResult(member.filename, member.filetype, len(member.data), archive=member.archive, member=member.name)
+    return parse_result(result, lambda: icotool.IcoTool(member.filename, data=member.data), decode, best, seen, thumbnails, icon_filter)
+
+def parse_result(result, open_tool, decode=True, best=False, seen=None, thumbnails=None, icon_filter=None):
+    '''
+    Sets the icons of result to those of the IcoTool open_tool() returns.
+    '''
+    try:
+        with open_tool() as icons:
+            if best:
+                icon_data = icons.extract_best(metadata_only=True, icon_filter=icon_filter)
+            else:
+                icon_data = icons.extract_all(icon_filter)
+    except Exception as e:
+        result.error = f"{type(e).__name__}: {e}"
+        return result
+    finally:
+        if icon_filter is not None:
+            result.filtered = icon_filter.collect()
+            iconprofile.count("filter_skipped", result.filtered['skipped'], nbytes=result.filtered['skipped_bytes'])
+
+    return decode_result(result, icon_data, decode, seen, thumbnails)
+
+def decode_result(result, icon_data, decode=True, seen=None, thumbnails=None):
+    '''
+    Sets the icons of result to icon_data, decoding them if decode is set.
+
+    seen: optional set of image digests, each icon gets its 'digest' and
+          icons whose digest is in seen are not decoded (see Dedup)
+    thumbnails: optional iconcache.ThumbnailCache, icons are decoded to its
+                size and large ones are cached there. Without it they are
+                decoded to iconcache.THUMBNAIL_SIZE.
+    '''
+    if not decode:
+        result.icons = icon_data
+        return result
+
+    size = iconcache.THUMBNAIL_SIZE if thumbnails is None else thumbnails.size
+    for icon in icon_data:
+        if seen is not None:
+            icon['digest'] = icon_digest(icon)
+            if icon['digest'] in seen:
+                result.icons.append(icon)
+                continue
+            seen.add(icon['digest'])
+        try:
+            icon['RGBA'], icon['RGBA_size'] = decode_icon(icon, size, thumbnails)
+        except Exception as e:
+            result.errors.append(f"{icon['filename']}: {type(e).__name__}: {e}")
+            continue
+        result.icons.append(icon)
+    return result
+
+def scan_item(item, decode=True, best=False, seen=None, thumbnails=None, icon_filter=None):
+    '''
+    Scans a file name or an iconarchive.ArchiveMember, or finishes a
+    ScanResult whose icons were loaded from a scan index.
+    '''
+    if isinstance(item, ScanResult):
+        icon_data, item.icons = item.icons, []
+        return decode_result(item, icon_data, decode, seen, thumbnails)
+    if isinstance(item, iconarchive.ArchiveMember):
+        return scan_member(item, decode, best, seen, thumbnails, icon_filter)
+    return scan_file(item, decode, best, seen, thumbnails, icon_filter)
+
+def scan_batch(items, decode=True, best=False, dedup=False, thumbnails=None, profile=False, icon_filter=None):
+    # Runs in a worker process, which is only used for one scan. Returns
+    # the results and, when profiling, the stages the worker recorded.
+    seen = worker_seen if dedup else None
+    if profile:
+        iconprofile.enable()
+    results = [scan_item(item, decode, best, seen, thumbnails, icon_filter) for item in items]
+    return results, iconprofile.collect() if profile else None
+
+def add_filtered(totals, result):
+    '''
+    Adds the filter counters of result to the totals dict, returns it.
+    '''
+    if result.filtered:
+        for key, value in result.filtered.items():
+            totals[key] = totals.get(key, 0) + value
+    return totals
+
+class Dedup:
+    '''
+    Collapses icons whose image is identical (same digest) into the first
+    one found, across every file of a scan.
+
+    Worker processes already skip decoding the images they decoded before
+    (see decode_result), icons left undecoded that turn out to be the first
+    of their image are decoded here.
+    '''
+
+    def __init__(self):
+        self.first = {}
+        self.origins = {}
+        self.unique = 0
+        self.duplicates = 0
+        self.saved = 0
+
+    def check(self, result, icon):
+        '''
+        Returns the first icon with the same image as icon if there is one,
+        recording that icon of result is also found there. Otherwise
+        icon becomes the first of its image and None is returned.
+        '''
+        digest = icon.get('digest')
+        if digest is None:
+            digest = icon['digest'] = icon_digest(icon)
+        first = self.first.get(digest)
+        if first is None:
+            self.first[digest] = icon
+            self.origins[digest] = [(result.filename, icon['filename'])]
+            self.unique += 1
+            return None
+        self.origins[digest].append((result.filename, icon['filename']))
+        self.duplicates += 1
+        self.saved += len(icotool.icon_image(icon))
+        return first
+
+    def filter(self, results, decode=True, thumbnails=None):
+        '''
+        Yields results keeping only the first icon of each image.
+        '''
+        try:
+            for result in results:
+                icons, result.icons = result.icons, []
+                for icon in icons:
+                    if self.check(result, icon) is not None:
+                        continue
+                    if decode and 'RGBA' not in icon:
+                        # Adds icon to result once decoded
+                        decode_result(result, [icon], decode, thumbnails=thumbnails)
+                    else:
+                        result.icons.append(icon)
+                yield result
+        finally:
+            results.close()
+
+    def stats(self):
+        return {'unique': self.unique, 'duplicates': self.duplicates, 'saved': self.saved}
+
+class Scanner:
+    '''
+    Scans files for icons using a pool of worker processes.
+
+    workers: number of worker processes, defaults to the number of CPUs.
+             0 or 1 scans in the calling process.
+    ordered: yield results in the order of the files given, otherwise as
+             soon as they are ready
+    decode: decode every icon to an RGBA thumbnail in the workers
+    batch_size: number of files sent to a worker at a time
+    index: optional iconindex.ScanIndex, unchanged files are loaded from
+           it instead of being parsed and new results are stored in it.
+           It is only used from the thread calling scan().
+    best: only return the best icon of each group. The index, which
+          holds every icon of a file, is not used.
+    dedup: only return the first icon of each distinct image, duplicates
+           are not decoded. self.dedup holds the Dedup of the last scan,
+           with where each image was found and how much was skipped.
+    thumbnails: optional iconcache.ThumbnailCache used when decoding, see
+                decode_result
+    archives: scan the members of zip and tar archives (see iconarchive)
+              instead of skipping them. Members are read in the calling
+              thread and parsed by the workers, each gets its own
+              ScanResult tagged with the archive and member path.
+    icon_filter: optional icotool.IconFilter, only the icons it accepts are
+                 parsed and decoded. As with best, the index is not used.
+                 Each ScanResult has the counters of the filter for its
+                 file (filtered), summed by add_filtered.
+    '''
+
+    def __init__(self, workers=None, ordered=True, decode=True, batch_size=16, index=None, best=False, dedup=False, thumbnails=None, archives=False, icon_filter=None):
+        self.workers = (os.cpu_count() or 1) if workers is None else workers
+        self.ordered = ordered
+        self.decode = decode
+        self.batch_size = batch_size
+        self.index = None if best or icon_filter is not None else index
+        self.icon_filter = icon_filter
+        self.best = best
+        self.dedup = Dedup() if dedup else None
+        self.thumbnails = thumbnails
+        self.archives = archives
+
+    def items(self, filenames):
+        '''
+        Yields the file names to scan, replacing files found unchanged in
+        the index with a ScanResult holding their indexed icons, and
+        archives with their members.
+        '''
+        for filename in filenames:
+            filename = str(filename)
+            if self.archives and iconarchive.archive_type(filename):
+                yield from self.archive_members(filename)
+                continue
+            if self.index is not None:
+                try:
+                    stat = os.stat(filename)
+                    with iconprofile.stage("index_lookup"):
+                        cached = self.index.lookup(filename, stat)
+                except OSError:
+                    cached = None
+                if cached is not None:
+                    filetype, icons = cached
+                    yield ScanResult(filename, filetype, stat.st_size, icons, mtime_ns=stat.st_mtime_ns, cached=True)
+                    continue
+            yield filename
+
+    def archive_members(self, filename):
+        '''
+        Yields the iconarchive.ArchiveMembers of an archive, or a ScanResult
+        with the error if it cannot be read.
+        '''
+        try:
+            yield from iconarchive.iter_members(filename)
+        except Exception as e:
+            logger.debug(f"Unable to read archive {filename}: {e}")
+            yield ScanResult(filename, error=f"{type(e).__name__}: {e}")
+
+    def record(self, results):
+        '''
+        Stores new results in the index as they are yielded.
+        '''
+        try:
+            for result in results:
+                if self.index is not None and not result.cached and not result.error and not result.archive and result.filename:
+                    with iconprofile.stage("index_store"):
+                        self.index.store(result.filename, result.size, result.mtime_ns, result.filetype, result.icons)
+                yield result
+        finally:
+            results.close()
+
+    def batches(self, filenames):
+        batch = []
+        size = 0
+        for item in self.items(filenames):
+            batch.append(item)
+            if isinstance(item, iconarchive.ArchiveMember):
+                size += len(item.data)
+            if len(batch) >= self.batch_size or size >= BATCH_BYTES:
+                yield batch
+                batch = []
+                size = 0
+        if batch:
+            yield batch
+
+    def scan(self, filenames, cancel=None):
+        '''
+        Scans filenames (any iterable, consumed lazily) and yields a
+        ScanResult for each file.
+
+        cancel: optional threading.Event, once it is set the scan stops
+                promptly and batches not yet started are dropped
+        '''
+        results = self.record(self.scan_items(filenames, cancel))
+        if self.dedup is not None:
+            self.dedup = Dedup()
+            results = self.dedup.filter(results, self.decode, self.thumbnails)
+        return results
+
+    def scan_items(self, filenames, cancel=None):
+        if self.workers <= 1:
+            seen = set() if self.dedup is not None else None
+            for item in self.items(filenames):
+                if cancel is not None and cancel.is_set():
+                    return
+                yield scan_item(item, self.decode, self.best, seen, self.thumbnails, self.icon_filter)
+            return
+
+        logger.debug(f"Scanning with {self.workers} workers")
+        # forkserver avoids forking a process that may be running GTK threads
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("forkserver")
+        else:
+            context = None
+        # Bound the batches in flight so results and input are consumed
+        # at the pace of the caller
+        max_pending = self.workers * 2
+        executor = concurrent.futures.ProcessPoolExecutor(self.workers, mp_context=context)
+        pending = deque()
+        try:
+            for batch in self.batches(filenames):
+                if cancel is not None and cancel.is_set():
+                    return
+                pending.append((executor.submit(scan_batch, batch, self.decode, self.best, self.dedup is not None, self.thumbnails, iconprofile.enabled, self.icon_filter), batch))
+                while len(pending) >= max_pending:
+                    if cancel is not None and cancel.is_set():
+                        return
+                    yield from self.completed(pending, timeout=CANCEL_POLL)
+                yield from self.completed(pending, timeout=0)
+            while pending:
+                if cancel is not None and cancel.is_set():
+                    return
+                yield from self.completed(pending, timeout=CANCEL_POLL)
+        finally:
+            if pending:
+                logger.debug(f"Scan stopped, dropping {len(pending)} batches")
+            # Do not wait for batches still running when the scan is stopped
+            executor.shutdown(wait=not pending, cancel_futures=True)
+
+    def completed(self, pending, timeout):
+        '''
+        Yields the results of finished batches in pending, waiting at most
+        timeout seconds for one. In ordered mode only the oldest batches are
+        returned.
+        '''
+        if self.ordered:
+            if timeout:
+                concurrent.futures.wait([pending[0][0]], timeout=timeout)
+            while pending and pending[0][0].done():
+                yield from self.batch_results(*pending.popleft())
+        else:
+            if timeout:
+                concurrent.futures.wait([future for future, batch in pending], timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+            for item in [item for item in pending if item[0].done()]:
+                pending.remove(item)
+                yield from self.batch_results(*item)
+
+    def batch_results(self, future, batch):
+        try:
+            results, stages = future.result()
+        except Exception as e:
+            # The worker itself failed (for example it was killed)
+            logger.debug(f"Worker failed: {e}")
+            # Items are file names, ScanResults or ArchiveMembers
+            return [ScanResult(getattr(item, 'filename', item), error=f"{type(e).__name__}: {e}") for item in batch]
+        if stages:
+            iconprofile.merge(stages)
+        return results
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import logging
+import sys
+import time
+from pathlib import Path
+
+import iconexport
+import iconprofile
+import iconscan
+import iconwalk
+import iconwatch
+import icotool
+
+'''
+Icons Extractor command line
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Extracts icons from Windows ICO, ICL, DLL and EXE files without a display.
+Icons are written as PNG or ICO files, to a folder or streamed into a zip
+or tar archive, along with a manifest (one JSON object per line)
+describing each icon written.
+
+Only the icotool and iconscan modules are loaded, GTK is never imported
+and Pillow is only imported when icons need to be decoded for PNG output.
+'''
+
+clilog = logging.getLogger('iconscli')
+
+def icon_filter(args):
+    '''
+    Returns the icotool.IconFilter of the size, color, format and group
+    options, applied while parsing, or None if they keep every icon.
+    '''
+    formats = [args.image_format] if args.image_format else None
+    icon_filter = icotool.IconFilter(min_width=args.min_size, max_width=args.max_size, min_bits=args.min_bits, max_bits=args.max_bits, min_colors=args.min_colors, formats=formats, groups=args.group)
+    return icon_filter if icon_filter.active else None
+
+def to_png(icon):
+    '''
+    Returns icon as a PNG file, PNG compressed icons are returned as stored.
+    '''
+    png = icotool.icon_png(icon)
+    if png is not None:
+        return png
+    import io
+    from PIL import Image
+    img = Image.open(io.BytesIO(icon['ICON']))
+    output = io.BytesIO()
+    img.save(output, "png")
+    return output.getvalue()
+
+def named_icons(result, names):
+    '''
+    Yields (name, icon) for the icons of result, name is the file name
+    (without extension) names, an iconexport.UniqueNames, gives the icon.
+    '''
+    seen = {}
+    for icon in result.icons:
+        name = icon['filename'][:icon['filename'].rfind(".")]
+        # Icons of the same size in one group have the same name too
+        seen[name] = seen.get(name, 0) + 1
+        yield names.name((result.filename, name, seen[name]), name), icon
+
+def write_icon(icon, path, output_format, overwrite, existing):
+    '''
+    Writes icon to path, returns the path written or None if the file was
+    in the output folder before the run started (its name is in existing)
+    and overwrite is False.
+    '''
+    if path.name in existing and not overwrite:
+        clilog.debug(f"Skipping {path} file already exists")
+        return None
+    data = icon['ICON'] if output_format == "ico" else to_png(icon)
+    with open(path, "wb") as f:
+        f.write(data)
+    return path
+
+def icon_meta(icon, result):
+    '''
+    Returns the manifest fields of icon, found in result.
+    '''
+    source = {'source': result.filename}
+    if result.archive:
+        source = {'source': result.archive, 'member': result.member}
+    return {
+        **source,
+        'filetype': result.filetype,
+        'index': icon.get('index'),
+        'ID': icon['ID'],
+        'Width': icon['Width'],
+        'Height': icon['Height'],
+        'Colors': icon['Colors'],
+        'BitCount': icon['rtIconDirEntry']['wBitCount'],
+    }
+
+def filter_summary(filtered):
+    if not filtered:
+        return ""
+    return f", {filtered['skipped']} filtered out ({filtered['skipped_bytes']:,} bytes not read, {filtered['skipped_groups']} groups skipped)"
+
+def dedup_summary(dedup):
+    if dedup is None:
+        return ""
+    return f", {dedup.duplicates} duplicates not written ({dedup.saved:,} bytes)"
+
+def archive_items(results, args, counts, archive, dedup=None):
+    '''
+    Yields an iconexport.ExportItem for each icon in results,
+    counting files, icons and errors in counts. With dedup, icons whose
+    image was already yielded are only added to the manifest of archive.
+    '''
+    names = iconexport.UniqueNames()
+    # Name each image was added as when deduplicating
+    written_names = {}
+    for result in results:
+        counts['files'] += 1
+        iconscan.add_filtered(counts['filtered'], result)
+        if result.error:
+            counts['errors'] += 1
+            clilog.warning(f"Unable to open {result.filename}: {result.error}")
+            continue
+        for name, icon in named_icons(result, names):
+            counts['icons'] += 1
+            if dedup is not None:
+                first = dedup.check(result, icon)
+                if first is not None:
+                    archive.add_manifest({'path': f"{written_names[icon['digest']]}.{args.format}", **icon_meta(icon, result), 'duplicate': True})
+                    continue
+                written_names[icon['digest']] = name
+            yield iconexport.ExportItem(name, png=icotool.icon_png(icon), ico=icon['ICON'], meta=icon_meta(icon, result))
+
+def export_archive(args, scanner, walker, start):
+    counts = {'files': 0, 'icons': 0, 'errors': 0, 'filtered': {}}
+    levels = {'png': args.png_level, 'ico': args.ico_level}
+    dedup = iconscan.Dedup() if args.dedup else None
+    with iconexport.ArchiveExporter(args.archive, args.format, levels=levels, manifest=args.manifest or "manifest.jsonl", workers=args.jobs) as archive:
+        summary = archive.export(archive_items(scanner.scan(walker.walk(args.paths)), args, counts, archive, dedup))
+    for name, error in summary['failed']:
+        clilog.warning(f"Unable to write {name}: {error}")
+
+    elapsed = time.perf_counter() - start
+    errors = counts['errors'] + len(summary['failed'])
+    print(f"{counts['files']} Files, {counts['icons']} Icons, {summary['written']} written to {args.archive} ({summary['bytes']:,} bytes){filter_summary(counts['filtered'])}{dedup_summary(dedup)}, {errors} errors in {elapsed:.2f}s")
+    return 0
+
+def main(argv=None):
+    start = time.perf_counter()
+    desc = 'Icons Extractor command line: extract icons from Windows ICO, ICL, DLL and EXE files.'
+    arg_parser = argparse.ArgumentParser(description=desc)
+    arg_parser.add_argument('-d', '--debug', help="Print debugging statements", action="store_const", dest="loglevel", const=logging.DEBUG, default=logging.WARNING)
+    arg_parser.add_argument("paths", help="Windows files or folders to extract icons from", nargs="+")
+    arg_parser.add_argument("-o", "--output", help="Folder to write icons to (default: current folder)", default=".")
+    arg_parser.add_argument("-a", "--archive", help="Write the icons and manifest into this zip or tar archive (.zip, .tar, .tar.gz, .tgz, .tar.bz2 or .tar.xz) instead of a folder", default=None)
+    arg_parser.add_argument("--png-level", help="Compression level (0-9) of PNG files in zip archives, they are already compressed (default: %(default)s, stored)", type=int, choices=range(10), default=iconexport.DEFAULT_LEVELS['png'], metavar="LEVEL")
+    arg_parser.add_argument("--ico-level", help="Compression level (0-9) of ICO files in zip archives (default: %(default)s)", type=int, choices=range(10), default=iconexport.DEFAULT_LEVELS['ico'], metavar="LEVEL")
+    arg_parser.add_argument("-r", "--recursive", help="Search subfolders of folders", default=False, action="store_true")
+    arg_parser.add_argument("--max-depth", help="Levels of subfolders searched with --recursive (default: no limit)", type=int, default=None)
+    arg_parser.add_argument("--ignore", help="Skip files and folders matching this glob pattern, patterns with a / match paths relative to the folder searched (can be repeated)", action="append", default=[], metavar="PATTERN")
+    arg_parser.add_argument("--ignore-ext", help="Skip files with this extension (can be repeated)", action="append", default=[], metavar="EXT")
+    arg_parser.add_argument("--max-file-size", help="Skip files larger than this many MB", type=float, default=0, metavar="MB")
+    arg_parser.add_argument("--follow-symlinks", help="Follow symlinks to files and folders", default=False, action="store_true")
+    arg_parser.add_argument("--cross-devices", help="Search folders on other filesystems", default=False, action="store_true")
+    arg_parser.add_argument("-z", "--scan-archives", help="Search the files inside zip and tar archives (.zip, .tar, .tar.gz, .tgz, .tar.bz2, .tar.xz) without unpacking them", default=False, action="store_true")
+    arg_parser.add_argument("-f", "--format", help="Output format (default: %(default)s)", choices=["png", "ico"], default="png")
+    arg_parser.add_argument("--min-size", help="Only extract icons at least this wide", type=int, default=0)
+    arg_parser.add_argument("--max-size", help="Only extract icons at most this wide", type=int, default=0)
+    arg_parser.add_argument("--min-colors", help="Only extract icons with at least this many colors (256 for 8 bits and above)", type=int, default=0)
+    arg_parser.add_argument("--min-bits", help="Only extract icons with at least this many bits per pixel", type=int, default=0)
+    arg_parser.add_argument("--max-bits", help="Only extract icons with at most this many bits per pixel", type=int, default=0)
+    arg_parser.add_argument("--image-format", help="Only extract icons whose image is stored as PNG or as a bitmap (DIB)", choices=["png", "dib"], default=None)
+    arg_parser.add_argument("--group", help="Only extract the group icons whose id, index or name matches this glob pattern (can be repeated)", action="append", default=None, metavar="PATTERN")
+    arg_parser.add_argument("-b", "--best", help="Only extract the best icon (most bits per pixel, then largest) of each group", default=False, action="store_true")
+    arg_parser.add_argument("-m", "--manifest", help="Manifest file (default: OUTPUT/manifest.jsonl, manifest.jsonl in archives)", default=None)
+    arg_parser.add_argument("-u", "--dedup", help="Write identical icon images once, later copies are only listed in the manifest", default=False, action="store_true")
+    arg_parser.add_argument("--overwrite", help="Overwrite existing icon files", default=False, action="store_true")
+    arg_parser.add_argument("-w", "--watch", help="Keep running and extract the icons of files added or changed, files are watched with inotify on Linux and polled elsewhere", default=False, action="store_true")
+    arg_parser.add_argument("-j", "--jobs", help="Number of worker processes used to parse files (default: number of CPUs)", type=int, default=None)
+    arg_parser.add_argument("--profile", help="Print the time spent in each stage (walk, read, parse, decode, write...) when done", default=False, action="store_true")
+    arg_parser.add_argument("--profile-json", help="Write the time spent in each stage to this JSON file", default=None, metavar="FILE")
+    arg_parser.add_argument("--cprofile", help="Write a cProfile dump of the main process to this file", default=None, metavar="FILE")
+    args = arg_parser.parse_args(argv)
+
+    logging.basicConfig(level=args.loglevel, format="%(levelname)s: %(message)s")
+    clilog.debug(f"Started in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    if args.profile or args.profile_json:
+        iconprofile.enable()
+    profiler = None
+    if args.cprofile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        return extract(args, arg_parser, start)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.cprofile)
+        if args.profile:
+            print(iconprofile.report(), file=sys.stderr)
+        if args.profile_json:
+            iconprofile.write_json(args.profile_json)
+
+def extract(args, arg_parser, start):
+    scanner = iconscan.Scanner(workers=args.jobs, decode=False, best=args.best, archives=args.scan_archives, icon_filter=icon_filter(args))
+    walker = iconwalk.Walker(
+        ignore=args.ignore,
+        ignore_extensions=args.ignore_ext,
+        max_size=int(args.max_file_size * 1024 * 1024),
+        max_depth=args.max_depth if args.recursive else 0,
+        follow_symlinks=args.follow_symlinks,
+        cross_devices=args.cross_devices)
+    if args.archive:
+        if args.watch:
+            arg_parser.error("--watch writes icons to a folder, not to an archive")
+        if iconexport.archive_mode(args.archive) is None:
+            arg_parser.error(f"unknown archive type: {args.archive}")
+        return export_archive(args, scanner, walker, start)
+
+    output_folder = Path(args.output)
+    output_folder.mkdir(parents=True, exist_ok=True)
+    manifest_path = Path(args.manifest) if args.manifest else output_folder / "manifest.jsonl"
+
+    counts = {'files': 0, 'icons': 0, 'written': 0, 'skipped': 0, 'errors': 0, 'filtered': {}}
+    dedup = iconscan.Dedup() if args.dedup else None
+    # Path each image was written to when deduplicating
+    written_paths = {}
+    names = iconexport.UniqueNames()
+    # Only files there before the run are skipped, icons of the run never
+    # replace each other (see named_icons)
+    existing = {path.name for path in output_folder.iterdir()}
+    watcher = iconwatch.Watcher(args.paths, walker) if args.watch else None
+    with open(manifest_path, "w") as manifest:
+        files = watcher.start() if watcher is not None else walker.walk(args.paths)
+        write_results(scanner.scan(files), args, output_folder, manifest, counts, dedup, written_paths, names, existing, args.overwrite)
+        elapsed = time.perf_counter() - start
+        print(f"{counts['files']} Files, {counts['icons']} Icons, {counts['written']} written, {counts['skipped']} skipped (already exist){filter_summary(counts['filtered'])}{dedup_summary(dedup)}, {counts['errors']} errors in {elapsed:.2f}s")
+        if watcher is not None:
+            watch(args, scanner, watcher, output_folder, manifest, dedup, written_paths, names, existing)
+    return 0
+
+def write_results(results, args, output_folder, manifest, counts, dedup, written_paths, names, existing, overwrite):
+    '''
+    Writes the icons of results to output_folder and the manifest,
+    counting files, icons, written, skipped and errors in counts. names
+    (an iconexport.UniqueNames) names the files, those in existing are
+    only replaced with overwrite.
+    '''
+    for result in results:
+        counts['files'] += 1
+        iconscan.add_filtered(counts['filtered'], result)
+        if result.error:
+            counts['errors'] += 1
+            clilog.warning(f"Unable to open {result.filename}: {result.error}")
+            continue
+        for name, icon in named_icons(result, names):
+            counts['icons'] += 1
+            path = output_folder / f"{name}.{args.format}"
+            if dedup is not None:
+                first = dedup.check(result, icon)
+                if first is not None:
+                    # path is None when the first copy could not be written
+                    manifest.write(json.dumps({'path': written_paths.get(icon['digest']), **icon_meta(icon, result), 'bytes': len(icon['ICON']), 'duplicate': True}) + "\n")
+                    continue
+            try:
+                with iconprofile.stage("export_write"):
+                    written = write_icon(icon, path, args.format, overwrite, existing)
+            except Exception as e:
+                counts['errors'] += 1
+                clilog.warning(f"Unable to write {icon['filename']}: {type(e).__name__}: {e}")
+                continue
+            if written is None:
+                counts['skipped'] += 1
+                if dedup is not None:
+                    # Copies are listed with the file already there
+                    written_paths[icon['digest']] = str(path)
+                continue
+            counts['written'] += 1
+            if dedup is not None:
+                written_paths[icon['digest']] = str(path)
+            manifest.write(json.dumps({'path': str(path), **icon_meta(icon, result), 'bytes': len(icon['ICON'])}) + "\n")
+
+def watch(args, scanner, watcher, output_folder, manifest, dedup, written_paths, names, existing):
+    '''
+    Writes the icons of files added or changed under args.paths until
+    interrupted. Icons of changed files are overwritten, removed files are
+    recorded in the manifest, their icons are left in place.
+    '''
+    print(f"Watching {', '.join(args.paths)} for changes, press Ctrl+C to stop")
+    try:
+        for changes in watcher.changes():
+            start = time.perf_counter()
+            for filename in changes.removed:
+                manifest.write(json.dumps({'source': filename, 'removed': True}) + "\n")
+            counts = {'files': 0, 'icons': 0, 'written': 0, 'skipped': 0, 'errors': 0, 'filtered': {}}
+            write_results(scanner.scan(changes.changed), args, output_folder, manifest, counts, dedup, written_paths, names, existing, True)
+            manifest.flush()
+            print(f"{len(changes.changed)} Files changed, {len(changes.removed)} removed: {counts['icons']} Icons, {counts['written']} written, {counts['errors']} errors in {time.perf_counter() - start:.2f}s")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+
+import argparse
+import concurrent.futures
+import hashlib
+import http
+import io
+import json
+import logging
+import multiprocessing
+import os
+import stat
+import sys
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import iconcache
+import iconprofile
+import iconscan
+import icotool
+
+'''
+Icons HTTP Service
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Serves the icons of the Windows files under a folder over HTTP, so other
+tools can fetch them without running an extractor of their own:
+
+    GET /icons/<path>                   the icons of a file, as JSON
+    GET /icon/<path>?n=N&format=png&size=S
+                                        icon N of a file (or n=best) as a
+                                        PNG or ICO file, scaled to S pixels
+    GET /stats                          cache and parsing counters
+
+Paths are relative to the folder served and cannot leave it. Files are
+parsed by a pool of worker processes, their icon tables and the images
+encoded from them are kept in a memory bounded LRU keyed by the file
+fingerprint (device, inode, size and modification time), so a changed
+file is parsed again and nothing stale is served. Every response has an
+ETag derived from that fingerprint, If-None-Match is compared with it
+before the file is parsed or anything is encoded: a 304 costs resolving
+the path (os.path.realpath) and a single stat.
+'''
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+DEFAULT_PORT = 8000
+# Memory budget of the icon tables and encoded images
+DEFAULT_CACHE_SIZE = 128 * 1024 * 1024
+# Largest size an icon can be scaled to
+MAX_ICON_SIZE = 1024
+FORMATS = {'png': 'image/png', 'ico': 'image/x-icon'}
+
+class RequestError(Exception):
+    '''
+    A request that cannot be served, status is an http.HTTPStatus.
+    '''
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+class IconService:
+    '''
+    The icons of the files under root.
+
+    workers: number of worker processes parsing files, defaults to the
+             number of CPUs. 0 parses in the thread serving the request.
+    cache_size: bytes of icon tables and encoded images kept in memory
+
+    Requests for a file being parsed wait for that parse instead of
+    starting another one. self.stats counts cache 'hits' and 'misses',
+    files 'parsed' and 'not_modified' responses.
+    '''
+
+    def __init__(self, root, workers=None, cache_size=DEFAULT_CACHE_SIZE):
+        self.root = os.path.realpath(root)
+        self.workers = (os.cpu_count() or 1) if workers is None else workers
+        self.cache = iconcache.LRUCache(cache_size)
+        self.lock = threading.Lock()
+        # Parses running, by fingerprint
+        self.parsing = {}
+        self.stats = {'hits': 0, 'misses': 0, 'parsed': 0, 'not_modified': 0}
+        self.executor = None
+        if self.workers > 0:
+            # forkserver, as in iconscan: the server runs threads
+            context = multiprocessing.get_context("forkserver") if "forkserver" in multiprocessing.get_all_start_methods() else None
+            self.executor = concurrent.futures.ProcessPoolExecutor(self.workers, mp_context=context)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    def resolve(self, path):
+        '''
+        Returns the absolute path of path, relative to root, and its
+        fingerprint.
+        '''
+        filename = os.path.realpath(os.path.join(self.root, path.lstrip("/")))
+        if os.path.commonpath([self.root, filename]) != self.root:
+            raise RequestError(http.HTTPStatus.FORBIDDEN, f"{path} is outside the folder served")
+        try:
+            st = os.stat(filename)
+        except OSError:
+            raise RequestError(http.HTTPStatus.NOT_FOUND, f"{path} not found")
+        if not stat.S_ISREG(st.st_mode):
+            raise RequestError(http.HTTPStatus.NOT_FOUND, f"{path} is not a file")
+        return filename, (filename, st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def cached(self, key, create):
+        '''
+        Returns the cached value of key, or (value, nbytes) = create().
+        '''
+        with self.lock:
+            value = self.cache.get(key)
+            if value is not None:
+                self.stats['hits'] += 1
+                return value
+            self.stats['misses'] += 1
+        value, nbytes = create()
+        with self.lock:
+            self.cache.put(key, value, nbytes)
+        return value
+
+    def icons(self, filename, fingerprint):
+        '''
+        Returns the icons (IconRecords) of filename, parsed once per
+        fingerprint.
+        '''
+        return self.cached(('icons', fingerprint), lambda: self.parse(filename, fingerprint))
+
+    def parse(self, filename, fingerprint):
+        with self.lock:
+            future = self.parsing.get(fingerprint)
+            first = future is None
+            if first:
+                if self.executor is not None:
+                    future = self.executor.submit(iconscan.scan_file, filename, False)
+                else:
+                    future = concurrent.futures.Future()
+                self.parsing[fingerprint] = future
+                self.stats['parsed'] += 1
+        if first and self.executor is None:
+            future.set_result(iconscan.scan_file(filename, decode=False))
+        try:
+            with iconprofile.stage("server_parse"):
+                result = future.result()
+        finally:
+            with self.lock:
+                self.parsing.pop(fingerprint, None)
+        if result.error:
+            raise RequestError(http.HTTPStatus.UNPROCESSABLE_ENTITY, result.error)
+        if not result.filetype:
+            raise RequestError(http.HTTPStatus.UNPROCESSABLE_ENTITY, "File type not ICO, ICL, EXE, or DLL")
+        nbytes = sum(len(icotool.icon_image(icon)) for icon in result.icons)
+        return (result.filetype, result.icons), nbytes
+
+    def not_modified(self, tag, if_none_match):
+        '''
+        Returns True when the If-None-Match header value if_none_match
+        holds tag, the client copy is current.
+        '''
+        if not if_none_match or tag not in [value.strip() for value in if_none_match.split(",")]:
+            return False
+        with self.lock:
+            self.stats['not_modified'] += 1
+        return True
+
+    def listing(self, path, if_none_match=None):
+        '''
+        Returns (etag, JSON bytes) listing the icons of path. The bytes
+        are None, and nothing is parsed, when the If-None-Match header
+        value if_none_match holds the etag.
+        '''
+        filename, fingerprint = self.resolve(path)
+        # The path is part of the listing
+        tag = etag((fingerprint, path))
+        if self.not_modified(tag, if_none_match):
+            return tag, None
+
+        def create():
+            filetype, icons = self.icons(filename, fingerprint)
+            data = json.dumps({
+                'path': path,
+                'filetype': filetype,
+                'icons': [{
+                    'n': n,
+                    'index': icon.get('index'),
+                    'ID': icon['ID'],
+                    'Width': icon['Width'],
+                    'Height': icon['Height'],
+                    'Colors': icon['Colors'],
+                    'BitCount': icon['rtIconDirEntry']['wBitCount'],
+                    'format': "png" if bytes(icotool.icon_image(icon)[:8]) == icotool.PNG_SIGNATURE else "dib",
+                    'bytes': len(icotool.icon_image(icon)),
+                } for n, icon in enumerate(icons)],
+            }).encode()
+            return data, len(data)
+
+        return tag, self.cached(('listing', fingerprint, path), create)
+
+    def icon(self, path, n, image_format="png", size=None, if_none_match=None):
+        '''
+        Returns (etag, content type, bytes) of icon n (or "best") of path
+        as a PNG or ICO file, scaled to fit size x size pixels if given.
+        The bytes are None, as for listing(), when if_none_match holds
+        the etag.
+        '''
+        if image_format not in FORMATS:
+            raise RequestError(http.HTTPStatus.BAD_REQUEST, f"Unknown format {image_format}, choose from {', '.join(FORMATS)}")
+        if size is not None and not 0 < size <= MAX_ICON_SIZE:
+            raise RequestError(http.HTTPStatus.BAD_REQUEST, f"size must be between 1 and {MAX_ICON_SIZE}")
+        if image_format == "ico" and size is not None and size > 256:
+            raise RequestError(http.HTTPStatus.BAD_REQUEST, "ICO files cannot hold icons larger than 256")
+        filename, fingerprint = self.resolve(path)
+        key = (fingerprint, n, image_format, size)
+        tag = etag(key)
+        if self.not_modified(tag, if_none_match):
+            return tag, FORMATS[image_format], None
+
+        def create():
+            filetype, icons = self.icons(filename, fingerprint)
+            if not icons:
+                raise RequestError(http.HTTPStatus.NOT_FOUND, f"No icons in {path}")
+            if n == "best":
+                icon = max(icons, key=icotool.rank_icon)
+            elif 0 <= n < len(icons):
+                icon = icons[n]
+            else:
+                raise RequestError(http.HTTPStatus.NOT_FOUND, f"No icon {n} in {path}, it has {len(icons)}")
+            with iconprofile.stage("server_encode") as timer:
+                data = encode_icon(icon, image_format, size)
+                timer.nbytes = len(data)
+            return data, len(data)
+
+        return tag, FORMATS[image_format], self.cached(('icon',) + key, create)
+
+def etag(key):
+    return '"' + hashlib.blake2b(repr(key).encode(), digest_size=16).hexdigest() + '"'
+
+def encode_icon(icon, image_format, size=None):
+    '''
+    Returns icon as a PNG or ICO file. Stored images are returned as they
+    are when no size is asked or it is their size, others are decoded and
+    scaled to fit size x size.
+    '''
+    width, height = icon['Width'], icon['Height']
+    if size is None or (width == size and height == size):
+        if image_format == "ico":
+            return icon['ICON']
+        png = icotool.icon_png(icon)
+        if png is not None:
+            return png
+
+    from PIL import Image
+    rgba, image_size = iconscan.decode_icon(icon, size=None)
+    img = Image.frombuffer("RGBA", image_size, rgba, "raw", "RGBA", 0, 1)
+    if size is not None and img.size != (size, size):
+        scale = size / max(img.size)
+        img = img.resize((max(round(img.width * scale), 1), max(round(img.height * scale), 1)), Image.LANCZOS)
+    output = io.BytesIO()
+    if image_format == "ico":
+        img.save(output, "ico", sizes=[img.size])
+    else:
+        img.save(output, "png")
+    return output.getvalue()
+
+class IconRequestHandler(BaseHTTPRequestHandler):
+
+    server_version = "IconsExtractor"
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        route, _, path = urllib.parse.unquote(url.path).lstrip("/").partition("/")
+        service = self.server.service
+        try:
+            if route == "icons" and path:
+                tag, data = service.listing(path, self.headers.get('If-None-Match'))
+                self.send(data, "application/json", tag)
+            elif route == "icon" and path:
+                n = query.get('n', ["best"])[0]
+                size = query.get('size', [None])[0]
+                try:
+                    n = n if n == "best" else int(n)
+                    size = None if size is None else int(size)
+                except ValueError:
+                    raise RequestError(http.HTTPStatus.BAD_REQUEST, "n and size must be numbers")
+                tag, content_type, data = service.icon(path, n, query.get('format', ["png"])[0], size, self.headers.get('If-None-Match'))
+                self.send(data, content_type, tag)
+            elif route == "stats" and not path:
+                with service.lock:
+                    stats = {**service.stats, 'cached': len(service.cache), 'cache_bytes': service.cache.bytes}
+                self.send(json.dumps(stats).encode(), "application/json")
+            else:
+                raise RequestError(http.HTTPStatus.NOT_FOUND, f"Unknown endpoint {url.path}")
+        except RequestError as e:
+            self.send_error_json(e.status, str(e))
+        except Exception as e:
+            logger.exception(f"Error serving {self.path}")
+            self.send_error_json(http.HTTPStatus.INTERNAL_SERVER_ERROR, f"{type(e).__name__}: {e}")
+
+    def send(self, data, content_type, tag=None):
+        # data is None when the client copy is current
+        if data is None:
+            self.send_response(http.HTTPStatus.NOT_MODIFIED)
+            self.send_header("ETag", tag)
+            self.end_headers()
+            return
+        self.send_response(http.HTTPStatus.OK)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        if tag is not None:
+            self.send_header("ETag", tag)
+            # Cached by clients, revalidated with the ETag
+            self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_error_json(self, status, message):
+        data = json.dumps({'error': message}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+class IconServer(ThreadingHTTPServer):
+    '''
+    Serves an IconService on (host, port), port 0 picks a free port (see
+    server_address).
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, service, host="127.0.0.1", port=DEFAULT_PORT):
+        self.service = service
+        super().__init__((host, port), IconRequestHandler)
+
+def main(argv=None):
+    desc = 'Icons Extractor HTTP service: serves the icons of Windows ICO, ICL, DLL and EXE files.'
+    arg_parser = argparse.ArgumentParser(description=desc)
+    arg_parser.add_argument('-d', '--debug', help="Print debugging statements", action="store_const", dest="loglevel", const=logging.DEBUG, default=logging.WARNING)
+    arg_parser.add_argument("root", help="Folder whose files are served")
+    arg_parser.add_argument("--host", help="Address to listen on (default: %(default)s)", default="127.0.0.1")
+    arg_parser.add_argument("-p", "--port", help="Port to listen on (default: %(default)s)", type=int, default=DEFAULT_PORT)
+    arg_parser.add_argument("-j", "--jobs", help="Number of worker processes parsing files (default: number of CPUs)", type=int, default=None)
+    arg_parser.add_argument("--cache-size", help="Memory budget in MB of the icon tables and images kept (default: %(default)s)", type=int, default=DEFAULT_CACHE_SIZE // (1024 * 1024))
+    args = arg_parser.parse_args(argv)
+
+    logging.basicConfig(level=args.loglevel, format="%(levelname)s: %(message)s")
+    if not os.path.isdir(args.root):
+        arg_parser.error(f"{args.root} is not a folder")
+
+    service = IconService(args.root, workers=args.jobs, cache_size=args.cache_size * 1024 * 1024)
+    server = IconServer(service, args.host, args.port)
+    host, port = server.server_address[:2]
+    print(f"Serving the icons of {service.root} on http://{host}:{port}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,20 +2,27 @@
 
 import logging
 import icotool
+import iconscan
+import iconindex
+import iconcache
+import iconprofile
+import iconwalk
+import iconwatch
+import iconexport
 import sys
 from pprint import pprint
 import gi
-import io
 import array
 import os
 from pathlib import Path
 import argparse
+import threading
+import time
 
 
 gi.require_version("Gtk", "3.0")
 from gi.repository import Gtk
 from gi.repository import GdkPixbuf, GLib, Gio, Gdk
-from PIL import BmpImagePlugin, PngImagePlugin, Image
 import struct
 
 windowlog = logging.getLogger('icotool')
@@ -31,6 +38,9 @@ SKIP_ALL = -2
 OVERWRITE = -4
 OVERWRITE_ALL = -5
 
+# Seconds between icon view updates while scanning
+SCAN_UPDATE_INTERVAL = 0.25
+
 #pprint(icons.extract_all())
 
 def image2pixbuf(im):
@@ -50,9 +60,24 @@ def image2pixbuf(im):
           )
     return pix
 
+def rgba2pixbuf(data, width, height):
+    '''
+    Wraps an RGBA buffer decoded by the scan engine in a pixbuf without
+    copying it again.
+    '''
+    return GdkPixbuf.Pixbuf.new_from_bytes(
+            GLib.Bytes.new(data),
+            GdkPixbuf.Colorspace.RGB,
+            True,
+            8,
+            width,
+            height,
+            width * 4
+          )
+
 class IconsExtractor:
 
-    def __init__(self, iconfile=False, search_subfolders=False):
+    def __init__(self, iconfile=False, search_subfolders=False, workers=None, index_path=None, index_size=iconindex.DEFAULT_MAX_SIZE, dedup=False, thumbnails=None, cache_size=iconcache.DEFAULT_LRU_SIZE, walk_options=None, scan_archives=False, watch=False, icon_filter=None):
 
         if iconfile:
             windowlog.debug(f"Initializing with {iconfile}")
@@ -65,6 +90,35 @@ class IconsExtractor:
         self.search_subfolders = False
         self.overwrite_all = False
         self.skipall = False
+        self.workers = workers
+        self.index_path = index_path
+        self.index_size = index_size
+        self.dedup = dedup
+        # Ignore rules and limits of the folder walk, see iconwalk.Walker
+        self.walk_options = walk_options or {}
+        # Search the files inside zip and tar archives, see iconarchive
+        self.scan_archives = scan_archives
+        # Only the icons this icotool.IconFilter accepts are parsed
+        self.icon_filter = icon_filter
+        self.scan_cancel = None
+        self.export_cancel = None
+        # Once a scan is done, keep scanning the files added, changed or
+        # removed (see iconwatch) until another scan starts
+        self.watch = watch
+        self.watch_cancel = None
+        # The icon view only holds thumbnails (see iconcache), the ICO file
+        # of each icon is kept by row key and decoded at full size on
+        # demand: into full_images for copies, in the export workers for
+        # extraction. Icon file names are not unique: files with the same
+        # name in different folders give the same ones.
+        self.thumbnails = thumbnails if thumbnails is not None else iconcache.ThumbnailCache()
+        self.icon_files = {}
+        # Key of the next row of the icon view (column 6)
+        self.next_key = 0
+        self.full_images = iconcache.LRUCache(cache_size)
+        # (row key, ICO size) of the icons shown, by file (or archive) they
+        # were found in, so they can be dropped when it changes
+        self.source_icons = {}
 
         # Define signal mappings for builder
         self.handlers = {
@@ -85,7 +139,10 @@ class IconsExtractor:
         "about_window": self.about_window,
         "right_click_menu" : self.right_click,
         "right_click_extract" : self.extract,
+        "right_click_extract_archive" : self.extract_archive,
         "right_click_copy" : self.right_click_copy,
+        "cancel_scan_clicked_cb" : self.cancel_scan,
+        "extract_window_cancel_clicked_cb" : self.cancel_export,
         }
 
         
@@ -137,6 +194,9 @@ class IconsExtractor:
             self.update_status_bar(f"{total} Icons Selected")
 
     def cancel(self, button):
+        self.cancel_scan()
+        self.stop_watch()
+        self.cancel_export()
         Gtk.main_quit()
 
     def onDestroy(self, *args):
@@ -145,23 +205,17 @@ class IconsExtractor:
     def onDestroy(self, *args):
         Gtk.main_quit()
 
-    def get_icons(self, icon_file):
+    def get_icons(self, result):
+        # Adds the icons of an iconscan.ScanResult to the icon view
 
-        try:
-            icons = icotool.IcoTool(icon_file)
-        except:
-            return
-        icon_data = icons.extract_all()
+        for error in result.errors:
+            windowlog.debug(f"Unable to open icon {error}")
 
-        for icon in icon_data:
-            try:
-                img = Image.open(io.BytesIO(icon['ICON']))
-            except ValueError:
-                windowlog.debug(f"Unable to open icon {icon['filename']}")
-                continue
-
-            pixbuf = image2pixbuf(img)
-            windowlog.debug(f"{icon['filename']} Width/Height:{img.size}")
+        for icon in result.icons:
+            width, height = icon['RGBA_size']
+            with iconprofile.stage("pixbuf", len(icon['RGBA'])):
+                pixbuf = rgba2pixbuf(icon['RGBA'], width, height)
+            windowlog.debug(f"{icon['filename']} Width/Height:{icon['RGBA_size']}")
             
             l = icon['filename'].rfind("_", 0, icon['filename'].rfind("_"))
             file_without_extention = icon['filename'][:icon['filename'].rfind(".")]
@@ -173,9 +227,16 @@ class IconsExtractor:
                 index = icon['index']
                 name = f"{Path(icon['original_filename']).name} ({icon['index']},{icon['ID']})"
             
+            key = self.next_key
+            self.next_key += 1
+            ico = icon['ICON']
+            self.icon_files[key] = ico
+            self.source_icons.setdefault(result.archive or result.filename, []).append((key, len(ico)))
+
             self.totalicons += 1
-            self.totalsize += len(icon['ICON'])
-            self.icon_list.append([pixbuf, name,icon['ID'] ,index, 0.5, file_without_extention])
+            self.totalsize += len(ico)
+            with iconprofile.stage("liststore"):
+                self.icon_list.append([pixbuf, name,icon['ID'] ,index, 0.5, file_without_extention, key])
 
     def update_status_bar(self, message=""):
         self.status_bar.pop(self.context_id)
@@ -290,12 +351,17 @@ class IconsExtractor:
 
     def open_items(self, button=None):
         self.search_window.hide()
+        self.cancel_scan()
+        self.stop_watch()
 
         self.totalicons = 0
         self.totalsize = 0
-        totalfiles = 0
         self.icon_list.clear()
-        all_files = list()
+        self.icon_files = {}
+        self.full_images.clear()
+        self.source_icons = {}
+        # Each scan is profiled on its own
+        iconprofile.reset()
 
         self.filename = self.builder.get_object("file_path").get_text()
 
@@ -305,35 +371,182 @@ class IconsExtractor:
         if not self.path_file.exists():
             windowlog.error(f"Error opening {self.filename}")
             return
-        if self.path_file.is_file():
-            windowlog.debug(f"{self.filename} is a file, processing")
-            all_files.append(str(self.path_file.resolve()))
 
-        elif self.path_file.is_dir():
-            windowlog.debug(f"{self.filename} is a folder, processing")
-            
-            glob_string = "**/*"
-            
-            if not self.search_subfolders:
-                glob_string = "*"
-            
-            for l in self.path_file.glob(glob_string):
-                if not l.is_dir():
-                    all_files.append(str(l))
-            
-            windowlog.debug(f'{len(all_files)} files found, searching for icons')
+        # The walk, parsing and decoding run in a background thread (and its
+        # worker processes), icons are added to the icon view in batches
+        # from the main loop
+        self.scan_cancel = threading.Event()
+        self.scan_thread = threading.Thread(target=self.scan_files, args=(self.path_file, self.search_subfolders, self.scan_cancel), daemon=True)
+        self.builder.get_object("cancel_scan_button").show()
+        self.update_status_bar(f"Scanning {self.path_file}")
+        self.scan_thread.start()
+
+    def scan_files(self, path_file, search_subfolders, cancel):
+        # Runs in the scan thread, the GUI is only updated through GLib.idle_add
+        stats = {'files': 0, 'skipped': 0, 'skippedsize': 0, 'bytes': 0, 'filtered': {}, 'start': time.monotonic()}
+
+        batch = []
+        last_update = time.monotonic()
+        index = None
+        if self.index_path:
+            try:
+                index = iconindex.ScanIndex(self.index_path, max_size=self.index_size)
+            except Exception as e:
+                windowlog.error(f"Unable to open scan index {self.index_path}: {e}")
+        scanner = iconscan.Scanner(workers=self.workers, index=index, dedup=self.dedup, thumbnails=self.thumbnails, archives=self.scan_archives, icon_filter=self.icon_filter)
+        walk_options = dict(self.walk_options)
+        max_depth = walk_options.pop('max_depth', None)
+        walker = iconwalk.Walker(max_depth=max_depth if search_subfolders else 0, **walk_options)
+        watcher = None
+        if self.watch:
+            # The files found are scanned as the folders are walked and
+            # watched, changes made meanwhile come with the first update
+            watcher = iconwatch.Watcher([path_file.resolve()], walker)
+            files = watcher.start(cancel)
+        else:
+            files = walker.walk([path_file.resolve()], cancel=cancel)
+        results = scanner.scan(files, cancel=cancel)
+        try:
+            for result in results:
+                stats['files'] += 1
+                iconscan.add_filtered(stats['filtered'], result)
+                if result.error:
+                    windowlog.debug(f"Unable to open {result.filename}: {result.error}")
+                elif not result.filetype:
+                    # Only the headers of files that cannot hold icons were read
+                    stats['skipped'] += 1
+                    stats['skippedsize'] += result.size
+                else:
+                    stats['bytes'] += result.size
+                    batch.append(result)
+
+                if time.monotonic() - last_update >= SCAN_UPDATE_INTERVAL:
+                    if scanner.dedup is not None:
+                        stats.update(scanner.dedup.stats())
+                    GLib.idle_add(self.add_results, batch, dict(stats, filtered=dict(stats['filtered'])), False, cancel)
+                    batch = []
+                    last_update = time.monotonic()
+        except Exception as e:
+            windowlog.error(f"Error scanning {path_file}: {e}")
+        finally:
+            results.close()
+            if scanner.dedup is not None:
+                stats.update(scanner.dedup.stats())
+            GLib.idle_add(self.add_results, batch, dict(stats), True, cancel)
 
-        for file_path in all_files:
-            self.get_icons(file_path)
-            totalfiles +=1
+        try:
+            if watcher is not None and not cancel.is_set():
+                self.watch_files(scanner, watcher, cancel)
+        except Exception as e:
+            windowlog.error(f"Error watching {path_file}: {e}")
+        finally:
+            if watcher is not None:
+                watcher.close()
+            if index is not None:
+                windowlog.debug(f"Scan index: {index.hits} files loaded, {index.misses} files parsed")
+                index.close()
+
+    def watch_files(self, scanner, watcher, cancel):
+        # Runs in the scan thread once the scan is done, until cancel is set
+        for changes in watcher.changes(cancel):
+            results = []
+            for result in scanner.scan(changes.changed, cancel=cancel):
+                if result.error:
+                    windowlog.debug(f"Unable to open {result.filename}: {result.error}")
+                elif result.filetype:
+                    results.append(result)
+            GLib.idle_add(self.watch_results, changes, results, cancel)
+
+    def watch_results(self, changes, results, cancel):
+        # Called from the main loop with an iconwatch.Changes and the
+        # ScanResults of the files changed
+        if cancel is not self.watch_cancel:
+            return False
+        # Icons of changed files are replaced
+        self.remove_sources(changes.removed + changes.changed)
+        for result in results:
+            self.get_icons(result)
+        self.update_status_bar(f"Folder updated ({len(changes.changed)} Files changed, {len(changes.removed)} removed, {self.totalicons} Icons, {self.totalsize:,} bytes), watching for changes")
+        return False
+
+    def remove_sources(self, filenames):
+        # Drops the icons found in filenames from the icon view, by row
+        # key: other files can give icons of the same name
+        keys = set()
+        for filename in filenames:
+            for key, size in self.source_icons.pop(filename, ()):
+                keys.add(key)
+                self.icon_files.pop(key, None)
+                self.full_images.discard(key)
+                self.totalicons -= 1
+                self.totalsize -= size
+        if not keys:
+            return
+        treeiter = self.icon_list.get_iter_first()
+        while treeiter is not None:
+            if self.icon_list[treeiter][6] in keys:
+                # remove() moves treeiter to the next row
+                if not self.icon_list.remove(treeiter):
+                    break
+            else:
+                treeiter = self.icon_list.iter_next(treeiter)
+
+    def stop_watch(self):
+        if self.watch_cancel is not None:
+            windowlog.debug("Stopping watch")
+            self.watch_cancel.set()
+            self.watch_cancel = None
+
+    def add_results(self, results, stats, finished, cancel):
+        # Called from the main loop with a batch of iconscan.ScanResults
+        if cancel is not self.scan_cancel:
+            # Left over from a scan that was replaced by a new one
+            return False
+
+        for result in results:
+            self.get_icons(result)
+
+        elapsed = max(time.monotonic() - stats['start'], 0.001)
+        throughput = f"{stats['files'] / elapsed:,.0f} Files/s, {stats['bytes'] / elapsed / 1048576:,.1f} MB/s"
+        duplicates = ""
+        if 'duplicates' in stats:
+            # Duplicate images were neither decoded nor added to the view
+            duplicates = f", {stats['duplicates']} duplicates skipped ({stats['saved']:,} bytes)"
+        if stats['filtered']:
+            # Filtered icons were never copied out of their file
+            duplicates += f", {stats['filtered']['skipped']} Icons filtered out"
+
+        if not finished:
+            self.update_status_bar(f"Scanning... ({stats['files']} Files, {self.totalicons} Icons, {self.totalsize:,} bytes{duplicates}, {throughput})")
+            return False
+
+        windowlog.debug(f"Skipped {stats['skipped']} files without icons ({stats['skippedsize']:,} bytes not read)")
+        if iconprofile.enabled:
+            print(iconprofile.report(), file=sys.stderr)
+        self.builder.get_object("cancel_scan_button").hide()
+        self.scan_cancel = None
+        if self.watch and not cancel.is_set():
+            # The scan thread goes on watching for changes
+            self.watch_cancel = cancel
+
+        if cancel.is_set():
+            self.update_status_bar(f"Scan cancelled ({stats['files']} Files, {self.totalicons} Icons, {self.totalsize:,} bytes)")
+        elif self.path_file.is_file():
+            self.update_status_bar(f"File {self.path_file.name} loaded ({self.totalicons} Icons, {self.totalsize:,} bytes{duplicates})")
+        else:
+            self.update_status_bar(f"Folder loaded ({stats['files']} Files, {self.totalicons} Icons, {self.totalsize:,} bytes{duplicates}, {stats['skipped']} Files skipped, {stats['skippedsize']:,} bytes not read, {throughput})")
 
-        
         if self.path_file.is_file():
-            self.update_status_bar(f"File {self.path_file.name} loaded ({self.totalicons} Icons, {self.totalsize:,} bytes)")
             self.window.set_title(f"Icon Extractor - {self.path_file.name}")
         else:
-            self.update_status_bar(f"Folder loaded ({totalfiles} Files, {self.totalicons} Icons, {self.totalsize:,} bytes)")
             self.window.set_title(f"Icon Extractor - {self.path_file}")
+        return False
+
+    def cancel_scan(self, button=None):
+        if self.scan_cancel is not None and not self.scan_cancel.is_set():
+            windowlog.debug("Cancelling scan")
+            self.scan_cancel.set()
+            self.update_status_bar("Cancelling scan...")
 
 
     def get_selected(self):
@@ -345,7 +558,8 @@ class IconsExtractor:
             treeiter = liststore.get_iter(treeview)
             filename = liststore.get_value(treeiter, 5)
             image = liststore.get_value(treeiter, 0)
-            selected_icons.append((filename,image))
+            key = liststore.get_value(treeiter, 6)
+            selected_icons.append((filename,image,key))
         return selected_icons
             
         
@@ -354,21 +568,7 @@ class IconsExtractor:
         extract_radio = self.builder.get_object("extract_selected")
 
         if len(selected_items) == 0:
-            windowlog.debug("No files selected to extract. Showing error message.")
-            dialog = Gtk.MessageDialog(
-                transient_for=self.window,
-                flags=0,
-                message_type=Gtk.MessageType.ERROR,
-                buttons=Gtk.ButtonsType.OK,
-                text="You must select at least one icon to extract",
-            )
-            dialog.format_secondary_text(
-                "Tip: Use CTRL-A to select all icons!"
-            )
-            dialog.run()
-            windowlog.debug("Error Message Closed")
-
-            dialog.destroy()
+            self.no_icons_selected()
             return
 
         dialog = Gtk.FileChooserDialog(
@@ -402,81 +602,189 @@ class IconsExtractor:
             return
         
         windowlog.debug(f"Extracting {len(selected_items)} icons")
-        
-        extract_window = self.builder.get_object("extract_window")
-        self.builder.get_object("extract_window_from_label").set_label(f"Extracting files from \"{self.path_file.name}\"")
-        extract_text = "Extracting {} to {}"
-        pulse_bar = self.builder.get_object("extract_window_progress_bar")
-
-        button_quit = self.builder.get_object("extract_window_quit")
-        button_show = self.builder.get_object("extract_window_show")
-        button_show_quit = self.builder.get_object("extract_window_show_quit")
-        button_close = self.builder.get_object("extract_window_close")
-        button_quit.set_sensitive(False)
-        button_show.set_sensitive(False)
-        button_show_quit.set_sensitive(False)
-        button_close.set_sensitive(False)
-        extract_to_label = self.builder.get_object("extract_window_to_label")
-        extract_to_label.set_label("")
-        pulse_bar.set_fraction(0.0)
-        
-        total = 0
-        total_selected = len(selected_items)
-        total_files = 1
-
-        extract_window.show_all()
-
-
-        for selected in selected_items:
-            filename = selected[0]
-            pixbuf = selected[1]
-            overwrite = False
 
+        # Decide what to do with existing files before anything is written,
+        # the folder is only listed once
+        exporter = iconexport.Exporter(self.selected_folder, workers=self.workers)
+        existing = exporter.existing()
+        items = {}
+        for filename, pixbuf, key in selected_items:
             extract_path = Path(self.selected_folder) / f"{filename}.png"
-            extract_text = extract_text.format(filename, self.selected_folder)
-            extract_to_label.set_label(extract_text)
-            pulse_bar.set_fraction(total_selected/total_files)
-            if extract_path.exists() and not (self.skipall or self.overwrite_all):
-
+            if extract_path.name in existing and not self.overwrite_all:
+                if self.skipall:
+                    windowlog.debug(f"Skipping {str(extract_path)} file already exists")
+                    continue
                 windowlog.debug(f"File {str(extract_path)} exists, asking user")
                 what_to_do = self.file_exists(str(extract_path))
-                
+
                 if what_to_do == SKIP_ALL:
                     self.skipall = True
+                    windowlog.debug(f"Skipping {str(extract_path)} file already exists")
+                    continue
                 elif what_to_do == SKIP:
                     windowlog.debug(f"Skipping {str(extract_path)} file already exists")
                     continue
-                elif what_to_do == OVERWRITE:
-                    overwrite = True
                 elif what_to_do == OVERWRITE_ALL:
                     self.overwrite_all = True
+            # A later icon with the same file name replaces this one, as it
+            # did when icons were written one at a time
+            existing.add(extract_path.name)
+            items[extract_path.name] = self.export_item(filename, key)
+        self.start_export(exporter, list(items.values()), self.selected_folder)
 
-            if extract_path.exists() and self.skipall:
-                windowlog.debug(f"Skipping {str(extract_path)} file already exists")
-                continue 
+    def extract_archive(self, button):
+        selected_items = self.get_selected()
 
-            if overwrite or self.overwrite_all:
-                windowlog.debug(f"Extracting {filename} to {extract_path}")
-                pixbuf.savev(str(extract_path),"png",[], [])
-                extract_window.show_all()
-                total_files += 1
-            
-            if not extract_path.exists():
-                windowlog.debug(f"Extracting {filename} to {extract_path}")
-                pixbuf.savev(str(extract_path),"png",[], [])
-                extract_window.show_all()
-                total_files += 1
-
-        self.update_status_bar(f"{total_files} Icons Extracted")
-        extract_to_label.set_label("Extraction completed successfully")
-        button_quit.set_sensitive(True)
-        button_show.set_sensitive(True)
-        button_show_quit.set_sensitive(True)
-        button_close.set_sensitive(True)
+        if len(selected_items) == 0:
+            self.no_icons_selected()
+            return
+
+        dialog = Gtk.FileChooserDialog(
+            title="Choose an archive to extract to",
+            action=Gtk.FileChooserAction.SAVE,
+        )
+
+        dialog.add_buttons(
+            Gtk.STOCK_CANCEL,
+            Gtk.ResponseType.CANCEL,
+            "Save",
+            Gtk.ResponseType.OK)
+        dialog.set_transient_for(self.window)
+        dialog.set_do_overwrite_confirmation(True)
+        dialog.set_current_name(f"{self.path_file.stem or 'icons'}.zip")
+        for name, pattern in (("Zip archive", "*.zip"), ("Compressed tar archive", "*.tar.gz")):
+            file_filter = Gtk.FileFilter()
+            file_filter.set_name(name)
+            file_filter.add_pattern(pattern)
+            dialog.add_filter(file_filter)
+
+        dialog.set_modal(True)
+        response_id = dialog.run()
+        archive_path = dialog.get_filename()
+        dialog.destroy()
+        if response_id != Gtk.ResponseType.OK or not archive_path:
+            windowlog.debug("Archive selection cancelled")
+            return
+
+        if iconexport.archive_mode(archive_path) is None:
+            archive_path += ".zip"
+        self.selected_folder = str(Path(archive_path).parent)
+
+        windowlog.debug(f"Extracting {len(selected_items)} icons to {archive_path}")
+        try:
+            exporter = iconexport.ArchiveExporter(archive_path, workers=self.workers)
+        except Exception as e:
+            windowlog.error(f"Unable to create {archive_path}: {e}")
+            self.update_status_bar(f"Unable to create {archive_path}: {e}")
+            return
+        items = [self.export_item(filename, key) for filename, pixbuf, key in selected_items]
+        self.start_export(exporter, items, archive_path)
+
+    def no_icons_selected(self):
+        windowlog.debug("No files selected to extract. Showing error message.")
+        dialog = Gtk.MessageDialog(
+            transient_for=self.window,
+            flags=0,
+            message_type=Gtk.MessageType.ERROR,
+            buttons=Gtk.ButtonsType.OK,
+            text="You must select at least one icon to extract",
+        )
+        dialog.format_secondary_text(
+            "Tip: Use CTRL-A to select all icons!"
+        )
+        dialog.run()
+        windowlog.debug("Error Message Closed")
+
+        dialog.destroy()
+
+    def start_export(self, exporter, items, target):
+        # Shows the extract window and exports items in the export thread
+        extract_window = self.builder.get_object("extract_window")
+        self.builder.get_object("extract_window_from_label").set_label(f"Extracting files from \"{self.path_file.name}\"")
+        self.builder.get_object("extract_window_progress_bar").set_fraction(0.0)
+        for button in ("extract_window_quit", "extract_window_show", "extract_window_show_quit", "extract_window_close"):
+            self.builder.get_object(button).set_sensitive(False)
+        self.builder.get_object("extract_window_to_label").set_label(f"Extracting {len(items)} icons to {target}")
+        self.builder.get_object("extract_window_cancel").show()
         extract_window.show_all()
-        self.extract_window = extract_window
-        
-    
+
+        self.export_cancel = threading.Event()
+        export_thread = threading.Thread(target=self.export_icons, args=(exporter, items, self.export_cancel), daemon=True)
+        export_thread.start()
+
+    def export_item(self, filename, key):
+        # The pixbufs are thumbnails, the export workers decode the ICO
+        # file of row key at full size (PNG compressed icons are written
+        # as stored)
+        return iconexport.ExportItem(filename, ico=self.icon_files[key])
+
+    def full_pixbuf(self, key):
+        # Decodes the icon of row key at full size, keeping the latest ones
+        # within the memory budget of full_images
+        pixbuf = self.full_images.get(key)
+        if pixbuf is None:
+            rgba, (width, height) = iconscan.decode_icon({'ICON': self.icon_files[key]}, size=None)
+            pixbuf = rgba2pixbuf(rgba, width, height)
+            self.full_images.put(key, pixbuf, len(rgba))
+        return pixbuf
+
+    def export_icons(self, exporter, items, cancel):
+        # Runs in the export thread, the GUI is only updated through GLib.idle_add
+        last_update = 0
+
+        def progress(done, total):
+            nonlocal last_update
+            if time.monotonic() - last_update >= SCAN_UPDATE_INTERVAL:
+                GLib.idle_add(self.export_progress, done, total)
+                last_update = time.monotonic()
+
+        try:
+            with exporter:
+                summary = exporter.export(items, cancel=cancel, progress=progress)
+        except Exception as e:
+            windowlog.error(f"Error exporting to {exporter.folder}: {e}")
+            summary = {'written': 0, 'bytes': 0, 'failed': [], 'cancelled': False, 'elapsed': 0.0, 'error': str(e)}
+        GLib.idle_add(self.export_finished, summary, len(items))
+
+    def export_progress(self, done, total):
+        self.builder.get_object("extract_window_progress_bar").set_fraction(done / max(total, 1))
+        self.update_status_bar(f"Extracting... ({done} of {total} Icons)")
+        return False
+
+    def export_finished(self, summary, total):
+        for name, error in summary['failed']:
+            windowlog.error(f"Unable to extract {name}: {error}")
+
+        elapsed = max(summary['elapsed'], 0.001)
+        throughput = f"{summary['written'] / elapsed:,.0f} Icons/s, {summary['bytes'] / elapsed / 1048576:,.1f} MB/s"
+        failed = len(summary['failed'])
+        extract_to_label = self.builder.get_object("extract_window_to_label")
+        if summary.get('error'):
+            extract_to_label.set_label(f"Extraction failed: {summary['error']}")
+        elif summary['cancelled']:
+            extract_to_label.set_label(f"Extraction cancelled ({summary['written']} of {total} Icons extracted)")
+        elif failed:
+            extract_to_label.set_label(f"Extraction completed, {failed} Icons could not be written")
+        else:
+            extract_to_label.set_label("Extraction completed successfully")
+        self.builder.get_object("extract_window_progress_bar").set_fraction((summary['written'] + failed) / max(total, 1))
+        self.update_status_bar(f"{summary['written']} Icons Extracted ({summary['bytes']:,} bytes, {failed} failed, {throughput})")
+
+        self.builder.get_object("extract_window_cancel").hide()
+        self.builder.get_object("extract_window_quit").set_sensitive(True)
+        self.builder.get_object("extract_window_show").set_sensitive(True)
+        self.builder.get_object("extract_window_show_quit").set_sensitive(True)
+        self.builder.get_object("extract_window_close").set_sensitive(True)
+        self.extract_window = self.builder.get_object("extract_window")
+        self.export_cancel = None
+        return False
+
+    def cancel_export(self, button=None):
+        if self.export_cancel is not None and not self.export_cancel.is_set():
+            windowlog.debug("Cancelling extraction")
+            self.export_cancel.set()
+            self.builder.get_object("extract_window_to_label").set_label("Cancelling extraction...")
+
     def show_extract_folder(self, button):
         if not self.selected_folder:
             return
@@ -557,8 +865,9 @@ class IconsExtractor:
 
     def right_click_copy(self, *args):
         if len(self.get_selected()) > 0:
-            filename = self.get_selected()[-1][0]
-            pixbuf = self.get_selected()[-1][1]
+            filename, image, key = self.get_selected()[-1]
+            # The icon view only holds a thumbnail
+            pixbuf = self.full_pixbuf(key)
             windowlog.debug(f"Copying {filename} to clipboard")
             self.clipboard.set_image(pixbuf)
 
@@ -571,9 +880,59 @@ arg_parser = argparse.ArgumentParser(description=desc)
 arg_parser.add_argument('-d', '--debug', help="Print debugging statements", action="store_const", dest="loglevel", const=logging.DEBUG, default=logging.WARNING)
 arg_parser.add_argument("filename", help="Windows file or folder to extract Icons from", nargs="?", default=None)
 arg_parser.add_argument("-s", "--search_subfolders", help="Search subfolders if filename is a folder", default=False, action="store_true")
-args = arg_parser.parse_args()
-
-windowlog.setLevel(args.loglevel)
-
-ico = IconsExtractor(iconfile=args.filename, search_subfolders=args.search_subfolders)
-Gtk.main()
\ No newline at end of file
+arg_parser.add_argument("--max-depth", help="Levels of subfolders searched with --search_subfolders (default: no limit)", type=int, default=None)
+arg_parser.add_argument("--ignore", help="Skip files and folders matching this glob pattern, patterns with a / match paths relative to the folder searched (can be repeated)", action="append", default=[], metavar="PATTERN")
+arg_parser.add_argument("--ignore-ext", help="Skip files with this extension (can be repeated)", action="append", default=[], metavar="EXT")
+arg_parser.add_argument("--max-file-size", help="Skip files larger than this many MB", type=float, default=0, metavar="MB")
+arg_parser.add_argument("--follow-symlinks", help="Follow symlinks to files and folders", default=False, action="store_true")
+arg_parser.add_argument("--cross-devices", help="Search folders on other filesystems", default=False, action="store_true")
+arg_parser.add_argument("-z", "--scan-archives", help="Search the files inside zip and tar archives (.zip, .tar, .tar.gz, .tgz, .tar.bz2, .tar.xz) without unpacking them", default=False, action="store_true")
+arg_parser.add_argument("-w", "--watch", help="Keep the icon view up to date with the files added, changed or removed once the scan is done", default=False, action="store_true")
+arg_parser.add_argument("--min-size", help="Only show icons at least this wide", type=int, default=0)
+arg_parser.add_argument("--max-size", help="Only show icons at most this wide", type=int, default=0)
+arg_parser.add_argument("--min-bits", help="Only show icons with at least this many bits per pixel", type=int, default=0)
+arg_parser.add_argument("--max-bits", help="Only show icons with at most this many bits per pixel", type=int, default=0)
+arg_parser.add_argument("--image-format", help="Only show icons whose image is stored as PNG or as a bitmap (DIB)", choices=["png", "dib"], default=None)
+arg_parser.add_argument("--group", help="Only show the group icons whose id, index or name matches this glob pattern (can be repeated)", action="append", default=None, metavar="PATTERN")
+arg_parser.add_argument("-i", "--index", help=f"Keep a scan index so unchanged files are not parsed again, optionally giving its location (default: {iconindex.DEFAULT_INDEX})", nargs="?", const=iconindex.DEFAULT_INDEX, default=None)
+arg_parser.add_argument("--index-size", help="Size cap of the scan index in MB (default: %(default)s)", type=int, default=iconindex.DEFAULT_MAX_SIZE // (1024 * 1024))
+arg_parser.add_argument("-j", "--jobs", help="Number of worker processes used to scan files (default: number of CPUs)", type=int, default=None)
+arg_parser.add_argument("-u", "--dedup", help="Only show the first of identical icon images found in the files scanned", default=False, action="store_true")
+arg_parser.add_argument("--thumbnail-size", help="Largest width and height of the icons shown, larger icons are scaled down (default: %(default)s)", type=int, default=iconcache.THUMBNAIL_SIZE)
+arg_parser.add_argument("--thumbnail-cache", help=f"Folder caching the thumbnails of large icons (default: {iconcache.DEFAULT_THUMBNAILS})", default=iconcache.DEFAULT_THUMBNAILS)
+arg_parser.add_argument("--no-thumbnail-cache", help="Do not cache thumbnails on disk", dest="thumbnail_cache", action="store_const", const=None)
+arg_parser.add_argument("--profile", help="Print the time spent in each stage (walk, read, parse, decode, pixbuf...) when a scan is done", default=False, action="store_true")
+arg_parser.add_argument("--profile-json", help="Write the time spent in each stage of the last scan to this JSON file on exit", default=None, metavar="FILE")
+arg_parser.add_argument("--cprofile", help="Write a cProfile dump of the main process to this file on exit", default=None, metavar="FILE")
+arg_parser.add_argument("--cache-size", help="Memory budget in MB of the icons decoded at full size for copies (default: %(default)s)", type=int, default=iconcache.DEFAULT_LRU_SIZE // (1024 * 1024))
+
+if __name__ == "__main__":
+    args = arg_parser.parse_args()
+
+    windowlog.setLevel(args.loglevel)
+    if args.profile or args.profile_json:
+        iconprofile.enable()
+    profiler = None
+    if args.cprofile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    thumbnails = iconcache.ThumbnailCache(args.thumbnail_cache, args.thumbnail_size)
+    walk_options = {
+        'max_depth': args.max_depth,
+        'ignore': args.ignore,
+        'ignore_extensions': args.ignore_ext,
+        'max_size': int(args.max_file_size * 1024 * 1024),
+        'follow_symlinks': args.follow_symlinks,
+        'cross_devices': args.cross_devices,
+        }
+    icon_filter = icotool.IconFilter(min_width=args.min_size, max_width=args.max_size, min_bits=args.min_bits, max_bits=args.max_bits, formats=[args.image_format] if args.image_format else None, groups=args.group)
+    ico = IconsExtractor(iconfile=args.filename, search_subfolders=args.search_subfolders, workers=args.jobs, index_path=args.index, index_size=args.index_size * 1024 * 1024, dedup=args.dedup, thumbnails=thumbnails, cache_size=args.cache_size * 1024 * 1024, walk_options=walk_options, scan_archives=args.scan_archives, watch=args.watch, icon_filter=icon_filter if icon_filter.active else None)
+    Gtk.main()
+
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.cprofile)
+    if args.profile_json:
+        iconprofile.write_json(args.profile_json)
\ No newline at end of file
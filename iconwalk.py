@@ -0,0 +1,204 @@
+import fnmatch
+import logging
+import os
+import concurrent.futures
+import itertools
+from collections import deque
+
+import iconprofile
+
+'''
+Icons Folder Walker
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Streams the files found under folders to the scan engine as they are
+listed. Folders are read with os.scandir, whose entries already tell files
+from folders and symlinks without an extra stat, by a pool of threads so
+wide trees and network mounts are listed in parallel.
+
+Files and folders can be ignored by glob pattern, extension and size, and
+the walk stops at a maximum depth. Symlinks are not followed and other
+filesystems are not entered unless asked.
+'''
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# Threads listing folders, listing mostly waits on the filesystem
+DEFAULT_WORKERS = 4
+# Seconds between checks for cancellation while waiting on a listing
+CANCEL_POLL = 0.1
+
+class Walker:
+    '''
+    Walks folders for files to scan.
+
+    ignore: glob patterns, files and folders whose name matches one are
+            skipped (patterns containing a / are matched against the path
+            relative to the folder walked)
+    ignore_extensions: file extensions to skip, such as ".txt" (any case)
+    min_size, max_size: only yield files of at least / at most this many
+                        bytes, 0 for no limit
+    max_depth: how many levels of subfolders to enter, 0 only lists the
+               folders given, None has no limit
+    follow_symlinks: follow symlinks to files and folders, each folder is
+                     still only walked once
+    cross_devices: enter folders on another filesystem than the folder
+                   given
+    workers: number of threads listing folders, 1 lists them in the
+             calling thread
+
+    self.stats counts the 'folders' listed, 'files' yielded, entries
+    'ignored' and folders that could not be listed ('errors').
+    '''
+
+    def __init__(self, ignore=(), ignore_extensions=(), min_size=0, max_size=0, max_depth=None, follow_symlinks=False, cross_devices=False, workers=DEFAULT_WORKERS):
+        self.ignore = [pattern for pattern in ignore if '/' not in pattern]
+        self.ignore_paths = [pattern.strip('/') for pattern in ignore if '/' in pattern]
+        self.ignore_extensions = tuple(ext.lower() if ext.startswith('.') else f".{ext.lower()}" for ext in ignore_extensions)
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_depth = max_depth
+        self.follow_symlinks = follow_symlinks
+        self.cross_devices = cross_devices
+        self.workers = max(workers, 1)
+        self.stats = {'folders': 0, 'files': 0, 'ignored': 0, 'errors': 0}
+
+    def ignored(self, entry, relative):
+        for pattern in self.ignore:
+            if fnmatch.fnmatch(entry.name, pattern):
+                return True
+        for pattern in self.ignore_paths:
+            if fnmatch.fnmatch(relative, pattern):
+                return True
+        return False
+
+    def wanted_file(self, entry):
+        if self.ignore_extensions and entry.name.lower().endswith(self.ignore_extensions):
+            return False
+        if self.min_size or self.max_size:
+            # Only stats the files when a size rule is set
+            size = entry.stat(follow_symlinks=self.follow_symlinks).st_size
+            if size < self.min_size or (self.max_size and size > self.max_size):
+                return False
+        return True
+
+    def list_folder(self, path, relative, depth, device):
+        '''
+        Lists one folder, runs in a worker thread. Returns (files,
+        subfolders, ignored) where subfolders are (path, relative path,
+        depth) tuples still to walk.
+        '''
+        files = []
+        subfolders = []
+        ignored = 0
+        with iconprofile.stage("walk"), os.scandir(path) as entries:
+            for entry in entries:
+                entry_relative = f"{relative}/{entry.name}" if relative else entry.name
+                try:
+                    if entry.is_dir(follow_symlinks=self.follow_symlinks):
+                        if (self.max_depth is not None and depth >= self.max_depth) or self.ignored(entry, entry_relative):
+                            ignored += 1
+                        elif not self.cross_devices and entry.stat(follow_symlinks=self.follow_symlinks).st_dev != device:
+                            logger.debug(f"Not crossing into {entry.path}")
+                            ignored += 1
+                        else:
+                            subfolders.append((entry.path, entry_relative, depth + 1))
+                    elif entry.is_file(follow_symlinks=self.follow_symlinks):
+                        if self.ignored(entry, entry_relative) or not self.wanted_file(entry):
+                            ignored += 1
+                        else:
+                            files.append(entry.path)
+                except OSError as e:
+                    # Broken symlinks or entries removed while listing
+                    logger.debug(f"Skipping {entry.path}: {e}")
+                    ignored += 1
+        files.sort()
+        subfolders.sort()
+        return files, subfolders, ignored
+
+    def walk(self, paths, cancel=None, root=None, folders=None):
+        '''
+        Yields the files in paths (files are yielded as given, folders are
+        walked), as soon as the folder holding them has been listed.
+        Folders are yielded breadth first, in name order.
+
+        cancel: optional threading.Event, once it is set the walk stops
+        root: optional folder holding the folders in paths, ignore patterns
+              and max_depth are then applied relative to it, as if root
+              was walked
+        folders: optional list, the path of each folder listed is appended
+                 to it
+        '''
+        self.stats = {'folders': 0, 'files': 0, 'ignored': 0, 'errors': 0}
+        # Folders walked, by device and inode, so symlinks cannot loop
+        visited = set()
+        # Folders to list as [future, path, relative path, depth, device],
+        # only the first max_pending are handed to the threads so listings
+        # do not pile up ahead of the caller
+        pending = deque()
+        max_pending = self.workers * 4
+
+        def add(path, relative, depth, device):
+            if self.follow_symlinks:
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    return
+                if (stat.st_dev, stat.st_ino) in visited:
+                    return
+                visited.add((stat.st_dev, stat.st_ino))
+            pending.append([None, path, relative, depth, device])
+
+        executor = concurrent.futures.ThreadPoolExecutor(self.workers) if self.workers > 1 else None
+        try:
+            for path in paths:
+                path = str(path)
+                if os.path.isfile(path):
+                    self.stats['files'] += 1
+                    yield path
+                elif os.path.isdir(path) and root is not None:
+                    relative = os.path.relpath(path, root)
+                    depth = 0 if relative == "." else relative.count(os.sep) + 1
+                    if self.max_depth is None or depth <= self.max_depth:
+                        add(path, "" if depth == 0 else relative.replace(os.sep, "/"), depth, os.stat(root).st_dev)
+                elif os.path.isdir(path):
+                    add(path, "", 0, os.stat(path).st_dev)
+                else:
+                    logger.warning(f"{path} not found")
+
+            while pending:
+                if cancel is not None and cancel.is_set():
+                    return
+                if executor is not None:
+                    for folder in itertools.islice(pending, max_pending):
+                        if folder[0] is None:
+                            folder[0] = executor.submit(self.list_folder, *folder[1:])
+                future, path, relative, depth, device = pending.popleft()
+                try:
+                    if future is None:
+                        files, subfolders, ignored = self.list_folder(path, relative, depth, device)
+                    else:
+                        while not future.done():
+                            if cancel is not None and cancel.is_set():
+                                return
+                            concurrent.futures.wait([future], timeout=CANCEL_POLL)
+                        files, subfolders, ignored = future.result()
+                except OSError as e:
+                    logger.debug(f"Unable to list {path}: {e}")
+                    self.stats['errors'] += 1
+                    continue
+                self.stats['folders'] += 1
+                if folders is not None:
+                    folders.append(path)
+                self.stats['ignored'] += ignored
+                for subfolder, subfolder_relative, subfolder_depth in subfolders:
+                    add(subfolder, subfolder_relative, subfolder_depth, device)
+                for filename in files:
+                    if cancel is not None and cancel.is_set():
+                        return
+                    self.stats['files'] += 1
+                    yield filename
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,403 @@
+import ctypes
+import errno
+import logging
+import os
+import select
+import struct
+import time
+from collections import deque
+
+import iconprofile
+
+'''
+Icons Folder Watcher
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Watches the files and folders scanned for files added, changed or removed
+so only those are scanned again. The watcher keeps a snapshot (size and
+modification time) of every file the iconwalk.Walker rules let through,
+and the folders that may have changed are listed again and compared with
+it.
+
+On Linux the folders are watched with inotify, events only mark the folder
+they happened in. Files are reported once they are closed after writing or
+moved in, not while they are being written. Elsewhere, or when the
+inotify watch limit is reached, the folders are polled. Bursts of events
+are coalesced: changes are reported once no event came for the debounce
+delay, and at least every max_delay seconds during a long copy.
+'''
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# Seconds without events before changes are reported
+DEBOUNCE = 0.5
+# Seconds changes may be held back while events keep coming
+MAX_DELAY = 5.0
+# Seconds between polls when inotify cannot be used
+POLL_INTERVAL = 2.0
+# Seconds between checks for cancellation while waiting for events
+CANCEL_POLL = 0.1
+
+# inotify(7) event masks
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+# struct inotify_event without its name
+INOTIFY_EVENT = struct.Struct('iIII')
+
+class Changes:
+    '''
+    Files changed since the last report:
+
+    changed: list of str, files added or modified, to scan again
+    removed: list of str, files (or whole folders) that are gone, or no
+             longer pass the walker rules
+    '''
+
+    def __init__(self, changed, removed):
+        self.changed = changed
+        self.removed = removed
+
+    def __bool__(self):
+        return bool(self.changed or self.removed)
+
+    def __repr__(self):
+        return f"Changes({len(self.changed)} changed, {len(self.removed)} removed)"
+
+class Inotify:
+    '''
+    Watches folders with the Linux inotify API (through ctypes). read()
+    returns the folders to list again as (path, recursive) tuples.
+    '''
+
+    def __init__(self, follow_symlinks=False):
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, os.strerror(code))
+        self.mask = WATCH_MASK if follow_symlinks else WATCH_MASK | IN_DONT_FOLLOW
+        # Watched folder by watch descriptor
+        self.folders = {}
+        # What to list again when events were lost, see Watcher.start
+        self.rescan = set()
+
+    def add(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.mask)
+        if wd < 0:
+            code = ctypes.get_errno()
+            if code == errno.ENOSPC:
+                # fs.inotify.max_user_watches reached
+                raise OSError(code, "inotify watch limit reached")
+            # Removed since it was listed
+            logger.debug(f"Unable to watch {path}: {os.strerror(code)}")
+            return
+        self.folders[wd] = path
+
+    def read(self, timeout):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set()
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return set()
+        dirty = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, everything is listed again
+                logger.debug("inotify queue overflow")
+                dirty.update(self.rescan)
+                continue
+            folder = self.folders.get(wd)
+            if folder is None:
+                continue
+            if mask & IN_IGNORED:
+                # The folder was removed or is no longer watched
+                del self.folders[wd]
+            elif mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                # Seen through the event of its parent, unless it is a root
+                if (folder, True) in self.rescan:
+                    dirty.add((folder, True))
+                if mask & IN_MOVE_SELF:
+                    # Its path no longer holds it, later events would be
+                    # misplaced
+                    self.libc.inotify_rm_watch(self.fd, wd)
+            else:
+                # Files and subfolders are found by listing the folder
+                dirty.add((folder, False))
+        return dirty
+
+    def close(self):
+        os.close(self.fd)
+
+class Poller:
+    '''
+    Used instead of Inotify: every poll_interval read() returns all the
+    folders to list again.
+    '''
+
+    def __init__(self, poll_interval=POLL_INTERVAL):
+        self.poll_interval = poll_interval
+        self.rescan = set()
+        self.last_poll = time.monotonic()
+
+    def add(self, path):
+        pass
+
+    def read(self, timeout):
+        wait = self.last_poll + self.poll_interval - time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return set()
+        time.sleep(max(wait, 0))
+        self.last_poll = time.monotonic()
+        return set(self.rescan)
+
+    def close(self):
+        pass
+
+class Watcher:
+    '''
+    Watches paths for files to scan again, following the rules of walker
+    (an iconwalk.Walker: ignore patterns, sizes, depth, symlinks).
+
+    debounce: seconds without events before changes are reported
+    max_delay: seconds changes may be held back while events keep coming
+    poll_interval: seconds between polls when inotify cannot be used
+    use_inotify: False always polls
+
+    start() walks the paths once and yields the files found, to scan
+    first, changes() then yields a Changes for each burst of activity.
+    self.stats counts the 'events' (folders marked), 'changed' and
+    'removed' files and the 'reports' made.
+    '''
+
+    def __init__(self, paths, walker, debounce=DEBOUNCE, max_delay=MAX_DELAY, poll_interval=POLL_INTERVAL, use_inotify=True):
+        self.paths = [os.path.abspath(str(path)) for path in paths]
+        self.walker = walker
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify
+        # Folders walked, and files given by themselves
+        self.roots = [path for path in self.paths if os.path.isdir(path)]
+        self.files = [path for path in self.paths if path not in self.roots]
+        # (size, mtime_ns) by file path
+        self.snapshot = {}
+        # Folders listed, they are watched
+        self.folders = set()
+        self.backend = None
+        # start() walked every path
+        self.started = False
+        # What to list again on the first changes() round, see start()
+        self.unsettled = set()
+        self.stats = {'events': 0, 'changed': 0, 'removed': 0, 'reports': 0}
+
+    def start(self, cancel=None):
+        '''
+        Starts watching, yields the files found in paths as the walker
+        yields them, so they can be scanned while the walk goes on.
+
+        Each folder is watched once it has been listed, files added or
+        changed in between are found by listing the paths again on the
+        first changes() round, once every folder is watched.
+        '''
+        self.close()
+        if self.use_inotify and os.name == 'posix':
+            try:
+                self.backend = Inotify(self.walker.follow_symlinks)
+            except (OSError, AttributeError) as e:
+                logger.debug(f"Polling for changes, inotify unavailable: {e}")
+        if self.backend is None:
+            self.backend = Poller(self.poll_interval)
+        self.backend.rescan = self.rescan()
+        self.started = False
+
+        self.folders = set()
+        folders = []
+        watched = 0
+        for filename in self.walker.walk(self.paths, cancel=cancel, folders=folders):
+            # The folder of a file is listed before the file is yielded
+            self.watch(folders[watched:])
+            watched = len(folders)
+            if self.stat(filename) is not None:
+                yield filename
+        self.watch(folders[watched:])
+        # Files given by themselves are watched through their folder
+        self.watch([os.path.dirname(filename) for filename in self.files])
+        self.unsettled = self.rescan()
+        self.started = True
+
+    def rescan(self):
+        '''
+        Returns what to list again when events may have been missed.
+        '''
+        return {(root, True) for root in self.roots} | {(os.path.dirname(filename), False) for filename in self.files}
+
+    def watch(self, folders):
+        for folder in folders:
+            if folder in self.folders:
+                continue
+            self.folders.add(folder)
+            try:
+                self.backend.add(folder)
+            except OSError as e:
+                logger.warning(f"{e}, polling for changes instead")
+                self.backend.close()
+                self.backend = Poller(self.poll_interval)
+                self.backend.rescan = self.rescan()
+
+    def stat(self, filename):
+        '''
+        Records filename in the snapshot, returns its (size, mtime_ns) or
+        None if it cannot be read.
+        '''
+        try:
+            stat = os.stat(filename, follow_symlinks=self.walker.follow_symlinks)
+        except OSError:
+            self.snapshot.pop(filename, None)
+            return None
+        key = self.snapshot[filename] = (stat.st_size, stat.st_mtime_ns)
+        return key
+
+    def root_of(self, path):
+        for root in self.roots:
+            if path == root or path.startswith(root + os.sep):
+                return root
+        return None
+
+    def compare(self, filenames, known, changed, removed):
+        '''
+        Compares the files now in a folder (filenames) with the files of the
+        snapshot that were in it (known).
+        '''
+        for filename in filenames:
+            before = self.snapshot.get(filename)
+            after = self.stat(filename)
+            if after is not None and after != before:
+                changed.add(filename)
+        for filename in set(known).difference(filenames):
+            self.snapshot.pop(filename, None)
+            removed.add(filename)
+
+    def forget(self, folder, removed):
+        '''
+        Drops a folder that is gone, or no longer passes the walker rules,
+        with everything it held.
+        '''
+        prefix = folder + os.sep
+        for filename in [filename for filename in self.snapshot if filename.startswith(prefix)]:
+            del self.snapshot[filename]
+            removed.add(filename)
+        self.folders = {path for path in self.folders if path != folder and not path.startswith(prefix)}
+
+    def resolve(self, dirty):
+        '''
+        Lists the folders marked by events again, (path, recursive) tuples,
+        and returns what changed.
+        '''
+        changed = set()
+        removed = set()
+        queue = deque(sorted(dirty))
+        while queue:
+            folder, recursive = queue.popleft()
+            root = self.root_of(folder)
+            if root is None:
+                # The folder of files given by themselves
+                for filename in self.files:
+                    if os.path.dirname(filename) == folder:
+                        known = [filename] if filename in self.snapshot else []
+                        self.compare([filename] if os.path.isfile(filename) else [], known, changed, removed)
+                continue
+
+            if not os.path.isdir(folder):
+                self.forget(folder, removed)
+                continue
+
+            if recursive:
+                folders = []
+                filenames = list(self.walker.walk([folder], root=root, folders=folders))
+                prefix = folder + os.sep
+                self.compare(filenames, [filename for filename in self.snapshot if filename.startswith(prefix)], changed, removed)
+                self.folders = {path for path in self.folders if not path.startswith(prefix)}
+                self.watch(folders)
+                continue
+
+            relative = os.path.relpath(folder, root)
+            depth = 0 if relative == "." else relative.count(os.sep) + 1
+            try:
+                filenames, subfolders, ignored = self.walker.list_folder(folder, "" if depth == 0 else relative.replace(os.sep, "/"), depth, os.stat(root).st_dev)
+            except OSError as e:
+                logger.debug(f"Unable to list {folder}: {e}")
+                continue
+            known = [filename for filename in self.snapshot if os.path.dirname(filename) == folder]
+            self.compare(filenames, known, changed, removed)
+            subfolders = {subfolder for subfolder, subfolder_relative, subfolder_depth in subfolders}
+            for subfolder in [path for path in self.folders if os.path.dirname(path) == folder and path not in subfolders]:
+                self.forget(subfolder, removed)
+            for subfolder in sorted(subfolders.difference(self.folders)):
+                # Created or moved in, with whatever it already holds
+                queue.append((subfolder, True))
+        return Changes(sorted(changed), sorted(removed))
+
+    def changes(self, cancel=None):
+        '''
+        Yields a Changes for each burst of activity, until cancel (an
+        optional threading.Event) is set or the generator is closed.
+        '''
+        if not self.started:
+            for filename in self.start(cancel):
+                pass
+        dirty = self.unsettled
+        self.unsettled = set()
+        first = last = time.monotonic() if dirty else None
+        try:
+            while cancel is None or not cancel.is_set():
+                now = time.monotonic()
+                timeout = CANCEL_POLL
+                if dirty:
+                    timeout = max(min(timeout, last + self.debounce - now, first + self.max_delay - now), 0)
+                events = self.backend.read(timeout)
+                now = time.monotonic()
+                if events:
+                    self.stats['events'] += len(events)
+                    dirty.update(events)
+                    last = now
+                    if first is None:
+                        first = now
+                if dirty and (now - last >= self.debounce or now - first >= self.max_delay):
+                    with iconprofile.stage("watch_resolve"):
+                        changes = self.resolve(dirty)
+                    dirty = set()
+                    first = last = None
+                    if changes:
+                        self.stats['changed'] += len(changes.changed)
+                        self.stats['removed'] += len(changes.removed)
+                        self.stats['reports'] += 1
+                        logger.debug(f"{changes}")
+                        yield changes
+        finally:
+            self.close()
+
+    def close(self):
+        self.started = False
+        if self.backend is not None:
+            self.backend.close()
+            self.backend = None
@@ -1,11 +1,14 @@
+import fnmatch
+import itertools
 import logging
+import mmap
 import struct 
-import pefile
 import sys
-from icoextract import IconExtractor
 import os
 from pprint import pprint
 
+import iconprofile
+
 '''
 ICO Python Library
 ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -54,31 +57,480 @@ __icotool_version__ = __version__
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
+# NE resource table layouts
+TYPEINFO = struct.Struct('<HHI') # rtTypeID, rtResourceCount, rtReserved
+NAMEINFO = struct.Struct('<HHHHHH') # rnOffset, rnLength, rnFlags, rnID, rnHandle, rnUsage
+GRPICONDIR = struct.Struct('<HHH') # idReserved, idType, idCount
+GRPICONDIRENTRY_LAYOUT = struct.Struct('<BBBBHHLH') # bWidth, bHeight, bColorCount, bReserved, wPlanes, wBitCount, dwBytesInRes, nId
+# The first 12 bytes shared by ICONDIRENTRY and GRPICONDIRENTRY
+ICONDIRENTRY_LAYOUT = struct.Struct('<BBBBHHL') # bWidth, bHeight, bColorCount, bReserved, wPlanes, wBitCount, dwBytesInRes
+# ICONDIR of an ICO file holding one image, followed by its ICONDIRENTRY
+# (the 12 bytes above plus the image offset, 22)
+ICO_HEADER = struct.pack('<HHH', 0, 1, 1)
+ICO_IMAGE_OFFSET = struct.pack('<L', 22)
+# Images starting with it are PNG streams (Windows Vista and later icons)
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# Size of the header read by sniff_filetype, enough for the ICONDIR and the
+# DOS header e_lfanew field
+SNIFF_BYTES = 64
+
+def sniff_filetype(filename):
+    '''
+    Determines the icon file type of filename by reading only its headers:
+    the first SNIFF_BYTES bytes and, for executables, the two byte signature
+    at e_lfanew. Returns "ICO", "NE" or "PE", or None if the file cannot
+    contain icons (or cannot be read).
+    '''
+    try:
+        with open(filename, 'rb') as f:
+            header = f.read(SNIFF_BYTES)
+            if len(header) < 6:
+                return None
+            idReserved, idType, idCount = struct.unpack_from('<HHH', header, 0)
+            if idReserved == 0:
+                # ICONS ONLY NO CURSORS
+                if idType == 1 and idCount > 0:
+                    return "ICO"
+                return None
+            if len(header) < SNIFF_BYTES:
+                return None
+            e_lfanew = struct.unpack_from('<I', header, 60)[0]
+            f.seek(e_lfanew)
+            header_char = f.read(2)
+    except OSError as e:
+        logger.debug(f"Unable to sniff {filename}: {e}")
+        return None
+
+    if header_char == b"NE":
+        return "NE"
+    if header_char == b"PE":
+        return "PE"
+    return None
+
+# Largest e_lfanew sniff_stream reads up to
+MAX_SNIFF_OFFSET = 1 << 20
+
+def sniff_stream(f):
+    '''
+    Like sniff_filetype for a file object that can only be read forward,
+    such as an archive member. Returns (filetype, bytes read so far), the
+    rest of the file is f.read().
+    '''
+    header = f.read(SNIFF_BYTES)
+    if len(header) < 6:
+        return None, header
+    idReserved, idType, idCount = struct.unpack_from('<HHH', header, 0)
+    if idReserved == 0:
+        return ("ICO" if idType == 1 and idCount > 0 else None), header
+    if len(header) < SNIFF_BYTES:
+        return None, header
+    e_lfanew = struct.unpack_from('<I', header, 60)[0]
+    if e_lfanew > MAX_SNIFF_OFFSET:
+        return None, header
+    if e_lfanew + 2 > len(header):
+        header += f.read(e_lfanew + 2 - len(header))
+    header_char = header[e_lfanew:e_lfanew + 2]
+    if header_char == b"NE":
+        return "NE", header
+    if header_char == b"PE":
+        return "PE", header
+    return None, header
+
+def rank_icon(icon):
+    '''
+    Ranks an icon using only its directory entry: bits per pixel first (from
+    wBitCount, or the color count when it is not set), then size. Higher is
+    better.
+    '''
+    if isinstance(icon, IconRecord):
+        bits = icon.wBitCount
+    else:
+        bits = icon['rtIconDirEntry']['wBitCount']
+    if not bits:
+        bits = max(icon['Colors'] - 1, 1).bit_length()
+    return (bits, icon['Width'], icon['Height'])
+
+def icon_image(icon):
+    '''
+    Returns the image of an icon (its DIB or PNG stream) without copying it,
+    from an IconRecord or from the single image ICO file in 'ICON'.
+    '''
+    image = getattr(icon, 'image', None)
+    if image is not None:
+        return image
+    ico = memoryview(icon['ICON'])
+    # dwImageOffset of the only ICONDIRENTRY
+    return ico[struct.unpack_from('<L', ico, 18)[0]:]
+
+def icon_png(icon):
+    '''
+    Returns the PNG stream of icon if its image is PNG compressed, otherwise
+    None. The stream is a complete PNG file and can be written out as is.
+    '''
+    image = icon_image(icon)
+    if bytes(image[:8]) != PNG_SIGNATURE:
+        return None
+    return bytes(image)
+
+class IconFilter:
+    '''
+    Which icons to extract. Each icon is checked against its directory
+    entry before its image is copied out of the file (let alone decoded),
+    and each group icon before its entries are read:
+
+    min_width, max_width: width in pixels, 0 for no limit
+    min_bits, max_bits: bits per pixel (wBitCount, or from the color count
+                        when it is not set, see rank_icon), 0 for no limit
+    min_colors: number of colors (256 for 8 bits and above), 0 for no limit
+    formats: the image formats kept, "png" and/or "dib", None for both
+    groups: glob patterns, only the group icons whose id or name matches
+            one are read: the index and resource id of PE groups, the id
+            and name of NE groups. ICO files have no groups.
+
+    Pass it as wanted to IcoTool.iter_icons and iter_best, or as
+    icon_filter to extract_all and extract_best. self.stats counts the
+    icons 'kept' and 'skipped', the image bytes of the icons skipped
+    ('skipped_bytes') and the 'skipped_groups'.
+    '''
+
+    def __init__(self, min_width=0, max_width=0, min_bits=0, max_bits=0, min_colors=0, formats=None, groups=None):
+        self.min_width = min_width
+        self.max_width = max_width
+        self.min_bits = min_bits
+        self.max_bits = max_bits
+        self.min_colors = min_colors
+        self.formats = set(formats) if formats else None
+        self.groups = list(groups) if groups else None
+        self.stats = {'kept': 0, 'skipped': 0, 'skipped_bytes': 0, 'skipped_groups': 0}
+
+    @property
+    def active(self):
+        '''
+        False if the filter keeps every icon.
+        '''
+        return bool(self.min_width or self.max_width or self.min_bits or self.max_bits or self.min_colors or self.formats or self.groups)
+
+    def wanted(self, icon):
+        width = icon['Width']
+        if (self.min_width and width < self.min_width) or (self.max_width and width > self.max_width):
+            return False
+        if self.min_colors and icon['Colors'] < self.min_colors:
+            return False
+        if self.min_bits or self.max_bits:
+            bits = rank_icon(icon)[0]
+            if (self.min_bits and bits < self.min_bits) or (self.max_bits and bits > self.max_bits):
+                return False
+        if self.formats is not None:
+            # Only the start of the image is known, see IcoTool.icon_record
+            image_format = "png" if bytes(icon_image(icon)[:8]) == PNG_SIGNATURE else "dib"
+            if image_format not in self.formats:
+                return False
+        return True
+
+    def __call__(self, icon):
+        if self.wanted(icon):
+            self.stats['kept'] += 1
+            return True
+        self.stats['skipped'] += 1
+        # dwBytesInRes
+        self.stats['skipped_bytes'] += struct.unpack_from('<L', icon.entry, 8)[0]
+        return False
+
+    def wanted_group(self, *keys):
+        '''
+        Returns True if the group icon with keys (its ids and name, None
+        for unknown ones) is read.
+        '''
+        if self.groups is None:
+            return True
+        for key in keys:
+            if key is not None and any(fnmatch.fnmatchcase(str(key), pattern) for pattern in self.groups):
+                return True
+        self.stats['skipped_groups'] += 1
+        return False
+
+    def collect(self):
+        '''
+        Returns the counters so far and resets them.
+        '''
+        stats = self.stats
+        self.stats = dict.fromkeys(stats, 0)
+        return stats
+
+class IconRecord:
+    '''
+    One icon image. Behaves like the dict extract_all has always returned
+    (icon['Width'], icon.get('index'), dict(icon), ...) and the same keys
+    are also attributes (icon.Width).
+
+    Only the raw 12 byte directory entry, the image bytes and a few ids are
+    stored. 'filename' and 'rtIconDirEntry' are built when they are looked
+    up, the 'ICON' file the first time it is and kept until the image
+    changes (it is not pickled), and the name strings are shared by every
+    icon of a file. Other keys (like 'RGBA' set by the scan engine) can be assigned
+    as on a dict.
+
+    nId is set for icons from NE files: their rtIconDirEntry holds the
+    RT_ICON id instead of the image offset and, as before, only the color
+    count of their entry is adjusted.
+    '''
+
+    __slots__ = ('name', 'ID', 'index', 'entry', 'dwImageOffset', 'nId', 'original_filename', '_image', '_ico', 'extra')
+
+    def __init__(self, name, ID, entry, original_filename, index=None, dwImageOffset=0, nId=None, image=None):
+        self.name = name
+        self.ID = ID
+        self.index = index
+        self.entry = entry
+        self.dwImageOffset = dwImageOffset
+        self.nId = nId
+        self.original_filename = original_filename
+        self.image = image
+        self.extra = None
+
+    @property
+    def image(self):
+        return self._image
+
+    @image.setter
+    def image(self, image):
+        self._image = image
+        self._ico = None
+
+    def __getstate__(self):
+        # The ICO file is built again where it is needed, scan workers
+        # would otherwise send every image twice
+        return (None, {slot: getattr(self, slot) for slot in self.__slots__ if slot != '_ico'})
+
+    def __setstate__(self, state):
+        for slot, value in state[1].items():
+            setattr(self, slot, value)
+        self._ico = None
+
+    @property
+    def Width(self):
+        return self.entry[0] or (256 if self.nId is None else 0)
+
+    @property
+    def Height(self):
+        return self.entry[1] or (256 if self.nId is None else 0)
+
+    @property
+    def Colors(self):
+        return self.entry[2] or 256
+
+    @property
+    def wBitCount(self):
+        return self.entry[6] | self.entry[7] << 8
+
+    @property
+    def filename(self):
+        if self.index is not None:
+            return f"{self.name}_{self.index}_{self.ID}_{self.Width}x{self.Height}x{self.Colors}.ico"
+        return f"{self.name}_{self.ID}_{self.Width}x{self.Height}x{self.Colors}.ico"
+
+    @property
+    def rtIconDirEntry(self):
+        bWidth, bHeight, bColorCount, bReserved, wPlanes, wBitCount, dwBytesInRes = ICONDIRENTRY_LAYOUT.unpack(self.entry)
+        entry = {
+            'bWidth'       : self.Width, # Width, in pixels, of the image
+            'bHeight'      : self.Height, # Height, in pixels, of the image
+            'bColorCount'  : self.Colors, # Number of colors in image (0 if >=8bpp)
+            'bReserved'    : bReserved, # Reserved
+            'wPlanes'      : wPlanes, # Color Planes
+            'wBitCount'    : wBitCount, # Bits per pixel
+            'dwBytesInRes' : dwBytesInRes, # how many bytes in this resource?
+        }
+        if self.nId is None:
+            entry['dwImageOffset'] = self.dwImageOffset # Offset of the image in the ICO file
+        else:
+            entry['nId'] = self.nId # RT_ICON rnID
+        return entry
+
+    @property
+    def png(self):
+        '''
+        The PNG stream of the icon if its image is PNG compressed, otherwise
+        None.
+        '''
+        if self.image is not None and self.image[:8] == PNG_SIGNATURE:
+            return self.image
+        return None
+
+    @property
+    def ICON(self):
+        '''
+        The icon as an ICO file holding only this image.
+        '''
+        if self.image is None:
+            raise AttributeError("ICON")
+        if self._ico is None:
+            self._ico = ICO_HEADER + self.entry + ICO_IMAGE_OFFSET + self.image
+        return self._ico
+
+    def keys(self):
+        keys = ['filename', 'ID', 'Width', 'Height', 'Colors', 'original_filename', 'rtIconDirEntry']
+        if self.index is not None:
+            keys.append('index')
+        if self.image is not None:
+            keys.append('ICON')
+        if self.extra:
+            keys.extend(key for key in self.extra if key not in keys)
+        return keys
+
+    def __getitem__(self, key):
+        if self.extra and key in self.extra:
+            return self.extra[key]
+        if key in ('filename', 'ID', 'Width', 'Height', 'Colors', 'original_filename', 'rtIconDirEntry'):
+            return getattr(self, key)
+        if key == 'index' and self.index is not None:
+            return self.index
+        if key == 'ICON' and self.image is not None:
+            return self.ICON
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if self.extra is None:
+            self.extra = {}
+        self.extra[key] = value
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def __eq__(self, other):
+        if isinstance(other, (IconRecord, dict)):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"IconRecord({self.filename!r}, original_filename={self.original_filename!r})"
+
+def iter_icons(paths, wanted=None, use_mmap=True):
+    '''
+    Yields the icons of every file in paths one at a time, see
+    IcoTool.iter_icons. Files that cannot hold icons are skipped after
+    reading their headers, files that cannot be parsed are skipped.
+    '''
+    for path in paths:
+        path = str(path)
+        if not sniff_filetype(path):
+            continue
+        try:
+            tool = IcoTool(path, use_mmap=use_mmap)
+        except Exception as e:
+            logger.debug(f"Unable to open {path}: {e}")
+            continue
+        with tool:
+            try:
+                yield from tool.iter_icons(wanted)
+            except Exception as e:
+                logger.debug(f"Unable to parse {path}: {e}")
+
 class IcoTool:
-    def __init__(self, filename, output_folder=None):
+    def __init__(self, filename, output_folder=None, use_mmap=False, data=None):
+        '''
+        Opens filename and determines its icon file type.
+
+        With use_mmap the file is memory mapped instead of read into memory,
+        headers and resource tables are parsed in place and only the bytes
+        of the icon images returned are copied out of the file. Call close()
+        (or use IcoTool as a context manager) to release the mapping.
+
+        data: the contents of the file when it is already in memory (for
+              example an archive member), filename is then only used to
+              name the icons
+        '''
         self.filename = filename
         self.output_folder = output_folder
         if output_folder and output_folder[-1] != '/':
             self.output_folder += "/"
+        self._mmap = None
+        if data is not None:
+            self.file_bytes = data
+        else:
+            self.read(filename, use_mmap)
+        self.cur_file = self.file_bytes
+        try:
+            with iconprofile.stage("filetype"):
+                self.determine_filetype()
+        except Exception:
+            self.close()
+            raise
+
+    def read(self, filename, use_mmap):
         logger.debug("Reading {}".format(filename))
-        with open(filename,'rb') as f:
-            self.cur_file = f.read()
-            self.file_bytes = bytearray(self.cur_file)
-        self.determine_filetype()
+        with iconprofile.stage("read") as timer, open(filename,'rb') as f:
+            if use_mmap:
+                try:
+                    self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                except ValueError:
+                    # Empty files cannot be mapped
+                    logger.debug(f"Unable to mmap {filename}, reading instead")
+            if self._mmap is not None:
+                self.file_bytes = self._mmap
+            else:
+                self.file_bytes = f.read()
+            timer.nbytes = len(self.file_bytes)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        '''
+        Releases the memory mapping, if any. Icons already returned are
+        independent copies and remain valid.
+        '''
+        if self._mmap is not None:
+            logger.debug(f"Closing mmap of {self.filename}")
+            try:
+                self._mmap.close()
+            except BufferError:
+                # Views into the mapping are still referenced (for example
+                # by a traceback), it is unmapped once they are released
+                logger.debug(f"mmap of {self.filename} still in use")
+            self._mmap = None
+            self.file_bytes = self.cur_file = b''
 
     def set_output_folder(self, output_folder):
         logger.debug(f"Setting output folder to: {output_folder}")
         self.output_folder = output_folder
 
     def determine_filetype(self):
-        idReserved = struct.unpack('<H',self.file_bytes[0:2])[0]
-        idType = struct.unpack('<H',self.file_bytes[2:4])[0]
+        idReserved, idType = struct.unpack_from('<HH',self.file_bytes, 0)
 
         self.icontype = "ICO"
 
         if idReserved != 0:
-            e_lfanew =  struct.unpack('<I',self.file_bytes[60:64])[0]
-            header_char = self.file_bytes[e_lfanew:e_lfanew+2].decode()
+            e_lfanew =  struct.unpack_from('<I',self.file_bytes, 60)[0]
+            header_char = self.file_bytes[e_lfanew:e_lfanew+2].decode(errors='replace')
 
             if header_char not in ["NE","PE"]:
                 logger.debug(f"File {self.filename} is not ICO, ICL, EXE, or DLL")
@@ -92,232 +544,362 @@ class IcoTool:
         logger.debug(f"Filetype is {self.icontype}")
 
     def extract_ico(self, index=None):
+        return list(self.iter_ico(index))
+
+    def iter_ico(self, index=None, wanted=None):
+        '''
+        Yields the icons of an ICO file one at a time, see iter_icons.
+        '''
         logger.debug("Reading ICO file {}. Output Folder: {}. Index: {}".format(self.filename, self.output_folder, index))
-        cur_bytes = bytearray(self.cur_file)
+        cur_bytes = self.cur_file
 
-        if cur_bytes[0:2].decode() == "BM":
-            raise "File provided is a bitmap"
+        if cur_bytes[0:2] == b"BM":
+            raise Exception("File provided is a bitmap")
 
-        rtIconDir = False
-        rtIconDirEntry = False
-        ICONS = []
-        
-        idReserved = struct.unpack('<H',cur_bytes[0:2])[0]
-        idType = struct.unpack('<H',cur_bytes[2:4])[0]
-        idCount = struct.unpack('<H',cur_bytes[4:6])[0]
+        idReserved, idType, idCount = struct.unpack_from('<HHH',cur_bytes, 0)
         loc = 6
         if idType == 1: # ICONS ONLY NO CURSORS
             name = os.path.splitext(os.path.basename(self.filename))[0]
             for i in range(0,idCount):
                 
                 #ICONDIRENTRY
+                dwBytesInRes, dwImageOffset = struct.unpack_from('<LL',cur_bytes, loc+8)
+                icon = self.icon_record(name, i, cur_bytes[loc:loc+12], dwImageOffset, cur_bytes, dwImageOffset, dwBytesInRes, index, wanted)
+                if icon is not None:
+                    yield icon
 
-                rtIconDirEntry = {
-                    'bWidth'       : cur_bytes[loc], # Width, in pixels, of the image
-                    'bHeight'      : cur_bytes[loc+1], # Height, in pixels, of the image
-                    'bColorCount'  : cur_bytes[loc+2], # Number of colors in image (0 if >=8bpp)
-                    'bReserved'    : cur_bytes[loc+3], # Reserved
-                    'wPlanes'      : struct.unpack('<H',cur_bytes[loc+4:loc+6])[0], # Color Planes
-                    'wBitCount'    : struct.unpack('<H',cur_bytes[loc+6:loc+8])[0], # Bits per pixel
-                    'dwBytesInRes' : struct.unpack('<L',cur_bytes[loc+8:loc+12])[0], # how many bytes in this resource?
-                    'dwImageOffset'  : struct.unpack('<L',cur_bytes[loc+12:loc+16])[0] # RT_ICON rnID
-                }
-                
-                
-                ICONHEADER = bytearray(2) + struct.pack('<H',1) + struct.pack('<H',1)
-                IconDirectoryEntry = cur_bytes[loc:loc+12] + struct.pack('<L', 22)
-                img = cur_bytes[rtIconDirEntry['dwImageOffset']:rtIconDirEntry['dwImageOffset']+rtIconDirEntry['dwBytesInRes']]
+                loc += 16
 
-                if rtIconDirEntry['bColorCount'] == 0: rtIconDirEntry['bColorCount'] = 256
-                if rtIconDirEntry['bWidth'] == 0: rtIconDirEntry['bWidth'] = 256
-                if rtIconDirEntry['bHeight'] == 0: rtIconDirEntry['bHeight'] = 256
+    def icon_record(self, name, i, entry, dwImageOffset, buffer, offset, size, index=None, wanted=None):
+        '''
+        Builds the IconRecord returned for one icon image from the first 12
+        bytes of its ICONDIRENTRY (or GRPICONDIRENTRY) and the size bytes of
+        its image at offset in buffer, and writes it to the output folder if
+        one is set.
 
-                if index is not None:
-                    filename = "{}_{}_{}_{}x{}x{}.ico".format(name, index, i, rtIconDirEntry['bWidth'], rtIconDirEntry['bHeight'], rtIconDirEntry['bColorCount'])
-                else:
-                    filename = "{}_{}_{}x{}x{}.ico".format(name, i, rtIconDirEntry['bWidth'], rtIconDirEntry['bHeight'], rtIconDirEntry['bColorCount'])
-                logger.debug(f"Export Filename:{filename}")
-                if self.output_folder:
-                    logger.info("Creating:", self.output_folder + filename)
-                    f = open(self.output_folder + filename,"wb")
-                    f.write(ICONHEADER+IconDirectoryEntry+img)
-                    f.close()
-                
-                icon_dict = {
-                    'filename': filename, 
-                    'ID'      : i,
-                    'Width'   : rtIconDirEntry['bWidth'],
-                    'Height'  : rtIconDirEntry['bHeight'],
-                    'Colors'  : rtIconDirEntry['bColorCount'],
-                    'ICON': ICONHEADER+IconDirectoryEntry+img,
-                    'original_filename' : self.filename,
-                    'rtIconDirEntry' : rtIconDirEntry
-                }
-                
-                if index is not None:
-                    icon_dict['index'] = index
+        If wanted is given it is called with the record before the image is
+        copied (its image is only the first 8 bytes, enough to tell PNG
+        images apart), when it returns False None is returned instead.
+        '''
+        icon = IconRecord(name, i, bytes(entry), self.filename, index, dwImageOffset)
 
-                ICONS.append(icon_dict)
+        if wanted is not None:
+            # Enough of the image for wanted to tell PNG from DIB images
+            icon.image = bytes(buffer[offset:offset+8])
+            if not wanted(icon):
+                return None
 
-                loc += 16
+        icon.image = bytes(buffer[offset:offset+size])
+
+        logger.debug(f"Export Filename:{icon.filename}")
+        if self.output_folder:
+            logger.info(f"Creating: {self.output_folder + icon.filename}")
+            with open(self.output_folder + icon.filename,"wb") as f:
+                f.write(icon.ICON)
+
+        return icon
+
+    def pe_resources(self):
+        '''
+        Walks the resource directory (.rsrc) of a PE file in place, without
+        parsing the rest of the file.
+
+        Returns a dict with the RT_GROUP_ICON (14) and RT_ICON (3) resources,
+        each a list of (id, file offset, size) tuples in directory order. Only
+        the first language of each resource is used and named resources have
+        an id of None.
+        '''
+        pe_bytes = self.file_bytes
+        e_lfanew = struct.unpack_from('<I', pe_bytes, 60)[0]
+        NumberOfSections, SizeOfOptionalHeader = struct.unpack_from('<H12xH', pe_bytes, e_lfanew+6)
+        optional_header = e_lfanew + 24
+        Magic = struct.unpack_from('<H', pe_bytes, optional_header)[0]
+        FileAlignment = struct.unpack_from('<I', pe_bytes, optional_header+36)[0]
+        if Magic == 0x20b: # PE32+
+            NumberOfRvaAndSizes = struct.unpack_from('<I', pe_bytes, optional_header+108)[0]
+            data_directory = optional_header + 112
+        else:
+            NumberOfRvaAndSizes = struct.unpack_from('<I', pe_bytes, optional_header+92)[0]
+            data_directory = optional_header + 96
+
+        resources = {3: [], 14: []}
+        if NumberOfRvaAndSizes < 3:
+            return resources
+        # IMAGE_DIRECTORY_ENTRY_RESOURCE
+        rsrc_rva = struct.unpack_from('<I', pe_bytes, data_directory + 16)[0]
+        if not rsrc_rva:
+            return resources
+
+        sections = []
+        section_table = optional_header + SizeOfOptionalHeader
+        for i in range(NumberOfSections):
+            # VirtualSize, VirtualAddress, SizeOfRawData, PointerToRawData
+            sections.append(struct.unpack_from('<8xIIII', pe_bytes, section_table + i*40))
+
+        def rva_to_offset(rva):
+            for VirtualSize, VirtualAddress, SizeOfRawData, PointerToRawData in sections:
+                if VirtualAddress <= rva < VirtualAddress + max(VirtualSize, SizeOfRawData):
+                    # Same FileAlignment rounding as the Windows loader
+                    if FileAlignment >= 0x200:
+                        PointerToRawData = PointerToRawData // 0x200 * 0x200
+                    return rva - VirtualAddress + PointerToRawData
+            return rva
+
+        rsrc = rva_to_offset(rsrc_rva)
+
+        def directory(offset):
+            # IMAGE_RESOURCE_DIRECTORY followed by its entries
+            NumberOfNamedEntries, NumberOfIdEntries = struct.unpack_from('<HH', pe_bytes, rsrc + offset + 12)
+            for i in range(NumberOfNamedEntries + NumberOfIdEntries):
+                Name, OffsetToData = struct.unpack_from('<II', pe_bytes, rsrc + offset + 16 + i*8)
+                rsrc_id = None if Name & 0x80000000 else Name & 0xFFFF
+                yield rsrc_id, OffsetToData
+
+        type_dirs = {}
+        for rsrc_id, OffsetToData in directory(0):
+            # The first entry of a type takes precedence
+            if rsrc_id in resources and rsrc_id not in type_dirs and OffsetToData & 0x80000000:
+                type_dirs[rsrc_id] = OffsetToData & 0x7FFFFFFF
+
+        for rsrc_type, type_dir in type_dirs.items():
+            for rsrc_id, OffsetToData in directory(type_dir):
+                if OffsetToData & 0x80000000:
+                    # Select the first language
+                    for language, OffsetToData in directory(OffsetToData & 0x7FFFFFFF):
+                        break
+                    else:
+                        continue
+                    if OffsetToData & 0x80000000:
+                        continue
+                # IMAGE_RESOURCE_DATA_ENTRY
+                data_rva, data_size = struct.unpack_from('<II', pe_bytes, rsrc + OffsetToData)
+                resources[rsrc_type].append((rsrc_id, rva_to_offset(data_rva), data_size))
+
+        return resources
+
+    def pe_group_entries(self, offset, rt_icons):
+        '''
+        Parses the RT_GROUP_ICON resource at offset. Returns a list with, for
+        each image, the first 12 bytes of its ICONDIRENTRY, the offset of the
+        image in the equivalent ICO file and the file offset and size of its
+        RT_ICON. rt_icons maps RT_ICON ids to (file offset, size).
+        '''
+        pe_bytes = self.file_bytes
+        idReserved, idType, idCount = GRPICONDIR.unpack_from(pe_bytes, offset)
+        if idReserved:
+            raise ValueError(f"Invalid group icon definition (got Reserved={hex(idReserved)} instead of 0)")
+
+        # Offset of each image in the equivalent ICO file
+        dwImageOffset = 6 + idCount * 16
+        entries = []
+        for i in range(idCount):
+            # GRPICONDIRENTRY
+            loc = offset + GRPICONDIR.size + i*GRPICONDIRENTRY_LAYOUT.size
+            nId = struct.unpack_from('<H', pe_bytes, loc+12)[0]
+            # When the dwBytesInRes of the group entry and the size of the
+            # RT_ICON disagree, the RT_ICON size is authoritative: it is
+            # what the resource holds, and what Windows loads the image
+            # from. It replaces dwBytesInRes in the ICONDIRENTRY so the
+            # ICO file rebuilt declares the bytes it carries.
+            icon_offset, icon_size = rt_icons[nId]
+            entry = bytes(pe_bytes[loc:loc+8]) + struct.pack('<L', icon_size)
+            entries.append((entry, dwImageOffset, icon_offset, icon_size))
+            dwImageOffset += icon_size
+        return entries
+
+    def iter_pe_group(self, index, entries, wanted=None):
+        '''
+        Yields the icons of a PE group icon from its pe_group_entries, with
+        the same values extract_ico returns for the equivalent ICO file.
+        '''
+        pe_bytes = self.file_bytes
+        name = os.path.splitext(os.path.basename(self.filename))[0]
+        for i, (entry, dwImageOffset, icon_offset, icon_size) in enumerate(entries):
+            icon = self.icon_record(name, i, entry, dwImageOffset, pe_bytes, icon_offset, icon_size, index, wanted)
+            if icon is not None:
+                yield icon
+
+    def iter_pe_groups(self, wanted=None):
+        '''
+        Yields an iterator over the icons of each group icon of a PE file.
+        Groups that cannot be parsed are skipped, as are those the
+        wanted_group method of wanted (see IconFilter) rejects.
+        '''
+        wanted_group = getattr(wanted, 'wanted_group', None)
+        logger.debug("Parsing PE DLL/EXE")
+        try:
+            resources = self.pe_resources()
+        except struct.error as e:
+            logger.debug(f"Unable to parse PE resources: {e}")
+            return
+
+        rt_icons = {nId: (offset, size) for nId, offset, size in resources[3]}
 
-        return ICONS    
+        for idx, (grp_id, offset, size) in enumerate(resources[14]):
+            if wanted_group is not None and not wanted_group(idx, grp_id):
+                continue
+            try:
+                entries = self.pe_group_entries(offset, rt_icons)
+            except (struct.error, KeyError, ValueError) as e:
+                logger.debug(f"Skipping group icon {idx}: {e}")
+                continue
+            yield self.iter_pe_group(idx, entries, wanted)
+
+    def ne_header(self):
+        '''
+        Returns the offset of the NE header (e_lfanew).
+        '''
+        return struct.unpack_from('<I', self.file_bytes, 60)[0]
+
+    def ne_resources(self, e_lfanew):
+        '''
+        Parses the resource table of an NE file in place. Returns a dict with
+        the resources ('rscTypes', a list of NAMEINFO dicts), the resource
+        names ('rscResourceNames') and the RT_ICON resources indexed by rnID
+        ('rtIcons').
+        '''
+        group_type = { 3: 'RT_ICON', 14 :'RT_GROUP_ICON' }
+        dll_bytes = self.file_bytes
+
+        ne_rsrctab = struct.unpack_from('<H',dll_bytes, e_lfanew+36)[0] + e_lfanew
+        rscAlignShift = struct.unpack_from('<H',dll_bytes, ne_rsrctab)[0]
+        resource_table = {'rscAlignShift':rscAlignShift, 'rscTypes': [], 'rscEndTypes' : 0, 'rscResourceNames': [], 'rscEndNames': 0}
+
+        logger.debug("Offset from 0 to NE header (e_lfanew): {}".format(e_lfanew))
+        logger.debug("Parsing Resource Tables (ne_rsrctab) at {} ({})".format(ne_rsrctab, hex(ne_rsrctab)))
+
+        TNAMEINFO = []
+        ptr = ne_rsrctab+2 #Advance ptr to TYPEINFO
+        while True:
+            rttypeid, rtresourcecount, rtReserved = TYPEINFO.unpack_from(dll_bytes, ptr)
+            rttypeid &= 0x7FFF
+            if rttypeid == 0 or rttypeid > 24:
+                break # At the end of the type info array exit
+            ptr += TYPEINFO.size
+            if rttypeid in group_type:
+                logger.debug("Type ID {} has {} records ({}, {})".format(group_type[rttypeid], rtresourcecount, ptr, hex(ptr)))
+
+            for rnOffset, rnLength, rnFlags, rnID, rnHandle, rnUsage in NAMEINFO.iter_unpack(dll_bytes[ptr:ptr+rtresourcecount*NAMEINFO.size]):
+                TNAMEINFO.append( {
+                'rttypeid' : rttypeid,
+                'rnOffset' : rnOffset << rscAlignShift,
+                'rnLength' : rnLength,
+                'rnFlags'  : rnFlags,
+                'rnID'     : rnID & 0x7FFF,
+                'rnHandle' : rnHandle,
+                'rnUsage'  : rnUsage
+                } )
+            ptr += rtresourcecount*NAMEINFO.size # Skip to the next TYPEINFO
+            if rttypeid == 24:
+                break
+
+        ptr = ptr + 2 # rscEndTypes
+        #Resource Names
+        RESOURCENAMES = []
+        length = 1
+        while length != 0:
+            length = dll_bytes[ptr]
+            try:
+                RESOURCENAMES.append(bytes(dll_bytes[ptr+1:ptr+1+length]).decode())
+            except UnicodeDecodeError:
+                logger.debug("Could not decode resource name, unicode error")
+            ptr += length + 1
+        
+        resource_table['rscResourceNames'].extend(RESOURCENAMES)
+        resource_table['rscTypes'].extend(TNAMEINFO)
+
+        # Index the RT_ICON resources by rnID once, so resolving a group
+        # entry does not scan the whole resource table
+        rt_icons = {}
+        for RT_ICON in resource_table['rscTypes']:
+            if RT_ICON['rttypeid'] == 3: #RT_ICON
+                rt_icons.setdefault(RT_ICON['rnID'], []).append(RT_ICON)
+        resource_table['rtIcons'] = rt_icons
+        return resource_table
 
     def extract_icons_from_dll(self):
-        # This function extracts icons from "NE" DLL files (and ICL files)
+        # This function extracts icons from "NE" DLL files (and ICL files) and "PE" DLL/EXE files
         # Returns a list of dicts with the file name containing the name, index, width, height, colors and the icon itself
+        # For PE files it returns a list of lists of dicts, one list per group icon
+
+        if self.icontype == "PE":
+            return [list(group) for group in self.iter_pe_groups()]
+        return list(self.iter_ne())
+
+    def iter_ne(self, wanted=None, wanted_group=None, resource_table=None):
+        '''
+        Yields the icons of an NE DLL/ICL file one at a time, see iter_icons.
+        Group icons wanted_group (by default the method of wanted, see
+        IconFilter) rejects are skipped. resource_table is what
+        ne_resources returned, when it was already parsed.
+        '''
+        if wanted_group is None:
+            wanted_group = getattr(wanted, 'wanted_group', None)
         # This is kludgy as hell but it works
 
         # Mostly built off of:
         # https://www.codeproject.com/Articles/16178/IconLib-Icons-Unfolded-MultiIcon-and-Windows-Vista
         # https://hwiegman.home.xs4all.nl/fileformats/exe/WINHDR.TXT
 
-        group_type = { 3: 'RT_ICON', 14 :'RT_GROUP_ICON' }
-        ICONS = []
-
-        dll_bytes = self.file_bytes
+        # A memoryview lets the icon images below be sliced without copying,
+        # they are only copied once when each ICON is assembled
+        dll_bytes = memoryview(self.file_bytes)
         
-        logger.debug("Reading DLL/ICL/EXE file") 
-        e_lfanew =  struct.unpack('<I',dll_bytes[60:64])[0]
-        ne_header_char = dll_bytes[e_lfanew:e_lfanew+2].decode()
-        logger.debug("Header Char: {}".format(ne_header_char))
-
-        if ne_header_char == 'NE':
-            logger.debug("Parsing NE DLL/ICL")
-
-            ne_rsrctab = struct.unpack('<H',dll_bytes[e_lfanew+36:e_lfanew+36+2] )[0] + e_lfanew
-            rscAlignShift = struct.unpack('<H',dll_bytes[ne_rsrctab:ne_rsrctab+2] )[0]
-            resource_table = {'rscAlignShift':rscAlignShift, 'rscTypes': [], 'rscEndTypes' : 0, 'rscResourceNames': [], 'rscEndNames': 0}
-
-            logger.debug("Offset from 0 to NE header (e_lfanew): {}".format(e_lfanew))
-            logger.debug("Parsing Resource Tables (ne_rsrctab) at {} ({})".format(ne_rsrctab, hex(ne_rsrctab)))
-
-            TNAMEINFO = []
-            ptr = ne_rsrctab+2 #Advance ptr to TYPEINFO
-            rttypeid = 1
-            while rttypeid != 0 and rttypeid < 24:
-                tmp_ba = dll_bytes[ptr:]
-                rttypeid = struct.unpack('<H',tmp_ba[0:2] )[0] & 0x7FFF
-                if rttypeid == 0 or rttypeid > 24: 
-                    continue # At the end of the type info array exit
-                rtresourcecount = struct.unpack('<H',tmp_ba[2:4] )[0]
-                tmp_ba = dll_bytes[ptr+8:]
-                if rttypeid in group_type:
-                    logger.debug("Type ID {} has {} records ({}, {})".format(group_type[rttypeid], rtresourcecount, ptr+8, hex(ptr+8)))
-
-                size = 0
-                for x in range(0, rtresourcecount):
-
-                    TNAMEINFO.append( {
-                    'rttypeid' : rttypeid,
-                    'rnOffset' : struct.unpack('<H',tmp_ba[size+ 0:size+2])[0] << rscAlignShift,
-                    'rnLength' : struct.unpack('<H',tmp_ba[size+ 2:size+4])[0],
-                    'rnFlags'  : struct.unpack('<H',tmp_ba[size+ 4:size+6])[0],
-                    'rnID'     : struct.unpack('<H',tmp_ba[size+ 6:size+8])[0] & 0x7FFF,
-                    'rnHandle' : struct.unpack('<H',tmp_ba[size+ 8:size+10])[0],
-                    'rnUsage'  : struct.unpack('<H',tmp_ba[size+ 10:size+12])[0]
-                    } )
-                    
-                    size = size + 12 #Skip ahead these entries
-                ptr = ptr + size + 8 # Skip to the next TYPEINFO
-
-            ptr = ptr + 2 # rscEndTypes
-            tmp_ba = dll_bytes[ptr:]
-            names = 0
-            length = 1
-            #Resource Names
-            RESOURCENAMES = []
-
-            while length != 0:
-                length = tmp_ba[names]
-                try:
+        logger.debug("Parsing NE DLL/ICL")
+        if resource_table is None:
+            resource_table = self.ne_resources(self.ne_header())
+        RESOURCENAMES = resource_table['rscResourceNames']
+        rt_icons = resource_table['rtIcons']
 
-                    RESOURCENAMES.append(tmp_ba[names+1:names+1+length].decode())
-                except UnicodeDecodeError:
-                    logger.debug("Could not decode resource name, unicode error")
+        for GRPICONDIRENTRY in resource_table['rscTypes']:
+            if GRPICONDIRENTRY['rttypeid'] == 14: #RT_GROUP_ICON    
+                try:
+                    name = RESOURCENAMES[GRPICONDIRENTRY['rnID']]
+                except (KeyError, IndexError):
+                    name = os.path.splitext(self.filename.split("/")[-1])[0]
+                    logger.debug(f"Missing name, using {name}")
                     pass
-                names = names + tmp_ba[names] + 1
-            
-            resource_table['rscResourceNames'].extend(RESOURCENAMES)
-            resource_table['rscTypes'].extend(TNAMEINFO)
-
-            for GRPICONDIRENTRY in resource_table['rscTypes']:
-                if GRPICONDIRENTRY['rttypeid'] == 14: #RT_GROUP_ICON    
-                    try:
-                        name = RESOURCENAMES[GRPICONDIRENTRY['rnID']]
-                    except (KeyError, IndexError):
-                        name = os.path.splitext(self.filename.split("/")[-1])[0]
-                        logger.debug(f"Missing name, using {name}")
-                        pass
-                    if not name:
-                        name = os.path.splitext(self.filename.split("/")[-1])[0]
-                    idReserved = struct.unpack('<H',dll_bytes[GRPICONDIRENTRY['rnOffset']+0:GRPICONDIRENTRY['rnOffset']+2])[0]
-                    idType = struct.unpack('<H',dll_bytes[GRPICONDIRENTRY['rnOffset']+2:GRPICONDIRENTRY['rnOffset']+4])[0]
-                    idCount = struct.unpack('<H',dll_bytes[GRPICONDIRENTRY['rnOffset']+4:GRPICONDIRENTRY['rnOffset']+6])[0]
-                    tmp_grp = dll_bytes[GRPICONDIRENTRY['rnOffset']+6:]
-                    for x in range(0, idCount):
-                        rtIcon = {
-                        'bWidth'       : tmp_grp[0], # Width, in pixels, of the image
-                        'bHeight'      : tmp_grp[1], # Height, in pixels, of the image
-                        'bColorCount'  : tmp_grp[2], # Number of colors in image (0 if >=8bpp)
-                        'bReserved'    : tmp_grp[3], # Reserved
-                        'wPlanes'      : struct.unpack('<H',tmp_grp[4:6])[0], # Color Planes
-                        'wBitCount'    : struct.unpack('<H',tmp_grp[6:8])[0], # Bits per pixel
-                        'dwBytesInRes' : struct.unpack('<L',tmp_grp[8:12])[0], # how many bytes in this resource?
-                        'nId'          : struct.unpack('<H',tmp_grp[12:14])[0] # RT_ICON rnID
-                        }
-                        
-                        for RT_ICON in resource_table['rscTypes']:
-                            if RT_ICON['rttypeid'] == 3 and  RT_ICON['rnID'] == rtIcon['nId']:
-                                icon_file = bytearray(2) + struct.pack('<H',1) + struct.pack('<H',1)
-                                ICONENTRY = tmp_grp[0:12] + struct.pack('<L', 22)
-                                icon_bitmap = dll_bytes[RT_ICON['rnOffset']:RT_ICON['rnOffset']+rtIcon['dwBytesInRes']]
-                                #print(ICONENTRY)
-                                if rtIcon['bColorCount'] == 0: rtIcon['bColorCount'] = 256
-                                filename = "{}_{}_{}x{}x{}.ico".format(name, GRPICONDIRENTRY['rnID'], rtIcon['bWidth'], rtIcon['bHeight'], rtIcon['bColorCount'])
-
-                                # if folder:
-                                #     logger.info("Creating: {}".format('', folder + filename))
-                                #     f = open(folder + filename,"wb")
-                                #     f.write(icon_file+ICONENTRY+icon_bitmap)
-                                #     f.close()
-                                logger.debug(f"Appending {filename}") 
-                                ICONS.append({
-                                    'filename': filename, 
-                                    'ID'      : GRPICONDIRENTRY['rnID'],
-                                    'Width'   : rtIcon['bWidth'],
-                                    'Height'  : rtIcon['bHeight'],
-                                    'Colors'  : rtIcon['bColorCount'],
-                                    'ICON': icon_file+ICONENTRY+icon_bitmap,
-                                    'original_filename' : self.filename,
-                                    'rtIconDirEntry' : rtIcon
-                                    })
-                        tmp_grp = tmp_grp[14:]
-
-        elif ne_header_char == "PE": 
-            logger.debug("Parsing PE DLL/EXE")
-            pe_icons = []
-            
-            try:
-                extractor = IconExtractor(self.filename)
-            
-                for idx, entry in enumerate(extractor.list_group_icons()):
-                    icon = extractor.get_icon(idx)
-                    icon.seek(0)
-                    iconfile = icon.read()
-                    pe_icons.append({"id": idx, "icon": iconfile})
-                
-                tmp_curfile = self.cur_file
+                if not name:
+                    name = os.path.splitext(self.filename.split("/")[-1])[0]
+                if wanted_group is not None and not wanted_group(GRPICONDIRENTRY['rnID'], name):
+                    continue
+                idReserved, idType, idCount = GRPICONDIR.unpack_from(dll_bytes, GRPICONDIRENTRY['rnOffset'])
+                loc = GRPICONDIRENTRY['rnOffset'] + GRPICONDIR.size
+                for x in range(0, idCount):
+                    dwBytesInRes, nId = struct.unpack_from('<LH', dll_bytes, loc+8)
+                    for RT_ICON in rt_icons.get(nId, ()):
+                        icon = IconRecord(name, GRPICONDIRENTRY['rnID'], bytes(dll_bytes[loc:loc+12]), self.filename, nId=nId)
+                        if wanted is not None:
+                            icon.image = bytes(dll_bytes[RT_ICON['rnOffset']:RT_ICON['rnOffset']+8])
+                            if not wanted(icon):
+                                continue
 
-                for i in pe_icons:
-                    self.cur_file = i['icon']
-                    d = self.extract_ico(index=i['id'])
-                    ICONS.append(d)
+                        icon.image = bytes(dll_bytes[RT_ICON['rnOffset']:RT_ICON['rnOffset']+dwBytesInRes])
+                        logger.debug(f"Appending {icon.filename}")
+                        yield icon
+                    loc += GRPICONDIRENTRY_LAYOUT.size
 
-                self.cur_file = tmp_curfile
-            except:
-                pass
-        return ICONS
+    def iter_icons(self, wanted=None):
+        '''
+        Yields the icons of the file one at a time, as the IconRecords
+        extract_all returns, so only the icon being processed is held in
+        memory.
+
+        wanted is an optional function called with each icon before its
+        image is copied out of the file (it has every key but 'ICON', its
+        image is only the first 8 bytes), icons it returns False for are
+        skipped. If it has a wanted_group method (see IconFilter) it is
+        called with the ids of each group icon before its entries are read.
+        '''
+        if self.icontype == "ICO":
+            yield from self.iter_ico(wanted=wanted)
+        elif self.icontype == "NE":
+            yield from self.iter_ne(wanted)
+        elif self.icontype == "PE":
+            for group in self.iter_pe_groups(wanted):
+                yield from group
+        else:
+            raise ValueError(f"Icon file type must be ICO, NE or PE: {self.icontype}")
 
     def flatten_pe(self, t):
         '''
@@ -341,59 +923,164 @@ class IcoTool:
         logger.debug(f"Best icon {best}: {entries[best]['filename']}")
         return entries[best]
 
-    def extract_all(self):
+    def extract_all(self, icon_filter=None):
         '''
-        Extracts all icons, returns a list of dicts with the format:
+        Extracts all icons, returns a list of IconRecords, which read like
+        dicts with the format:
         'Colors': int,
         'Height': int,
-        'ICON': bytearray(ICON FILE)
+        'ICON': bytes(ICON FILE)
         'ID': int,
         'Width': int,
         'filename' : str,
         'rtIconDirEntry': dictionary of rtIconDirEntry
         (optional) 'Index': int
+
+        icon_filter: optional IconFilter (or any wanted function, see
+                     iter_icons), only the icons it accepts are extracted
         '''
 
         if not self.icontype:
             raise ValueError(f"Icontype cannot be {self.icontype}")
 
-        if self.icontype == "ICO":
-            return self.extract_ico()
-        elif self.icontype in ["NE", "PE"]:
-            if self.icontype == "PE":
-                return self.flatten_pe(self.extract_icons_from_dll())
+        with iconprofile.stage(f"parse_{self.icontype.lower()}", len(self.file_bytes)):
+            if icon_filter is not None:
+                return list(self.iter_icons(icon_filter))
+            if self.icontype == "ICO":
+                return self.extract_ico()
+            elif self.icontype in ["NE", "PE"]:
+                if self.icontype == "PE":
+                    return self.flatten_pe(self.extract_icons_from_dll())
+                else:
+                    return self.extract_icons_from_dll()
             else:
-                return self.extract_icons_from_dll()
+                raise ValueError(f"Icon file type must be ICO, NE or PE: {self.icontype}")
+
+    def icon_sources(self, wanted_group=None):
+        '''
+        Returns a list of (source, group key) for the icons of the file.
+        Calling source(wanted) iterates over icons like iter_icons, the group
+        key function splits its icons into groups (None for one group).
+        Group icons wanted_group (see IconFilter) rejects are left out.
+        '''
+        if self.icontype == "ICO":
+            return [(lambda wanted: self.iter_ico(wanted=wanted), None)]
+        elif self.icontype == "NE":
+            if wanted_group is not None:
+                # The source is iterated more than once, groups are only
+                # checked (and counted) once
+                checked = {}
+                check = wanted_group
+
+                def wanted_group(*keys):
+                    if keys not in checked:
+                        checked[keys] = check(*keys)
+                    return checked[keys]
+
+            # iter_best goes over the icons twice, the resource table is
+            # only parsed once
+            resource_table = self.ne_resources(self.ne_header())
+            return [(lambda wanted: self.iter_ne(wanted, wanted_group, resource_table), lambda icon: icon['ID'])]
+        elif self.icontype == "PE":
+            sources = []
+            try:
+                resources = self.pe_resources()
+            except struct.error as e:
+                logger.debug(f"Unable to parse PE resources: {e}")
+                return sources
+            rt_icons = {nId: (offset, size) for nId, offset, size in resources[3]}
+            for idx, (grp_id, offset, size) in enumerate(resources[14]):
+                if wanted_group is not None and not wanted_group(idx, grp_id):
+                    continue
+                try:
+                    entries = self.pe_group_entries(offset, rt_icons)
+                except (struct.error, KeyError, ValueError) as e:
+                    logger.debug(f"Skipping group icon {idx}: {e}")
+                    continue
+                sources.append((lambda wanted, idx=idx, entries=entries: self.iter_pe_group(idx, entries, wanted), None))
+            return sources
         else:
             raise ValueError(f"Icon file type must be ICO, NE or PE: {self.icontype}")
 
-    def extract_best(self):
+    def iter_best(self, wanted=None):
+        '''
+        Yields the best icon of each group (of the file for ICO files) ranked
+        by rank_icon. The directory entries are read first and only the image
+        of each winning icon is copied out of the file.
+
+        wanted works as in iter_icons, only icons it accepts are ranked.
+        '''
+        for source, group_key in self.icon_sources(getattr(wanted, 'wanted_group', None)):
+            best = {}
+            counter = itertools.count()
+
+            def rank(icon):
+                # Only looks at the metadata, returning False means no image
+                # is copied on this pass
+                n = next(counter)
+                if wanted is None or wanted(icon):
+                    group = group_key(icon) if group_key else None
+                    icon_rank = rank_icon(icon)
+                    if group not in best or icon_rank > best[group][0]:
+                        best[group] = (icon_rank, n)
+                return False
+
+            for icon in source(rank):
+                pass
+
+            winners = {n for icon_rank, n in best.values()}
+            counter = itertools.count()
+            yield from source(lambda icon: next(counter) in winners)
+
+    def extract_best(self, metadata_only=False, icon_filter=None):
 
         '''
-        Extracts the best (highest quality) icons, returns a list of dicts with the format:
+        Extracts the best (highest quality) icons, returns a list of IconRecords with the format:
         'Colors': int,
         'Height': int,
-        'ICON': bytearray(ICON FILE)
+        'ICON': bytes(ICON FILE)
         'ID': int,
         'Width': int,
         'filename' : str,
         'rtIconDirEntry': dictionary of rtIconDirEntry,
         'original_filename' : str,
         (optional) 'Index': int
-        '''
 
-        best = []
+        With metadata_only the best icons are chosen by iter_best, which also
+        ranks bits per pixel and only copies the winning images (and picks
+        one icon per group for NE files too).
+
+        icon_filter: optional IconFilter (or any wanted function, see
+                     iter_icons), the best icons are chosen among those it
+                     accepts
+        '''
 
         if not self.icontype:
             raise ValueError(f"Icontype cannot be {self.icontype}")
 
+        if metadata_only:
+            with iconprofile.stage(f"parse_{self.icontype.lower()}", len(self.file_bytes)):
+                return list(self.iter_best(icon_filter))
+
+        best = []
+
         if self.icontype == "ICO":
+            if icon_filter is not None:
+                icons = list(self.iter_ico(wanted=icon_filter))
+                return [self.best_icon(icons)] if icons else []
             return [self.best_icon(self.extract_ico())]
         elif self.icontype in ["NE", "PE"]:
             if self.icontype == "PE":
-                for iconlist in self.extract_icons_from_dll():
-                    best.append(self.best_icon(iconlist))
+                if icon_filter is not None:
+                    groups = [list(group) for group in self.iter_pe_groups(icon_filter)]
+                else:
+                    groups = self.extract_icons_from_dll()
+                for iconlist in groups:
+                    if iconlist:
+                        best.append(self.best_icon(iconlist))
                 return best
+            elif icon_filter is not None:
+                return list(self.iter_ne(icon_filter))
             else:
                 return self.extract_icons_from_dll()
 
@@ -0,0 +1,96 @@
+import io
+import struct
+import sys
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "benchmarks"))
+
+import corpus
+import icondecode
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+def dib(width, height, bit_count, body):
+    # BITMAPINFOHEADER of an icon DIB, the height covers the AND mask
+    return icondecode.BITMAPINFOHEADER.pack(40, width, height * 2, 1, bit_count, icondecode.BI_RGB, 0, 0, 0, 0, 0) + body
+
+@unittest.skipIf(icondecode.numpy is None, "NumPy is not installed")
+class DecodeDibTest(unittest.TestCase):
+
+    def test_8bpp(self):
+        palette = bytearray(256 * 4)
+        palette[4:8] = bytes((0x30, 0x20, 0x10, 0))
+        xor = bytes([1, 0, 0, 0] * 2)
+        and_mask = struct.pack('>I', 0x40000000) * 2
+        rgba, size = icondecode.decode_dib(dib(2, 2, 8, bytes(palette) + xor + and_mask))
+        self.assertEqual(size, (2, 2))
+        self.assertEqual(rgba, bytes((0x10, 0x20, 0x30, 255, 0, 0, 0, 0)) * 2)
+
+    def test_truncated_palette(self):
+        # 100 bytes cannot hold the 256 colors of an 8 bpp palette
+        self.assertIsNone(icondecode.decode_dib(dib(16, 16, 8, bytes(100))))
+
+def pillow_decode(image):
+    # The decoder icondecode replaces
+    img = Image.open(io.BytesIO(corpus.make_ico([image]))).convert("RGBA")
+    return img.tobytes(), img.size
+
+def mask_alpha(image, size):
+    # Alpha of each pixel, top row first, from the AND mask ending image:
+    # set bits are transparent
+    stride = ((size + 31) // 32) * 4
+    rows = image[len(image) - stride * size:]
+    alpha = bytearray()
+    for y in reversed(range(size)):
+        row = rows[y * stride:(y + 1) * stride]
+        alpha += bytes(0 if row[x // 8] >> (7 - x % 8) & 1 else 255 for x in range(size))
+    return bytes(alpha)
+
+@unittest.skipIf(icondecode.numpy is None or Image is None, "NumPy or Pillow is not installed")
+class PillowTest(unittest.TestCase):
+    '''
+    Random images from benchmarks/corpus.py decode as Pillow decodes them,
+    their AND masks and row padding included.
+    '''
+
+    def test_bit_counts(self):
+        for bpp in (1, 4, 8, 24, 32):
+            for size in (16, 20, 33):
+                with self.subTest(bpp=bpp, size=size):
+                    image = corpus.make_dib(size, size, bpp, seed=size)
+                    self.assertEqual(icondecode.decode_dib(image), pillow_decode(image))
+
+    def test_and_mask(self):
+        for bpp in (1, 4, 8, 24):
+            with self.subTest(bpp=bpp):
+                image = corpus.make_dib(20, 20, bpp, seed=bpp)
+                rgba, size = icondecode.decode_dib(image)
+                self.assertEqual(rgba[3::4], mask_alpha(image, 20))
+                self.assertEqual({0, 255}, set(rgba[3::4]))
+
+    def test_alpha_channel(self):
+        # 32 bpp images use their own alpha, not the AND mask
+        image = corpus.make_dib(16, 16, 32, seed=3)
+        rgba, size = icondecode.decode_dib(image)
+        rows = [image[40 + y * 64:40 + (y + 1) * 64] for y in range(16)]
+        self.assertEqual(rgba[3::4], b"".join(row[3::4] for row in reversed(rows)))
+        self.assertNotEqual(rgba[3::4], mask_alpha(image, 16))
+
+    def test_empty_alpha_channel(self):
+        # 32 bpp images whose alpha is all zero use their AND mask, as
+        # Windows does (Pillow leaves them fully transparent)
+        image = bytearray(corpus.make_dib(16, 16, 32, seed=3))
+        image[40 + 3:40 + 16 * 16 * 4:4] = bytes(16 * 16)
+        rgba, size = icondecode.decode_dib(bytes(image))
+        pillow_rgba, pillow_size = pillow_decode(bytes(image))
+        self.assertEqual(size, pillow_size)
+        self.assertEqual(bytes(b for i, b in enumerate(rgba) if i % 4 != 3), bytes(b for i, b in enumerate(pillow_rgba) if i % 4 != 3))
+        self.assertEqual(rgba[3::4], mask_alpha(bytes(image), 16))
+
+if __name__ == '__main__':
+    unittest.main()
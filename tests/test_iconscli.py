@@ -0,0 +1,82 @@
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import unittest
+import zipfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "benchmarks"))
+
+import corpus
+import iconscli
+
+class SameNameSourcesTest(unittest.TestCase):
+    '''
+    src/a/x.ico and src/b/x.ico hold different icons of the same size, so
+    their icons get the same name.
+    '''
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.folder = Path(self.tmp.name)
+        self.images = {}
+        for seed, sub in enumerate(("a", "b")):
+            image = corpus.make_dib(16, 16, 32, seed=seed)
+            (self.folder / "src" / sub).mkdir(parents=True)
+            (self.folder / "src" / sub / "x.ico").write_bytes(corpus.make_ico([image]))
+            self.images[str(self.folder / "src" / sub / "x.ico")] = image
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def run_cli(self, *args):
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            self.assertEqual(iconscli.main(["-r", "-j", "1", "-f", "ico", str(self.folder / "src"), *args]), 0)
+        return output.getvalue()
+
+    def manifest(self, path):
+        with open(path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_folder(self):
+        out = self.folder / "out"
+        self.assertIn("2 written, 0 skipped", self.run_cli("-o", str(out)))
+        lines = self.manifest(out / "manifest.jsonl")
+        self.assertEqual(len({line['path'] for line in lines}), 2)
+        for line in lines:
+            # Each file holds the image of its own source
+            self.assertTrue(Path(line['path']).read_bytes().endswith(self.images[line['source']]))
+        self.assertEqual(sorted(os.listdir(out)), sorted(["manifest.jsonl"] + [Path(line['path']).name for line in lines]))
+
+        # Running again skips both, it does not write them under new names
+        self.assertIn("0 written, 2 skipped", self.run_cli("-o", str(out)))
+        self.assertEqual(len(os.listdir(out)), 3)
+        self.assertIn("2 written, 0 skipped", self.run_cli("-o", str(out), "--overwrite"))
+        self.assertEqual(self.manifest(out / "manifest.jsonl"), lines)
+
+    def test_archive(self):
+        archive = self.folder / "icons.zip"
+        self.assertIn("2 written", self.run_cli("-a", str(archive)))
+        with zipfile.ZipFile(archive) as zf:
+            lines = [json.loads(line) for line in zf.read("manifest.jsonl").splitlines()]
+            self.assertEqual(len({line['path'] for line in lines}), 2)
+            for line in lines:
+                self.assertTrue(zf.read(line['path']).endswith(self.images[line['source']]))
+
+    def test_dedup(self):
+        # A copy of b/x.ico is listed with the file holding its image
+        (self.folder / "src" / "c").mkdir()
+        (self.folder / "src" / "c" / "x.ico").write_bytes((self.folder / "src" / "b" / "x.ico").read_bytes())
+        out = self.folder / "out"
+        self.run_cli("-o", str(out), "-u")
+        lines = self.manifest(out / "manifest.jsonl")
+        duplicates = [line for line in lines if line.get('duplicate')]
+        self.assertEqual(len(duplicates), 1)
+        self.assertTrue(Path(duplicates[0]['path']).read_bytes().endswith(self.images[str(self.folder / "src" / "b" / "x.ico")]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+import os
+import struct
+import sys
+import tempfile
+import tracemalloc
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "benchmarks"))
+
+import corpus
+import icotool
+
+def ico_images(ico):
+    # The images of an ICO file, as its ICONDIRENTRYs declare them
+    count = struct.unpack_from('<H', ico, 4)[0]
+    images = []
+    for i in range(count):
+        size, offset = struct.unpack_from('<LL', ico, 6 + i * 16 + 8)
+        images.append(bytes(ico[offset:offset + size]))
+    return images
+
+def parse(name, data):
+    tool = icotool.IcoTool(name, data=data)
+    return tool, tool.extract_all()
+
+class RoundTripTest(unittest.TestCase):
+    '''
+    Files built by benchmarks/corpus.py give back the images they hold,
+    wrapped in ICO files that hold them unchanged.
+    '''
+
+    groups = corpus.group_images(3, sizes=(16, 32), png_size=48)
+
+    def check_icons(self, icons, groups):
+        images = [image for group in groups for image in group]
+        self.assertEqual([bytes(icon.image) for icon in icons], images)
+        for icon, image in zip(icons, images):
+            self.assertEqual(ico_images(icon['ICON']), [image])
+            width = struct.unpack_from('>I', image, 16)[0] if image[:8] == icotool.PNG_SIGNATURE else struct.unpack_from('<i', image, 4)[0]
+            self.assertEqual((icon['Width'], icon['Height']), (width, width))
+
+    def test_ico(self):
+        tool, icons = parse("x.ico", corpus.make_ico(self.groups[0]))
+        self.assertEqual(tool.icontype, "ICO")
+        self.check_icons(icons, self.groups[:1])
+        self.assertEqual([icon['ID'] for icon in icons], [0, 1, 2])
+        self.assertEqual([icon['filename'] for icon in tool.extract_best()], ["x_2_48x48x256.ico"])
+
+    def test_ico_bits(self):
+        for bpp in (1, 4, 8, 24, 32):
+            images = [corpus.make_dib(16, 16, bpp), corpus.make_dib(32, 32, bpp)]
+            tool, icons = parse("x.ico", corpus.make_ico(images))
+            self.check_icons(icons, [images])
+            self.assertEqual([icon['rtIconDirEntry']['wBitCount'] for icon in icons], [bpp, bpp])
+
+    def test_pe(self):
+        for pe32plus in (False, True):
+            tool, icons = parse("x.dll", corpus.make_pe(self.groups, pe32plus=pe32plus))
+            self.assertEqual(tool.icontype, "PE")
+            self.check_icons(icons, self.groups)
+            self.assertEqual([icon['index'] for icon in icons], [0] * 3 + [1] * 3 + [2] * 3)
+            self.assertEqual([icon['filename'] for icon in tool.extract_best()], [f"x_{index}_2_48x48x256.ico" for index in range(3)])
+            self.assertEqual(tool.extract_best(metadata_only=True), tool.extract_best())
+
+    def test_ne(self):
+        tool, icons = parse("x.icl", corpus.make_ne(self.groups))
+        self.assertEqual(tool.icontype, "NE")
+        self.check_icons(icons, self.groups)
+        self.assertEqual([icon['filename'] for icon in icons[:3]], ["ICON1_1_16x16x256.ico", "ICON1_1_32x32x256.ico", "ICON1_1_48x48x256.ico"])
+        best = tool.extract_best(metadata_only=True)
+        self.assertEqual([icon['filename'] for icon in best], [f"ICON{group}_{group}_48x48x256.ico" for group in (1, 2, 3)])
+
+    def test_ne_best_parses_once(self):
+        tool = icotool.IcoTool("x.icl", data=corpus.make_ne(self.groups))
+        calls = []
+        ne_resources = tool.ne_resources
+        tool.ne_resources = lambda e_lfanew: calls.append(e_lfanew) or ne_resources(e_lfanew)
+        self.assertEqual(len(tool.extract_best(metadata_only=True)), 3)
+        self.assertEqual(len(calls), 1)
+
+    def test_best_unknown_type(self):
+        tool = icotool.IcoTool("x.ico", data=corpus.make_ico(self.groups[0]))
+        tool.icontype = None
+        for metadata_only in (False, True):
+            with self.assertRaises(ValueError):
+                tool.extract_best(metadata_only=metadata_only)
+
+    def test_ne_without_names(self):
+        tool, icons = parse("x.icl", corpus.make_ne(self.groups, names=False))
+        self.check_icons(icons, self.groups)
+        self.assertEqual(icons[0]['filename'], "x_1_16x16x256.ico")
+
+    def test_iter_icons(self):
+        for name, data in (("x.ico", corpus.make_ico(self.groups[0])), ("x.dll", corpus.make_pe(self.groups)), ("x.icl", corpus.make_ne(self.groups))):
+            tool, icons = parse(name, data)
+            self.assertEqual(list(tool.iter_icons()), icons)
+
+class NEAllocationTest(unittest.TestCase):
+
+    # Allowed allocation per icon on top of the icon bytes returned
+    ALLOC_PER_ICON = 4096
+    ALLOC_SLACK = 1 << 20
+
+    def test_allocations(self):
+        # A 10 icon library followed by 32 MB of unrelated data: the memory
+        # allocated while parsing must not grow with the file size
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "alloc.icl")
+            with open(filename, 'wb') as f:
+                f.write(corpus.make_ne(corpus.group_images(10, sizes=(16, 32))))
+                f.write(bytes(32 << 20))
+
+            with icotool.IcoTool(filename, use_mmap=True) as tool:
+                tracemalloc.start()
+                try:
+                    icons = tool.extract_all()
+                    current, peak = tracemalloc.get_traced_memory()
+                finally:
+                    tracemalloc.stop()
+
+        self.assertEqual(len(icons), 20)
+        returned = sum(len(icon['ICON']) for icon in icons)
+        self.assertLessEqual(peak, returned + len(icons) * self.ALLOC_PER_ICON + self.ALLOC_SLACK)
+
+class PEGroupEntryTest(unittest.TestCase):
+
+    def test_size_mismatch(self):
+        # The group entry of the first image says 100 bytes, its RT_ICON
+        # holds the whole image
+        images = corpus.group_images(1, sizes=(16, 32))[0]
+        pe = bytearray(corpus.make_pe([images]))
+        group_offset = icotool.IcoTool("x.dll", data=bytes(pe)).pe_resources()[14][0][1]
+        struct.pack_into('<L', pe, group_offset + icotool.GRPICONDIR.size + 8, 100)
+
+        icons = icotool.IcoTool("x.dll", data=bytes(pe)).extract_all()
+        self.assertEqual([bytes(icon.image) for icon in icons], images)
+        for icon, image in zip(icons, images):
+            self.assertEqual(icon['rtIconDirEntry']['dwBytesInRes'], len(image))
+            self.assertEqual(ico_images(icon['ICON']), [image])
+
+if __name__ == '__main__':
+    unittest.main()